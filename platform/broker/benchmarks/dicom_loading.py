@@ -0,0 +1,101 @@
+## Benchmarks for loading source DICOM series
+# Run from platform/broker:
+#   python benchmarks/dicom_loading.py header-only [--series PATH] [--slices 200] [--size 512]
+#   python benchmarks/dicom_loading.py workers [--series PATH] [--slices 200] [--size 512] [--repeat 3]
+# Without --series, a synthetic CT series is written to a temporary directory.
+# header-only runs each mode in a fresh process so that its peak RSS is not hidden by an earlier mode.
+# workers compares header parsing throughput with 1, 2, 4 and 8 thread and process workers.
+
+import os
+import sys
+import argparse
+import resource
+import tempfile
+import time
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synthetic import write_ct_series
+
+def _peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _run_header_only_mode(series_path, mode, output_path, results):
+    import numpy as np
+    from rtstruct_to_seg_conversion import load_dicom_series, convert_3d_numpy_array_to_dicom_seg
+
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+    if mode == 'full':
+        dicom_series = load_dicom_series(series_path)
+    elif mode == 'deferred':
+        dicom_series = load_dicom_series(series_path, defer_pixels=True)
+    else:
+        dicom_series = load_dicom_series(series_path, header_only=True)
+    load_time = time.perf_counter() - start
+    load_rss = _peak_rss_mb() - baseline
+
+    mask = np.zeros((len(dicom_series), dicom_series[0].Rows, dicom_series[0].Columns), dtype=np.uint8)
+    mask[len(dicom_series) // 4:len(dicom_series) // 2, 100:200, 100:200] = 1
+    start = time.perf_counter()
+    convert_3d_numpy_array_to_dicom_seg(dicom_series, mask, ['Benchmark'], output_path, slice_axis=0)
+    seg_time = time.perf_counter() - start
+
+    results.put((mode, load_time, seg_time, load_rss, _peak_rss_mb() - baseline))
+
+def benchmark_header_only(series_path):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    with tempfile.TemporaryDirectory() as output_dir:
+        for mode in ['full', 'deferred', 'header-only']:
+            process = context.Process(target=_run_header_only_mode,
+                                      args=(series_path, mode, os.path.join(output_dir, f'{mode}.dcm'), results))
+            process.start()
+            process.join()
+            mode, load_time, seg_time, load_rss, peak_rss = results.get()
+            print(f'{mode:>12}: load {load_time:7.3f}s ({load_rss:7.1f} MB) | '
+                  f'build SEG {seg_time:7.3f}s | peak RSS increase {peak_rss:7.1f} MB')
+
+def benchmark_workers(series_path, repeat):
+    from rtstruct_to_seg_conversion import load_dicom_series
+
+    reference_order = None
+    for use_processes in [False, True]:
+        for workers in [1, 2, 4, 8]:
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                dicom_series = load_dicom_series(series_path, header_only=True, workers=workers, use_processes=use_processes)
+                times.append(time.perf_counter() - start)
+
+            order = [d.SOPInstanceUID for d in dicom_series]
+            if reference_order is None:
+                reference_order = order
+            assert order == reference_order, 'load order changed with the number of workers'
+
+            best = min(times)
+            print(f'{"processes" if use_processes else "threads":>9} x {workers}: '
+                  f'{best:7.3f}s | {len(dicom_series) / best:8.1f} files/s')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=['header-only', 'workers'])
+    parser.add_argument('--series', help='directory of an existing DICOM series')
+    parser.add_argument('--slices', type=int, default=200)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        series_path = args.series
+        if series_path is None:
+            series_path = os.path.join(temp_dir, 'series')
+            print(f'Writing a synthetic series of {args.slices} {args.size}x{args.size} slices...')
+            write_ct_series(series_path, args.slices, args.size, args.size)
+
+        if args.benchmark == 'header-only':
+            benchmark_header_only(series_path)
+        elif args.benchmark == 'workers':
+            benchmark_workers(series_path, args.repeat)
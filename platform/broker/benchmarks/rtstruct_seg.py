@@ -0,0 +1,80 @@
+## Benchmark for the memory of RTSTRUCT to SEG conversion
+# Run from platform/broker:
+#   python benchmarks/rtstruct_seg.py [--slices 200] [--size 512] [--rois 5 15 30]
+# A synthetic series is written to a temporary directory and, for each ROI count, ROI masks of box shaped structures
+# (each over a tenth of the slices) are written as a SEG by convert_mask_to_dicom_seg, in a fresh process for each
+# mode so that its peak RSS is not hidden by an earlier one:
+#   one-hot  the old masks: a full int32 volume per ROI, stacked into a (slices, rows, columns, ROIs) uint8 array
+#   packed   the PackedRoiMasks of get_roi_masks, unpacked one frame at a time while the SEG is encoded
+
+import os
+import sys
+import argparse
+import resource
+import tempfile
+import time
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import numpy as np
+from synthetic import write_ct_series
+
+def _peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _get_roi_mask(shape, label):
+    rng = np.random.default_rng(label)
+    columns, rows, num_slices = shape
+    depth = max(1, num_slices // 10)
+    z = rng.integers(0, num_slices - depth + 1)
+    x, y = rng.integers(0, columns // 2), rng.integers(0, rows // 2)
+    mask = np.zeros(shape, dtype=bool)
+    mask[x:x + columns // 4, y:y + rows // 4, z:z + depth] = True
+    return mask
+
+def _run_mode(series_path, num_rois, mode, results):
+    from rtstruct_to_seg_conversion import load_dicom_series, convert_mask_to_dicom_seg, convert_4d_numpy_array_to_dicom_seg, PackedRoiMask
+
+    dicom_series = load_dicom_series(series_path, header_only=True)
+    shape = (dicom_series[0].Columns, dicom_series[0].Rows, len(dicom_series))
+    roi_names = [f'ROI {label}' for label in range(1, num_rois + 1)]
+    baseline = _peak_rss_mb()
+
+    masks = {}
+    for label, roi_name in enumerate(roi_names, 1):
+        mask = _get_roi_mask(shape, label)
+        masks[roi_name] = { 'mask': mask.astype(np.int32) if mode == 'one-hot' else PackedRoiMask.from_array(mask) }
+
+    start = time.perf_counter()
+    if mode == 'one-hot':
+        pixel_array = np.zeros((shape[2], shape[0], shape[1], num_rois), dtype=np.uint8)
+        for i, roi_name in enumerate(roi_names):
+            pixel_array[:, :, :, i] = np.transpose((masks[roi_name]['mask'] > 0).astype(np.uint8), (2, 0, 1))
+        convert_4d_numpy_array_to_dicom_seg(dicom_series, pixel_array, roi_names, None)
+    else:
+        convert_mask_to_dicom_seg(dicom_series, masks, roi_names, None)
+    results.put((mode, time.perf_counter() - start, _peak_rss_mb() - baseline))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slices', type=int, default=200)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--rois', type=int, nargs='+', default=[5, 15, 30])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        series_path = os.path.join(temp_dir, 'series')
+        print(f'Writing a synthetic series of {args.slices} {args.size}x{args.size} slices...')
+        write_ct_series(series_path, args.slices, args.size, args.size)
+
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        for num_rois in args.rois:
+            for mode in ['one-hot', 'packed']:
+                process = context.Process(target=_run_mode, args=(series_path, num_rois, mode, results))
+                process.start()
+                process.join()
+                mode, seg_time, peak_rss = results.get()
+                print(f'{num_rois:3} ROIs {mode:>8}: build SEG {seg_time:7.3f}s | peak RSS increase {peak_rss:7.1f} MB')
@@ -0,0 +1,92 @@
+## Benchmark for preparing label maps for SEG writing
+# Run from platform/broker:
+#   python benchmarks/seg_label_map.py [--slices 600] [--size 512] [--rois 5] [--dtype int64] [--slice-axis 2]
+# A synthetic series and a label map of --dtype with its slices along --slice-axis (the layout of the legacy .npz
+# model outputs by default) are written to a temporary directory. convert_3d_numpy_array_to_dicom_seg is then run
+# in a fresh process for each mode, so that its peak RSS is not hidden by an earlier one:
+#   copying      the old preparation: a full astype copy of the transposed label map, then scans for its min and max,
+#                and highdicom scanning it for its max again
+#   single-pass  get_slice_major_label_map, and highdicom trusting its result
+
+import os
+import sys
+import argparse
+import contextlib
+import resource
+import tempfile
+import time
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import numpy as np
+from synthetic import write_ct_series
+
+def _peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _copying_label_map(numpy_array, num_labels):
+    numpy_array = numpy_array.astype(np.uint8)
+    return numpy_array, int(numpy_array.min()), int(numpy_array.max())
+
+def _run_mode(series_path, label_map_path, slice_axis, num_rois, mode, results):
+    import monkey_patches
+    import rtstruct_to_seg_conversion
+    from rtstruct_to_seg_conversion import load_dicom_series, convert_3d_numpy_array_to_dicom_seg
+
+    if mode == 'copying':
+        rtstruct_to_seg_conversion.get_slice_major_label_map = _copying_label_map
+        monkey_patches.checked_label_map = lambda pixel_array: contextlib.nullcontext()
+
+    dicom_series = load_dicom_series(series_path, header_only=True)
+    label_map = np.load(label_map_path)
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+    convert_3d_numpy_array_to_dicom_seg(dicom_series, label_map, [f'ROI {i}' for i in range(1, num_rois + 1)], None,
+                                        slice_axis=slice_axis)
+    results.put((mode, time.perf_counter() - start, _peak_rss_mb() - baseline))
+
+def _get_label_map(shape, slice_axis, num_rois, dtype):
+    rng = np.random.default_rng(0)
+    num_slices = shape[slice_axis]
+    label_map = np.zeros(shape, dtype=dtype)
+    depth = max(1, num_slices // 10)
+    for label in range(1, num_rois + 1):
+        box = [slice(None)] * 3
+        z = rng.integers(0, num_slices - depth + 1)
+        box[slice_axis] = slice(z, z + depth)
+        for axis in range(3):
+            if axis != slice_axis:
+                start = rng.integers(0, shape[axis] // 2)
+                box[axis] = slice(start, start + shape[axis] // 4)
+        label_map[tuple(box)] = label
+    return label_map
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slices', type=int, default=600)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--rois', type=int, default=5)
+    parser.add_argument('--dtype', default='int64')
+    parser.add_argument('--slice-axis', type=int, default=2, choices=[0, 1, 2])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        series_path = os.path.join(temp_dir, 'series')
+        print(f'Writing a synthetic series of {args.slices} {args.size}x{args.size} slices...')
+        write_ct_series(series_path, args.slices, args.size, args.size)
+
+        shape = [args.size, args.size]
+        shape.insert(args.slice_axis, args.slices)
+        label_map_path = os.path.join(temp_dir, 'label_map.npy')
+        np.save(label_map_path, _get_label_map(tuple(shape), args.slice_axis, args.rois, np.dtype(args.dtype)))
+
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        for mode in ['copying', 'single-pass']:
+            process = context.Process(target=_run_mode, args=(series_path, label_map_path, args.slice_axis, args.rois, mode, results))
+            process.start()
+            process.join()
+            mode, seg_time, peak_rss = results.get()
+            print(f'{mode:>12}: build SEG {seg_time:7.3f}s | peak RSS increase {peak_rss:7.1f} MB')
@@ -0,0 +1,94 @@
+## Benchmark for the SEG writer options (SEG_OMIT_EMPTY_FRAMES)
+# Run from platform/broker:
+#   python benchmarks/seg_writing.py [--series PATH] [--slices 200] [--size 512] [--rois 5] [--upload]
+# Without --series, a synthetic CT series is written to a temporary directory.
+# A label map with --rois box shaped structures, each over a tenth of the slices, is written as a SEG with and
+# without empty frames. For each the write time and file size are reported, whether decode_seg reads it back to the
+# same volume as the full frame SEG and, with --upload, the time to upload it to the Orthanc configured for the broker.
+
+import os
+import sys
+import argparse
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import numpy as np
+from synthetic import write_ct_series
+
+_MODES = [
+    ('full frames', '0'),
+    ('sparse frames', '1'),
+]
+
+def _get_label_map(num_slices, rows, columns, num_rois):
+    rng = np.random.default_rng(0)
+    label_map = np.zeros((num_slices, rows, columns), dtype=np.uint8)
+    depth = max(1, num_slices // 10)
+    for label in range(1, num_rois + 1):
+        z = rng.integers(0, num_slices - depth + 1)
+        y, x = rng.integers(0, rows // 2), rng.integers(0, columns // 2)
+        label_map[z:z + depth, y:y + rows // 4, x:x + columns // 4] = label
+    return label_map
+
+def _decode(seg_path):
+    from seg_mask_dice import decode_seg
+    try:
+        return decode_seg(seg_path)[0]
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+
+def benchmark_seg_writing(series_path, num_rois, upload):
+    from rtstruct_to_seg_conversion import load_dicom_series, convert_3d_numpy_array_to_dicom_seg
+
+    dicom_series = load_dicom_series(series_path, header_only=True)
+    label_map = _get_label_map(len(dicom_series), dicom_series[0].Rows, dicom_series[0].Columns, num_rois)
+    roi_names = [f'ROI {label}' for label in range(1, num_rois + 1)]
+
+    if upload:
+        from orthanc_functions import uploadSegFile
+
+    reference = None
+    with tempfile.TemporaryDirectory() as output_dir:
+        for name, omit_empty_frames in _MODES:
+            os.environ['SEG_OMIT_EMPTY_FRAMES'] = omit_empty_frames
+            output_path = os.path.join(output_dir, f'{omit_empty_frames}.dcm')
+
+            start = time.perf_counter()
+            convert_3d_numpy_array_to_dicom_seg(dicom_series, label_map, roi_names, output_path, slice_axis=0)
+            write_time = time.perf_counter() - start
+
+            line = f'{name:>13}: write {write_time:7.3f}s | {os.path.getsize(output_path) / 1024 / 1024:8.2f} MB'
+            if upload:
+                start = time.perf_counter()
+                uploadSegFile(output_path)
+                line += f' | upload {time.perf_counter() - start:7.3f}s'
+
+            decoded = _decode(output_path)
+            if reference is None:
+                reference = decoded
+                print(line)
+            elif isinstance(decoded, str):
+                print(line + f' | decode_seg fails ({decoded})')
+            else:
+                same = decoded.shape == reference.shape and np.array_equal(decoded, reference)
+                print(line + f' | decodes {"the same" if same else f"differently, to {decoded.shape}"}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--series', help='directory of an existing DICOM series')
+    parser.add_argument('--slices', type=int, default=200)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--rois', type=int, default=5)
+    parser.add_argument('--upload', action='store_true', help='also upload each SEG to the Orthanc configured for the broker')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        series_path = args.series
+        if series_path is None:
+            series_path = os.path.join(temp_dir, 'series')
+            print(f'Writing a synthetic series of {args.slices} {args.size}x{args.size} slices...')
+            write_ct_series(series_path, args.slices, args.size, args.size)
+
+        benchmark_seg_writing(series_path, args.rois, args.upload)
@@ -0,0 +1,60 @@
+## Synthetic DICOM data for the broker benchmarks
+# Writes a CT-like series of random slices so the benchmarks can run without Orthanc or real patient data.
+
+import os
+import numpy as np
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian, CTImageStorage
+
+def write_ct_series(output_dir: str, num_slices: int = 200, rows: int = 512, columns: int = 512, slice_thickness: float = 1.0) -> str:
+    '''Writes num_slices CT instances to output_dir in random order and returns the SeriesInstanceUID'''
+    os.makedirs(output_dir, exist_ok=True)
+    study_uid, series_uid, frame_of_reference_uid = generate_uid(), generate_uid(), generate_uid()
+    rng = np.random.default_rng(0)
+
+    for i in rng.permutation(num_slices):
+        sop_instance_uid = generate_uid()
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = CTImageStorage
+        file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        ds = FileDataset(None, {}, file_meta=file_meta, preamble=b'\0' * 128)
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = sop_instance_uid
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.FrameOfReferenceUID = frame_of_reference_uid
+        ds.PatientID = 'BENCHMARK'
+        ds.PatientName = 'Benchmark^Patient'
+        ds.PatientBirthDate = ''
+        ds.PatientSex = 'O'
+        ds.StudyDate = '20240101'
+        ds.StudyTime = '000000'
+        ds.StudyID = '1'
+        ds.AccessionNumber = ''
+        ds.ReferringPhysicianName = ''
+        ds.Manufacturer = 'Benchmark'
+        ds.Modality = 'CT'
+        ds.SeriesNumber = 1
+        ds.InstanceNumber = int(i) + 1
+        ds.ImagePositionPatient = [0.0, 0.0, float(i) * slice_thickness]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [0.8, 0.8]
+        ds.SliceThickness = slice_thickness
+        ds.Rows = rows
+        ds.Columns = columns
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.RescaleIntercept = -1024
+        ds.RescaleSlope = 1
+        ds.PixelData = rng.integers(0, 2048, (rows, columns), dtype=np.int16).tobytes()
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.save_as(os.path.join(output_dir, f'{sop_instance_uid}.dcm'), write_like_original=False)
+
+    return series_uid
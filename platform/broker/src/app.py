@@ -15,22 +15,35 @@ from flask_helpers import (
     run_predictions,
     get_dicom_series_from_orthanc_to_cache
 )
-from docker_registry_helpers import list_docker_images, get_docker_image
+from docker_registry_helpers import list_docker_images, list_model_catalog, get_docker_image
 from gcloud_auth import auth_with_key_file_json, read_env_vars, validate_zone, validate_machine_type
 from werkzeug.middleware.proxy_fix import ProxyFix
 from orthanc_get import get_files_and_dice_score
+from orthanc_client import get_orthanc_metrics
 from orthanc_functions import (
     change_tags, get_tags,
     get_dicom_series_by_id, get_first_dicom_image_series_from_study,
     uploadSegFile,
     get_modality_of_series,
     get_next_available_iterative_name_for_series,
-    extract_dicom_series_zip
+    reserve_iterative_names_for_series,
+    release_iterative_names,
+    find_cohort_series,
+    extract_dicom_series_zip,
+    write_series_zip
 )
+from series_cache import get_series_cache
+from volume_cache import get_volume_cache
+from metric_cache import get_metric_cache, get_metric_config
+from mask_cache import get_mask_cache
 from seg_converter_main_func import process_conversion
+from cohort_evaluation import evaluate_cohort
+from prediction_export import export_predictions_to_seg, PREDICTION_SUFFIXES
 from getRTStructWithoutDICEDict import getRTStructWithoutDICEDict
-from rtstruct_to_seg_conversion import convert_3d_numpy_array_to_dicom_seg, load_dicom_series, convert_mask_to_dicom_seg, get_non_intersection_mask_to_seg
-from seg_mask_dice import seg_to_mask
+from rtstruct_to_seg_conversion import convert_mask_to_dicom_seg, get_non_intersection_mask_to_seg, get_seg_output_path
+from seg_mask_dice import seg_to_mask, validate_metrics, DEFAULT_SURFACE_TOLERANCE
+from instance_registry import get_instance_index, get_instance_metadata, invalidate_instance_index
+from job_queue import JobQueue, JobStatus, QueueFullError, current_job_id, get_configured_int, get_jobs_db_path
 import numpy as np
 import threading
 import shutil
@@ -39,7 +52,6 @@ from typing import Union
 from google.cloud.compute_v1.types import Instance
 import json
 from datetime import datetime
-import gzip
 
 app = Flask(__name__)
 
@@ -106,7 +118,8 @@ app.config['SECRET_KEY'] = 'asdfjkl'
 # Initialize SocketIO
 socketio = SocketIO(app, cors_allowed_origins="*", path='/api/socket.io' if __name__ == '__main__' else 'socket.io')
 
-PREDICTION_LOCK = 0
+# Setting up an instance may switch _ZONE to a backup zone, so only one prediction job sets up at a time
+PREDICTION_SETUP_LOCK = threading.Lock()
 MODELS_BEING_SET_UP = {}
 
 # Serve React App
@@ -161,25 +174,37 @@ def emit_update_progressbar(value, type='prediction'):
     socketio.emit(f"{type}_progress_update", {"value": value})
     # pass
 
+def make_progressbar_callback(start, end, type='prediction'):
+    '''Maps the (done, total) progress of one step onto [start, end] of the progress bar, emitting only on change'''
+    last_value = [None]
+    def callback(done, total):
+        value = start + ((end - start) * done) // max(total, 1)
+        if value != last_value[0]:
+            last_value[0] = value
+            emit_update_progressbar(value, type=type)
+    return callback
+
 def emit_toast(message, type='success'): # type = success | warning | error
     socketio.emit('toast_message', {'message': message, 'type': type})
 
 def emit_update_model_list():
     socketio.emit('update_model_list')
 
+def emit_job_update(job):
+    socketio.emit('job_update', job)
+
+JOBS = JobQueue(get_jobs_db_path(), on_update=emit_job_update)
+
 def clear_unused_instances():
-    instances = list_instances(_PROJECT_ID, _ZONE)
+    index = get_instance_index(_PROJECT_ID, _ZONE)
     print('Suspending running instances')
-    for instance in instances:
-        if instance.status == 'RUNNING':
-            print(instance.name, 'is running. Checking if idling:')
-            is_idling = next(filter(lambda m: m.key == 'idling', instance.metadata.items), None)
-            is_idling = is_idling is not None and is_idling.value == 'True'
-            if is_idling:
-                print(' Is idling, did not suspend')
-            else:
-                print(' Suspending', instance.name)
-                suspend_instance(_PROJECT_ID, _ZONE, instance.name, block=False)
+    for instance in index.by_status.get('RUNNING', []):
+        print(instance.name, 'is running. Checking if idling:')
+        if index.is_idling(instance):
+            print(' Is idling, did not suspend')
+        else:
+            print(' Suspending', instance.name)
+            suspend_instance(_PROJECT_ID, _ZONE, instance.name, block=False)
         # elif instance.status in ['PROVISIONING', 'STAGING']:
 
     return
@@ -217,41 +242,34 @@ def clear_backup_region_instances():
 
     print('Deleted', deleted, 'backup instances')
 
+def is_instance_available_for_any_model(instance: Instance, index) -> bool:
+    '''An instance can be reused for another model if it is stopped, has no model, or is running but idling'''
+    return (instance.status in ['TERMINATED', 'SUSPENDED'] or
+            index.get_metadata_value(instance, 'model-displayname') is None or
+            (index.is_idling(instance) and instance.status in ['RUNNING']))
+
 def get_existing_instance_for_model(model_name: str, try_any_avail=False):
     '''Get the Instance associated with a model name, or None if it does not exist'''
 
-    all_instances = list_instances(_PROJECT_ID, _ZONE)
+    index = get_instance_index(_PROJECT_ID, _ZONE)
     print('getting existing instances...')
-    possible_any_avail_models = []
-    for instance in all_instances:
-        print(instance.name)
-        # if instance.metadata['model-displayname'] == model_name:
-        this_name = next(filter(lambda m: m.key == 'model-displayname', instance.metadata.items), None)
-        is_idling = next(filter(lambda m: m.key == 'idling', instance.metadata.items), None)
-        # print(instance.metadata.items)
-        # print(this_name)
-        # print(instance.status)
-        if (try_any_avail and (instance.status in ['TERMINATED', 'SUSPENDED'] or this_name is None or
-                               (is_idling is not None and is_idling.value == 'True' and instance.status in ['RUNNING']))):
-            possible_any_avail_models.append(instance)
-        elif (this_name is not None and this_name.value == model_name):
-        # if (this_name is not None and this_name.value == model_name):
+    for instance in index.by_model.get(model_name, []):
+        if not (try_any_avail and is_instance_available_for_any_model(instance, index)):
             return instance
 
-    if len(possible_any_avail_models) != 0:
-        return possible_any_avail_models[0]
+    if try_any_avail:
+        return next((i for i in index.instances if is_instance_available_for_any_model(i, index)), None)
 
     return None
 
 def is_able_to_predict_on_dicom_series(selected_model: str, dicom_series_id: str):
     '''Returns false if another instance (not this model) is already running predictions on this dicom series'''
-    all_instances = list_instances(_PROJECT_ID, _ZONE)
-    print('# instances:', len(all_instances))
-    for instance in all_instances:
-        this_dicom_image = next(filter(lambda m: m.key == 'dicom-image', instance.metadata.items), None)
-        this_name = next(filter(lambda m: m.key == 'model-displayname', instance.metadata.items), None)
-        if this_dicom_image is not None and this_dicom_image.value == dicom_series_id:
-            return this_name is None or this_name.value == selected_model
+    index = get_instance_index(_PROJECT_ID, _ZONE)
+    print('# instances:', len(index.instances))
+    instances_on_series = index.by_dicom_image.get(dicom_series_id)
+    if instances_on_series:
+        this_name = index.get_metadata_value(instances_on_series[0], 'model-displayname')
+        return this_name is None or this_name == selected_model
 
     return True
     # filename = _MODEL_INSTANCES_FILEPATH
@@ -296,11 +314,12 @@ def is_tracked_model_instance_running(model_name_or_instance: Union[str | Instan
         # print(model_name_or_instance.name)
         instance = model_name_or_instance
 
-    is_idling = None if instance is None else next(filter(lambda m: m.key == 'idling', instance.metadata.items), None)
-    this_name = None if instance is None else next(filter(lambda m: m.key == 'model-displayname', instance.metadata.items), None)
+    metadata = {} if instance is None else get_instance_metadata(instance)
+    is_idling = metadata.get('idling') == 'True'
+    this_name = metadata.get('model-displayname')
     print(is_idling, this_name)
     return instance is not None and this_name is not None and (instance.status not in ['TERMINATED', 'SUSPENDED'] and
-                                                               (is_idling is None or is_idling.value != 'True' or instance.status in ['SUSPENDING', 'STOPPING']))
+                                                               (not is_idling or instance.status in ['SUSPENDING', 'STOPPING']))
     # filename = _MODEL_INSTANCES_FILEPATH
     # model_instances = read_json(filename, default_as_dict=False)
     # for model_instance in model_instances:
@@ -338,7 +357,7 @@ def get_containers():
     print("fetching containers")
     try:
         # emit_status_update('Getting containers')
-        containers = list_instances( _PROJECT_ID, _ZONE)
+        containers = get_instance_index(_PROJECT_ID, _ZONE).instances
         arr = [c.name for c in containers]
 
         return jsonify({"containers": arr}), 200
@@ -374,14 +393,19 @@ def authenticateGoogleCloud():
 @bp.route('/listModels', methods=['GET'])
 def list_models():
     # return jsonify({'hello': 'world'}), 200
-    docker_packages = list_docker_images(_PROJECT_ID, _ZONE, _REPOSITORY, specific_tags=False)
+    docker_packages = list_model_catalog(_PROJECT_ID, _ZONE, _REPOSITORY)
     # print(docker_packages)
-    return jsonify({'models': [
+    response = jsonify({'models': [
         {
             'name': d.name.split('/')[-1],
             'updateTime': d.update_time.rfc3339(),
             'running': MODELS_BEING_SET_UP.get(d.name.split('/')[-1]) or is_tracked_model_instance_running(d.name.split('/')[-1])
-        } for d in docker_packages]}), 200
+        } for d in docker_packages]})
+
+    # unchanged lists are answered with 304 Not Modified when the panel sends If-None-Match
+    response.headers['Cache-Control'] = 'no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
 
 @bp.route('/isModelRunning', methods=['POST'])
 def is_model_running():
@@ -410,6 +434,8 @@ def setup_compute_with_model_helper(selected_model, start_compute=True, dicom_se
     new_instance = None
     while not succeeded_or_def_failed:
         try:
+            # pick the instance from an up to date listing, since another job may have just claimed one
+            invalidate_instance_index(_PROJECT_ID, _ZONE)
             existing_instance = get_existing_instance_for_model(selected_model, try_any_avail=True)
             # print(existing_instance.name)
             new_instance_name = generate_instance_name('ohif-instance', 'predictor') if existing_instance is None else existing_instance.name
@@ -522,68 +548,66 @@ def convert_cached_pred_result_to_seg(dicom_series_obj, dcm_prediction_dir, cach
     print('Converting to SEG...')
 
     temp_seg_path = os.path.join(dcm_prediction_dir, '__convert/')
-    temp_image_path = os.path.join(dcm_prediction_dir, '__image/')
-    extract_dicom_series_zip(cached_dicom_series_path, temp_image_path, remove_original=True)
+    if cached_dicom_series_path.endswith('.zip'):
+        temp_image_path = os.path.join(dcm_prediction_dir, '__image/')
+        extract_dicom_series_zip(cached_dicom_series_path, temp_image_path, remove_original=True)
+    else:
+        # the series files are already on disk, e.g. in the series cache
+        temp_image_path = cached_dicom_series_path
     # os.remove(os.path.join(dcm_prediction_dir, 'series.zip'))
     # temp_images_path = os.path.join(dcm_prediction_dir, '_images/')
     os.makedirs(temp_seg_path, exist_ok=True)
     # os.makedirs(temp_images_path, exist_ok=True)
     print('temp seg path', temp_seg_path)
 
-    # Convert all npz files in cache
-    dcm_pred_files = os.listdir(dcm_prediction_dir)
-    success_count = 0
-    for f in dcm_pred_files:
+    # Convert all npz and qdpred files in cache
+    prediction_files = []
+    for f in sorted(os.listdir(dcm_prediction_dir)):
         if os.path.isfile(filepath := os.path.join(dcm_prediction_dir, f)):
             print(filepath)
-            if not filepath.endswith('.npz'):
-                continue
-
-            success_count += 1
-            # data = np.load(filepath)
-            with gzip.open(filepath, 'rb') as gzf:
-                with np.load(gzf) as data:
-                    if not os.path.exists(temp_image_path):
-                        print('path doesnt exist', temp_image_path)
-                        # load from orthanc ...
-
-                    dicom_series = load_dicom_series(temp_image_path)
-
-                    # iterative naming
-                    # get all SEG series with same parent
-                    # find next avail name
-                    seg_name = f'pred_{selected_model}'
-                    parent_study_uid = None
-                    print(dicom_series_obj)
-                    try:
-                        seg_name += f'_{dicom_series_obj.description}'
-                        parent_study_uid = dicom_series_obj.parent_study.uid
-                        assert (parent_study_uid is not None)
-                    except Exception as e:
-                        print('Something went wrong with dcm loading:', e)
-                        pass
-
-                    print(seg_name, '| before')
-
-                    seg_name = get_next_available_iterative_name_for_series(seg_name, parent_study_uid)
-                    print(seg_name, '| after')
-
-                    seg_save_dir = convert_3d_numpy_array_to_dicom_seg(
-                        dicom_series,
-                        data['data'],
-                        data['rois'],
-                        os.path.join(temp_seg_path, f'{f.split(".")[0]}.dcm'),
-                        slice_axis=2,
-                        seg_series_description=seg_name
-                    )
-                    if seg_save_dir is None:
-                        raise Exception('Something went wrong with saving SEG')
-
-                    # Upload to orthanc
-                    uploadSegFile(seg_save_dir, remove_original=True)
-
-                    print('Removing', filepath, '...')
-                    os.remove(filepath)
+            if filepath.endswith(PREDICTION_SUFFIXES):
+                prediction_files.append(f)
+    success_count = len(prediction_files)
+
+    if success_count > 0:
+        if not os.path.exists(temp_image_path):
+            print('path doesnt exist', temp_image_path)
+            # load from orthanc ...
+
+        # parsed once per series, not once per prediction output
+        dicom_series = get_volume_cache().get_datasets(dicom_series_obj.uid, temp_image_path)
+
+        # iterative naming
+        # get all SEG series with same parent
+        # find next avail names, reserved so that outputs converted in parallel never get the same one
+        seg_name = f'pred_{selected_model}'
+        parent_study_uid = None
+        print(dicom_series_obj)
+        try:
+            seg_name += f'_{dicom_series_obj.description}'
+            parent_study_uid = dicom_series_obj.parent_study.uid
+            assert (parent_study_uid is not None)
+        except Exception as e:
+            print('Something went wrong with dcm loading:', e)
+            pass
+
+        print(seg_name, '| before')
+        seg_names = reserve_iterative_names_for_series(seg_name, parent_study_uid, len(prediction_files))
+        print(seg_names, '| after')
+
+        try:
+            export_predictions_to_seg(
+                dicom_series,
+                [os.path.join(dcm_prediction_dir, f) for f in prediction_files],
+                # the whole file name, so that e.g. out.npz and out.qdpred do not write to the same SEG
+                [os.path.join(temp_seg_path, f'{f}.dcm') for f in prediction_files],
+                seg_names,
+                # Upload to orthanc
+                upload=lambda seg: uploadSegFile(seg, remove_original=True),
+                progress_callback=make_progressbar_callback(85, 95)
+            )
+        finally:
+            release_iterative_names(parent_study_uid, seg_names)
 
     # shutil.rmtree(temp_images_path)
     # shutil.rmtree(temp_seg_path)
@@ -640,6 +664,7 @@ def test_iter():
 
 def run_pred_helper(instance, selected_model, study_id, dicom_series_id, stop_instance_at_end=True): # TODO: should take series study patient id
     emit_toast_on_fail = True
+    cached_series = None
     try:
         print('instance not none')
         set_tracked_model_instance_running(selected_model, True)
@@ -650,10 +675,15 @@ def run_pred_helper(instance, selected_model, study_id, dicom_series_id, stop_in
 
         timestamp = datetime.now().strftime('%Y_%m_%d_%H_%M_%S_%f')
         pred_cache_dir = f'prediction/{timestamp}'
-        series_obj = []
-        cached_dicom_series_path, temp_images_path = get_dicom_series_from_orthanc_to_cache(dicom_series_id, cache_subdir=pred_cache_dir, series_obj_out=series_obj, extract_zip=False)
-        series_obj = series_obj[0]
-        print(cached_dicom_series_path, temp_images_path)
+        # the images come from the shared series cache and stay there; only the zip for the Compute instance is per prediction
+        cached_series = get_series_cache().checkout(dicom_series_id, progress_callback=make_progressbar_callback(25, 35))
+        series_obj = cached_series.series
+        temp_images_path = os.path.join(pred_cache_dir, dicom_series_id)
+        if (cache_dir := os.environ.get('CACHE_DIRECTORY')) is not None:
+            temp_images_path = os.path.abspath(os.path.join(cache_dir, temp_images_path))
+        os.makedirs(temp_images_path, exist_ok=True)
+        cached_dicom_series_zip_path = write_series_zip(cached_series.files(), os.path.join(temp_images_path, 'series.zip'))
+        print(cached_series.path, cached_dicom_series_zip_path)
 
         emit_update_progressbar(35)
         emit_status_update('Running predictions...')
@@ -662,7 +692,7 @@ def run_pred_helper(instance, selected_model, study_id, dicom_series_id, stop_in
             _ZONE,
             _SERVICE_ACCOUNT_EMAIL,
             _KEY_FILE,
-            cached_dicom_series_path,
+            cached_dicom_series_zip_path,
             dicom_series_id,
             instance.name,
             progress_bar_update_callback=emit_update_progressbar,
@@ -681,7 +711,7 @@ def run_pred_helper(instance, selected_model, study_id, dicom_series_id, stop_in
         emit_status_update('Converting to SEG...')
         emit_toast('Saving your predictions. Almost done, please wait...')
         print(dcm_pred_dir)
-        convert_cached_pred_result_to_seg(series_obj, dcm_pred_dir, cached_dicom_series_path, temp_images_path, selected_model)
+        convert_cached_pred_result_to_seg(series_obj, dcm_pred_dir, cached_series.path, temp_images_path, selected_model)
 
         # TODO: maybe delete instance here? it gets paused anyway so not sure if needed
         set_tracked_model_instance_running(selected_model, False)
@@ -725,53 +755,56 @@ def run_pred_helper(instance, selected_model, study_id, dicom_series_id, stop_in
         remove_instance_metadata(_PROJECT_ID, _ZONE, get_instance(_PROJECT_ID, _ZONE, instance.name), ['dicom-image', 'model-displayname'], add_idling=True)
         # set_
         return False
+    finally:
+        if cached_series is not None:
+            get_series_cache().release(cached_series)
 
 def setup_compute_and_run_pred_helper(
         selected_model: str, start_compute: bool, dicom_series_id: str,
         study_id: str, stop_instance_at_end: bool = True):
-    global PREDICTION_LOCK
+    global _ZONE
+    global _CURRENT_BACKUP_ZONE_INDEX
 
-    try:
-        instance = setup_compute_with_model_helper(selected_model, start_compute=start_compute, dicom_series_id=dicom_series_id)
-        if instance is None:
-            PREDICTION_LOCK = 0
-            del MODELS_BEING_SET_UP[selected_model]
-            emit_toast('Error: Google Cloud is at its limit, please wait.', type='error')
+    with PREDICTION_SETUP_LOCK:
+        _ZONE = _BASE_ZONE
+        _CURRENT_BACKUP_ZONE_INDEX = -1
+        try:
+            instance = setup_compute_with_model_helper(selected_model, start_compute=start_compute, dicom_series_id=dicom_series_id)
+            if instance is None:
+                MODELS_BEING_SET_UP.pop(selected_model, None)
+                emit_toast('Error: Google Cloud is at its limit, please wait.', type='error')
+                return False
+        except Exception as e:
+            print(e)
+            print(traceback.format_exc())
+            # return jsonify({ 'message': 'Issue creating Compute instance. Google Cloud Services likely experiencing temporary resource shortage. Please try again later.' }), 500
+            MODELS_BEING_SET_UP.pop(selected_model, None)
+            emit_toast('Issue creating Compute instance. Google Cloud Services likely experiencing temporary resource shortage. Please try again later.', type='error')
             return False
-    except Exception as e:
-        print(e)
-        print(traceback.format_exc())
-        # return jsonify({ 'message': 'Issue creating Compute instance. Google Cloud Services likely experiencing temporary resource shortage. Please try again later.' }), 500
-        PREDICTION_LOCK = 0
-        del MODELS_BEING_SET_UP[selected_model]
-        emit_toast('Issue creating Compute instance. Google Cloud Services likely experiencing temporary resource shortage. Please try again later.', type='error')
-        return False
 
-    # thread = threading.Thread(target=run_pred_helper, args=(instance, selected_model, study_id, series_id), kwargs={'stop_instance_at_end': True})
-    # thread.start()
-    PREDICTION_LOCK = 0 # unlock here because in theory you could run multiple predictions at once on different instances
+    # the setup lock is released here because in theory you could run multiple predictions at once on different instances
     try:
-        del MODELS_BEING_SET_UP[selected_model]
-        run_pred_helper(instance, selected_model, study_id, dicom_series_id, stop_instance_at_end=stop_instance_at_end)
+        MODELS_BEING_SET_UP.pop(selected_model, None)
+        return run_pred_helper(instance, selected_model, study_id, dicom_series_id, stop_instance_at_end=stop_instance_at_end)
     except Exception as e:
         print(e)
         emit_toast('Something went wrong while running predictions.', type='error')
         return False
 
-    # emit_toast('Prediction successful.')
-    # return jsonify({ 'message': 'Prediction job successfully started' }), 202
-    return True
+def prediction_job(selected_model: str, series_id: str, study_id: str):
+    '''Job queue handler for /run'''
+    if not setup_compute_and_run_pred_helper(selected_model, True, series_id, study_id, stop_instance_at_end=False):
+        raise Exception(f'Prediction with {selected_model} on {series_id} failed')
+
+    return { 'message': 'Prediction done' }
 
 @bp.route("/run", methods=["POST"])
 def run_prediction():
-    global _ZONE
-    global _CURRENT_BACKUP_ZONE_INDEX
-    global PREDICTION_LOCK
     """
-    Run the prediction on the Google Cloud instance.
+    Queue a prediction job on the Google Cloud instance.
 
     Returns:
-        response: JSON response with status of the prediction process.
+        response: JSON response with the ID of the queued prediction job.
     """
 
     # if MODELS_BEING_SET_UP.get('find-organ-alpha') is None:
@@ -782,18 +815,10 @@ def run_prediction():
     # emit_update_model_list()
     # return jsonify({'message': 'hello world'}), 200
 
-    if PREDICTION_LOCK != 0:
-        return jsonify({ 'message': 'Currently setting up another prediction job. Please wait.' }), 429
-
-    _ZONE = _BASE_ZONE
-    _CURRENT_BACKUP_ZONE_INDEX = -1
-    PREDICTION_LOCK = 1
-
     if request.is_json:
         json_data = request.get_json()
         print(json_data)
     else:
-        PREDICTION_LOCK = 0
         return jsonify({'message': 'Invalid Request'}), 400
 
     selected_model = json_data.get("selectedModel", None)
@@ -807,34 +832,33 @@ def run_prediction():
 
     if selected_model is None or series_id is None or study_id is None:
         print('Invalid params from frontend')
-        PREDICTION_LOCK = 0
         return jsonify({'message': 'Model or images not provided'}), 500
 
     series_modality = get_modality_of_series(series_id)
     if series_modality is None:
         print('Series', series_id, 'does not exist.')
-        PREDICTION_LOCK = 0
         return jsonify({ 'message': 'The DICOM image file you are trying to predict is invalid.' }), 400
 
     if series_modality != 'CT':
         print('Series', series_id, 'is not a valid image, it is a', series_modality)
-        PREDICTION_LOCK = 0
         return jsonify({ 'message': f'You are trying to predict on a {series_modality}, not an image series.'}), 400
 
-    if is_tracked_model_instance_running(selected_model):
-        PREDICTION_LOCK = 0
+    if MODELS_BEING_SET_UP.get(selected_model) or is_tracked_model_instance_running(selected_model):
         return jsonify({ 'message': "Error: Google Cloud is at its limit, please wait." }), 429
 
     if get_docker_image(_PROJECT_ID, _ZONE, _REPOSITORY, selected_model) is None:
-        PREDICTION_LOCK = 0
         return jsonify({ 'message': f'Model {selected_model} does not exist.' }), 400
 
     MODELS_BEING_SET_UP[selected_model] = 1
+    try:
+        job_id = JOBS.submit('prediction', { 'selected_model': selected_model, 'series_id': series_id, 'study_id': study_id })
+    except QueueFullError as e:
+        MODELS_BEING_SET_UP.pop(selected_model, None)
+        return jsonify({ 'message': str(e) }), 429
+
     emit_update_model_list()
     emit_update_progressbar(5)
-    thread = threading.Thread(target=setup_compute_and_run_pred_helper, args=(selected_model, True, series_id, study_id), kwargs={'stop_instance_at_end': False})
-    thread.start()
-    return jsonify({ 'message': 'Your prediction job is now running...' }), 202
+    return jsonify({ 'message': 'Your prediction job is now queued...', 'job_id': job_id }), 202
 
 # # This currently is not called by anything
 # @bp.route("/deleteModel", methods=["POST"])
@@ -867,38 +891,25 @@ def run_prediction():
 #     emit_status_update(message)
 #     return jsonify({"message": message}), status_code
 
-DISC_LOCK = 0
 def save_discrepancy_mask_helper(dicom_series_id, pred_series_id, truth_series_id):
-    global DISC_LOCK
     # Pull the images from Orthanc into cache
     # emit_status_update('Getting DICOM images...')
-    disc_path = 'discrepancy/'
+    # each job gets its own directory so that discrepancy jobs can run side by side
+    disc_path = os.path.join('discrepancy', current_job_id() or datetime.now().strftime('%Y_%m_%d_%H_%M_%S_%f'))
     if (cache_dir := os.environ.get('CACHE_DIRECTORY')) is not None:
         disc_path = os.path.abspath(os.path.join(cache_dir, disc_path))
 
-    cached_dicom_series_path, temp_images_path = get_dicom_series_from_orthanc_to_cache(dicom_series_id, cache_subdir='discrepancy/_images')
-    dicom_series = load_dicom_series(cached_dicom_series_path)
-    shutil.rmtree(temp_images_path)
-
-    pred_series_obj, truth_series_obj = [], []
-    pred_series, temp_pred_path = get_dicom_series_from_orthanc_to_cache(pred_series_id, cache_subdir=os.path.join(disc_path, '_pred/'), series_obj_out=pred_series_obj)
-    truth_series, temp_truth_path = get_dicom_series_from_orthanc_to_cache(truth_series_id, cache_subdir=os.path.join(disc_path, '_truth/'), series_obj_out=truth_series_obj)
-    pred_series_obj, truth_series_obj = pred_series_obj[0], truth_series_obj[0]
-
-    for dirpath, _, fnames in os.walk(pred_series):
-        print(fnames)
-        print(dirpath)
-        if len(fnames) == 1:
-            pred_series = os.path.abspath(os.path.join(dirpath, fnames[0]))
-    for dirpath, _, fnames in os.walk(truth_series):
-        print(fnames)
-        print(dirpath)
-        if len(fnames) == 1:
-            truth_series = os.path.abspath(os.path.join(dirpath, fnames[0]))
-
-    pred_mask, dcm_pred = seg_to_mask(pred_series, slice_thickness=1)
-    truth_mask, dcm_truth = seg_to_mask(truth_series, slice_thickness=1)
-    shutil.rmtree(disc_path)
+    series_cache = get_series_cache()
+    with series_cache.acquire(dicom_series_id) as cached_images:
+        dicom_series = get_volume_cache().get_datasets(dicom_series_id, cached_images.path)
+
+    # each SEG series holds a single instance
+    with series_cache.acquire(pred_series_id) as cached_pred:
+        pred_series_obj = cached_pred.series
+        pred_mask, dcm_pred = seg_to_mask(cached_pred.files()[0], slice_thickness=1)
+    with series_cache.acquire(truth_series_id) as cached_truth:
+        truth_series_obj = cached_truth.series
+        truth_mask, dcm_truth = seg_to_mask(cached_truth.files()[0], slice_thickness=1)
 
     temp_seg_path = os.path.join(disc_path, '_res/')
     os.makedirs(temp_seg_path, exist_ok=True)
@@ -920,47 +931,38 @@ def save_discrepancy_mask_helper(dicom_series_id, pred_series_id, truth_series_i
 
     try:
         out_name = get_non_intersection_mask_to_seg(dicom_series, pred_mask, truth_mask, dcm_pred, dcm_truth,
-                                                    os.path.join(temp_seg_path, f'discrepancy.dcm'),
+                                                    get_seg_output_path(os.path.join(temp_seg_path, f'discrepancy.dcm')),
                                                     output_desc=seg_name,
                                                     separate_fp_fn=False,
                                                     merge_all_rois=False)
     except Exception as e:
         print(e)
-        DISC_LOCK = 0
         emit_toast(f'Something went wrong: {str(e)}', type='error')
-        return
-        # return jsonify({ 'saved_mask': False, 'message': str(e) }), 500
+        shutil.rmtree(disc_path, ignore_errors=True)
+        raise
 
     if out_name is None:
         # print('something went wrong')
-        DISC_LOCK = 0
         emit_toast('There were no discrepancies between the two masks. Nothing was saved.', type='warning')
-        return
-        # return jsonify({ 'saved_mask': False, 'message': 'There were no discrepancies between the two masks.' }), 200
+        shutil.rmtree(disc_path, ignore_errors=True)
+        return { 'saved_mask': False, 'message': 'There were no discrepancies between the two masks.' }
 
     print('Uploading SEG')
     uploadSegFile(out_name, remove_original=False)
 
     print('Removing cached files')
-    shutil.rmtree(temp_seg_path)
+    shutil.rmtree(disc_path)
 
     print('Done')
-    DISC_LOCK = 0
     emit_toast('Successfully saved discrepancy mask. Please reload page to see changes.')
-    # return jsonify({ 'saved_mask': True, 'message': 'Succesfully saved    discrepancy mask.' }), 200
+    return { 'saved_mask': True, 'message': 'Succesfully saved discrepancy mask.' }
 
 @bp.route('/saveDiscrepancyMask', methods=['POST'])
 def save_discrepancy_mask():
-    global DISC_LOCK
-    if DISC_LOCK != 0:
-        return jsonify({ 'message': 'Currently calculating another discrepancy mask. Please wait.' }), 429
-
-    DISC_LOCK = 1
     if request.is_json:
         json_data = request.get_json()
     else:
         print('not json')
-        DISC_LOCK = 0
         return jsonify({ 'message': 'Malformed Request' }), 500
 
     dicom_series_id = json_data.get('parent_id')
@@ -968,27 +970,25 @@ def save_discrepancy_mask():
     truth_series_id = json_data.get('truthSeriesUid')
 
     if dicom_series_id is None or pred_series_id is None or truth_series_id is None:
-        DISC_LOCK = 0
         return jsonify({ 'message': 'Please select a prediction and truth mask.' }), 400
 
-    thread = threading.Thread(target=save_discrepancy_mask_helper, args=(dicom_series_id, pred_series_id, truth_series_id))
-    thread.start()
-    return jsonify({ 'message': 'Calculating discrepancy mask...' }), 202
+    try:
+        job_id = JOBS.submit('discrepancy', { 'dicom_series_id': dicom_series_id, 'pred_series_id': pred_series_id, 'truth_series_id': truth_series_id })
+    except QueueFullError as e:
+        return jsonify({ 'message': str(e) }), 429
 
-DICE_LOCK = 0
-@bp.route('/getDICEScores', methods=['POST'])
-def getDICEScores():
-    global DICE_LOCK
+    return jsonify({ 'message': 'Calculating discrepancy mask...', 'job_id': job_id }), 202
 
-    if DICE_LOCK != 0:
-        return jsonify({ 'message': 'Currently calculating another DICE score. Please wait.' }), 429
+def dice_job(parent_id: str, pred_series_id: str, truth_series_id: str, metrics=None, surface_tolerance=DEFAULT_SURFACE_TOLERANCE):
+    '''Job queue handler for /getDICEScores'''
+    return get_files_and_dice_score(parent_id, pred_series_id, truth_series_id, metrics=metrics, surface_tolerance=surface_tolerance)
 
-    DICE_LOCK = 1
+@bp.route('/getDICEScores', methods=['POST'])
+def getDICEScores():
     if request.is_json:
         json_data = request.get_json()
     else:
         print('not json')
-        DICE_LOCK = 0
         return jsonify({ 'message': 'Malformed request.' }), 400
 
     currentMaskDic = json_data.get('currentMask')
@@ -996,7 +996,6 @@ def getDICEScores():
 
     if currentMaskDic is None or groundTruthDic is None:
         print('wrong params')
-        DICE_LOCK = 0
         return jsonify({ 'message': 'Select both ground truth and another mask for DICE scores.' }), 400
 
     currentMaskDic = json.loads(currentMaskDic)
@@ -1012,19 +1011,69 @@ def getDICEScores():
     # truth_series_id = '1.2.826.0.1.3680043.8.498.65606104540766071416178016107620147411'
     if parent_id is None:
         print('wrong params')
-        DICE_LOCK = 0
         return jsonify({ 'message': 'Select both ground truth and another mask for DICE scores.' }), 400
 
+    # optional, e.g. "metrics": ["dice", "hd95", "surface_dice"], "surfaceTolerance": 2.0 (mm)
+    try:
+        metrics = validate_metrics(json_data.get('metrics'))
+        surface_tolerance = float(json_data.get('surfaceTolerance', DEFAULT_SURFACE_TOLERANCE))
+    except (TypeError, ValueError) as e:
+        return jsonify({ 'message': str(e) }), 400
+
+    # pairs that were scored before are answered straight from the metric cache
+    wait = json_data.get('wait', True)
+    if wait:
+        cached_scores = get_metric_cache().get_by_series(pred_series_id, truth_series_id,
+                                                         get_metric_config(parent_id, metrics, surface_tolerance))
+        if cached_scores is not None:
+            return jsonify(cached_scores), 200
+
     print('getting dice...')
     try:
-        score_dict = get_files_and_dice_score(parent_id,pred_series_id,truth_series_id)
-    except Exception as e:
-        print(e)
-        DICE_LOCK = 0
-        return jsonify({ 'message': 'Something went wrong with the DICE calulcation.' }), 500
+        job_id = JOBS.submit('dice', { 'parent_id': parent_id, 'pred_series_id': pred_series_id, 'truth_series_id': truth_series_id,
+                                       'metrics': metrics, 'surface_tolerance': surface_tolerance })
+    except QueueFullError as e:
+        return jsonify({ 'message': str(e) }), 429
+
+    # the panel waits for the scores by default; pass wait=false to poll /jobs/<id> instead
+    if not wait:
+        return jsonify({ 'message': 'Calculating DICE scores...', 'job_id': job_id }), 202
+
+    job = JOBS.wait(job_id)
+    if job['status'] != JobStatus.SUCCEEDED.value:
+        return jsonify({ 'message': 'Something went wrong with the DICE calulcation.', 'job_id': job_id }), 500
+
+    response = jsonify(job['result'])
+    response.headers['X-Job-Id'] = job_id
+    return response, 200
 
-    DICE_LOCK = 0
-    return jsonify(score_dict), 200
+@bp.route('/metrics/orthanc', methods=['GET'])
+def orthanc_metrics():
+    return jsonify(get_orthanc_metrics()), 200
+
+@bp.route('/metrics/series_cache', methods=['GET'])
+def series_cache_metrics():
+    return jsonify(get_series_cache().stats()), 200
+
+@bp.route('/metrics/volume_cache', methods=['GET'])
+def volume_cache_metrics():
+    return jsonify(get_volume_cache().stats()), 200
+
+@bp.route('/metrics/mask_cache', methods=['GET'])
+def mask_cache_metrics():
+    return jsonify(get_mask_cache().stats()), 200
+
+@bp.route('/metrics/metric_cache', methods=['GET'])
+def metric_cache_metrics():
+    return jsonify(get_metric_cache().stats()), 200
+
+@bp.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = JOBS.get(job_id)
+    if job is None:
+        return jsonify({ 'message': f'No job found with ID {job_id}' }), 404
+
+    return jsonify(job), 200
 
 
 # @bp.route('/getGroundTruthSeries', methods=['POST'])
@@ -1075,31 +1124,117 @@ def convert_rt_struct_to_seg():
         print('id is none cannot select rtstruct')
         return jsonify({ 'message': 'Please select a model' }), 400
 
+    try:
+        job_id = JOBS.submit('rtstruct', { 'patient_id': patient_id, 'study_id': study_id })
+    except QueueFullError as e:
+        return jsonify({ 'message': str(e) }), 429
+
+    return jsonify({ 'message': 'Converting RTSTRUCT to SEG...', 'job_id': job_id }), 202
+
+def convert_rt_struct_to_seg_job(patient_id: str, study_id: str):
+    '''Job queue handler for /convert_rt_struct_to_seg'''
     rt_struct_dicom_path_dict = getRTStructWithoutDICEDict(patient_id,study_id)
     dicom_series_path = rt_struct_dicom_path_dict["DICOM_series_path"]
     rt_struct_path = rt_struct_dicom_path_dict["RT_struct_path"]
 
     if not dicom_series_path or not rt_struct_path:
-        return jsonify({"error": "Please provide both dicom_series_path and rt_struct_path"}), 400
+        raise Exception("Please provide both dicom_series_path and rt_struct_path")
 
-    seg_filename = "output_seg.dcm"  # Temporary filename for the converted SEG file
+    seg_filename = f"output_seg_{current_job_id()}.dcm"  # Temporary filename for the converted SEG file
     result = process_conversion(dicom_series_path, rt_struct_path, seg_filename)
     if not result: #dont have to worry about saving files into orthanc, default ohif functionality
         print('Conversion process failed')
-        return jsonify({'message': 'Conversion failed'}), 500
+        raise Exception('Conversion failed')
+
+    return { 'seg_filename': result }
+
+def cohort_job(items=None, study_filter=None, metrics=None, surface_tolerance=DEFAULT_SURFACE_TOLERANCE):
+    '''Job queue handler for /evaluateCohort'''
+    job_id = current_job_id()
+    if study_filter is not None:
+        items = (items or []) + find_cohort_series(study_filter.get('query'),
+                                                   study_filter['predDescription'],
+                                                   study_filter['truthDescription'],
+                                                   image_modality=study_filter.get('imageModality', 'CT'))
+    if not items:
+        raise Exception('No series to evaluate.')
+
+    def on_result(index, completed, total, result):
+        socketio.emit('cohort_evaluation_update', { 'job_id': job_id, 'index': index, 'completed': completed, 'total': total, 'result': result })
+
+    print('Evaluating cohort of', len(items), 'series')
+    return evaluate_cohort(items, metrics=metrics, surface_tolerance=surface_tolerance, on_result=on_result)
+
+@bp.route('/evaluateCohort', methods=['POST'])
+def evaluate_cohort_endpoint():
+    '''
+    Body: { "items": [{ "parent_id", "pred_series_id", "truth_series_id" }, ...] } and/or
+          { "studyFilter": { "query": { Orthanc study query }, "predDescription": "pred_*", "truthDescription": "truth*" } },
+          plus the optional "metrics" and "surfaceTolerance" of /getDICEScores.
+    Per-item results are emitted as cohort_evaluation_update while the job runs; poll /jobs/<job_id> for the summary.
+    '''
+    if not request.is_json:
+        return jsonify({ 'message': 'Malformed request.' }), 400
+    json_data = request.get_json()
+
+    items = json_data.get('items')
+    study_filter = json_data.get('studyFilter')
+    if items is None and study_filter is None:
+        return jsonify({ 'message': 'Provide items or a studyFilter.' }), 400
+    if items is not None and (not isinstance(items, list) or
+                              any(not isinstance(item, dict) or not all(item.get(k) for k in ('parent_id', 'pred_series_id', 'truth_series_id')) for item in items)):
+        return jsonify({ 'message': 'Every item needs a parent_id, pred_series_id and truth_series_id.' }), 400
+    if study_filter is not None and (not isinstance(study_filter, dict) or
+                                     not study_filter.get('predDescription') or not study_filter.get('truthDescription')):
+        return jsonify({ 'message': 'studyFilter needs a predDescription and a truthDescription.' }), 400
 
+    try:
+        metrics = validate_metrics(json_data.get('metrics'))
+        surface_tolerance = float(json_data.get('surfaceTolerance', DEFAULT_SURFACE_TOLERANCE))
+    except (TypeError, ValueError) as e:
+        return jsonify({ 'message': str(e) }), 400
 
+    try:
+        job_id = JOBS.submit('cohort', { 'items': items, 'study_filter': study_filter, 'metrics': metrics, 'surface_tolerance': surface_tolerance })
+    except QueueFullError as e:
+        return jsonify({ 'message': str(e) }), 429
+
+    return jsonify({ 'message': 'Evaluating cohort...', 'job_id': job_id }), 202
+
+## Startup
+# Everything the broker does once when it starts (job workers and recovered jobs, clearing leftover Compute Engine
+# instances and the cache, registering the routes) happens in start_broker, which only the real entry points call:
+# gunicorn importing app, and python app.py. Processes of the cohort scoring pool re-import the main script as
+# __mp_main__ when the broker is started with python app.py, and must not do any of it.
+
+def recover_jobs():
+    '''Re-queues the jobs of the last run, once stale instances and cached files have been cleared'''
+    # as /run does, so the model shows as busy until its instance is set up. Prediction workers only clear the flag
+    # after taking the setup lock, so a recovered job cannot clear it before it is set here
+    with PREDICTION_SETUP_LOCK:
+        for kind, params in JOBS.recover():
+            if kind == 'prediction':
+                MODELS_BEING_SET_UP[params['selected_model']] = 1
+
+def start_broker(development=False):
+    JOBS.register('prediction', prediction_job, workers=get_configured_int('JOB_WORKERS_PREDICTION', _INSTANCE_LIMIT))
+    JOBS.register('dice', dice_job)
+    JOBS.register('discrepancy', save_discrepancy_mask_helper)
+    JOBS.register('rtstruct', convert_rt_struct_to_seg_job)
+    JOBS.register('cohort', cohort_job)
+
+    # This setup is intended to prefix all routes to /api/{...} when running in development mode,
+    # since in production, there is a reverse proxy that serves these routes at /api
+    # NOTE: this should never really be run unless manually testing only the flask side
+    if development:
+        print('Running through main, prefixing routes with /api')
+        app.register_blueprint(bp, url_prefix='/api')
+        clear_unused_instances()
+        recover_jobs()
+        # app.run(host='localhost', port=5421)
+        # socketio.run(app, host='localhost', port=5421, debug=True)
+        return
 
-# This setup is intended to prefix all routes to /api/{...} when running in development mode,
-# since in production, there is a reverse proxy that serves these routes at /api
-# NOTE: this should never really be run unless manually testing only the flask side
-if __name__ == "__main__":
-    print('Running through main, prefixing routes with /api')
-    app.register_blueprint(bp, url_prefix='/api')
-    clear_unused_instances()
-    # app.run(host='localhost', port=5421)
-    # socketio.run(app, host='localhost', port=5421, debug=True)
-else:
     print('Not running through main, no prefixes for routes')
     if not _NO_GOOGLE_CLOUD:
         clear_unused_instances()
@@ -1113,7 +1248,13 @@ else:
         print(e)
         print('The above exception occurred while trying to clear the cache in', cache_dir)
 
+    recover_jobs()
     app.register_blueprint(bp)
     # socketio.init_app(app)
     # print(socketio.)
-    # socketio.run(app, debug=True)
\ No newline at end of file
+    # socketio.run(app, debug=True)
+
+if __name__ == "__main__":
+    start_broker(development=True)
+elif __name__ != '__mp_main__':
+    start_broker()
@@ -0,0 +1,103 @@
+## Cohort evaluation
+# Scores many (image, prediction, truth) series triples in one job, e.g. to validate a model over 100+ studies.
+# Series are fetched by COHORT_WORKERS threads (through the series cache) while the scoring itself runs in a
+# process pool of COHORT_SCORING_PROCESSES processes (0 scores in the fetching threads instead).
+# Each result is passed to on_result as soon as it is ready; the job returns every result with a per-label summary.
+
+import os
+import multiprocessing
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import numpy as np
+from orthanc_get import get_files_and_dice_score
+from seg_mask_dice import DEFAULT_SURFACE_TOLERANCE
+
+_DEFAULT_WORKERS = 2
+_COUNT_KEYS = ('label', 'tp', 'fp', 'fn')
+
+def _get_int_env(name: str, default: int):
+    try:
+        return max(0, int(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+def get_cohort_workers():
+    return max(1, _get_int_env('COHORT_WORKERS', _DEFAULT_WORKERS))
+
+def get_cohort_scoring_processes():
+    return _get_int_env('COHORT_SCORING_PROCESSES', get_cohort_workers())
+
+def normalize_scores(scores):
+    '''RTSTRUCT scores come back as {label: dice}; SEG scores as [{'label', 'value', ...}]'''
+    if isinstance(scores, dict):
+        return [{ 'label': label, 'value': float(value) } for label, value in scores.items()]
+    return scores or []
+
+def summarize_cohort(results):
+    '''Returns {label: {metric: {count, mean, median, std, min, max}}} over every scored item'''
+    values = {}
+    for result in results:
+        for score in result.get('scores', []):
+            label_values = values.setdefault(score['label'], {})
+            for metric, value in score.items():
+                if metric in _COUNT_KEYS or value is None:
+                    continue
+                metric = 'dice' if metric == 'value' else metric
+                label_values.setdefault(metric, []).append(float(value))
+
+    summary = {}
+    for label, metrics in values.items():
+        summary[label] = {}
+        for metric, metric_values in metrics.items():
+            metric_values = np.array(metric_values)
+            metric_values = metric_values[np.isfinite(metric_values)]
+            if metric_values.size == 0:
+                continue
+            summary[label][metric] = {
+                'count': int(metric_values.size),
+                'mean': float(metric_values.mean()),
+                'median': float(np.median(metric_values)),
+                'std': float(metric_values.std()),
+                'min': float(metric_values.min()),
+                'max': float(metric_values.max()),
+            }
+    return summary
+
+def _score_item(item, metrics, surface_tolerance, executor):
+    scores = get_files_and_dice_score(item['parent_id'], item['pred_series_id'], item['truth_series_id'],
+                                      metrics=metrics, surface_tolerance=surface_tolerance, executor=executor)
+    return normalize_scores(scores)
+
+def evaluate_cohort(items, metrics=None, surface_tolerance=DEFAULT_SURFACE_TOLERANCE, on_result=None):
+    '''
+    items is a list of {'parent_id', 'pred_series_id', 'truth_series_id'} dicts (extra keys are passed through).
+    Returns {'results': [...], 'summary': {...}} with results in the order of items.
+    '''
+    results = [None] * len(items)
+    workers = min(get_cohort_workers(), max(1, len(items)))
+    scoring_processes = min(get_cohort_scoring_processes(), workers)
+
+    # spawn, so the scoring processes do not inherit the broker's threads and sockets
+    scoring_pool = ProcessPoolExecutor(max_workers=scoring_processes, mp_context=multiprocessing.get_context('spawn')) \
+        if scoring_processes > 0 else None
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as fetch_pool:
+            futures = {fetch_pool.submit(_score_item, item, metrics, surface_tolerance, scoring_pool): i for i, item in enumerate(items)}
+            for completed, future in enumerate(as_completed(futures)):
+                index = futures[future]
+                result = dict(items[index])
+                try:
+                    result['scores'] = future.result()
+                except Exception as e:
+                    print(traceback.format_exc())
+                    result['scores'] = []
+                    result['error'] = str(e)
+                results[index] = result
+
+                if on_result is not None:
+                    on_result(index, completed + 1, len(items), result)
+    finally:
+        if scoring_pool is not None:
+            scoring_pool.shutdown(wait=True)
+
+    return { 'results': results, 'summary': summarize_cohort(results) }
@@ -2,9 +2,17 @@ from google.cloud import artifactregistry
 from gcloud_auth import get_credentials, get_registry_client
 from google.api_core.exceptions import NotFound
 import subprocess
+import os
+import threading
+import time
 
 _MAX_TIMEOUT_NORMAL_REQUEST = 90
 _MAX_TIMEOUT_COMPUTE_REQUEST = 640
+_DEFAULT_MODEL_CATALOG_TTL = 60 # seconds
+
+# Cached package listings per repository: parent path -> (monotonic time listed, stamp when listed, packages)
+_MODEL_CATALOG = {}
+_MODEL_CATALOG_LOCK = threading.Lock()
 
 def get_region_name(zone: str):
     return '-'.join(zone.split('-')[:-1])
@@ -22,6 +30,63 @@ def list_docker_images(project_id: str, zone: str, models_repo: str, specific_ta
         response = get_registry_client().list_packages(request)
         return list(response)
 
+def get_model_catalog_ttl() -> float:
+    try:
+        return float(os.environ.get('MODEL_CATALOG_TTL', _DEFAULT_MODEL_CATALOG_TTL))
+    except ValueError:
+        return _DEFAULT_MODEL_CATALOG_TTL
+
+## Model catalog
+# The broker caches the package listing of the repository for MODEL_CATALOG_TTL seconds. Models are uploaded by the
+# upload_model.py CLI, which is a separate process (usually on the host, while the broker runs in its container), so
+# clearing the cache in memory does not reach the broker. Uploads and deletes also rewrite a stamp file, and a listing
+# is reused only while the stamp is the same as when it was listed.
+# The stamp is kept next to this module, since the broker container bind mounts src from the host.
+# Set MODEL_CATALOG_STAMP to keep it elsewhere, at a path that both the CLI and the broker can reach.
+
+def get_model_catalog_stamp_path() -> str:
+    return os.environ.get('MODEL_CATALOG_STAMP') or os.path.join(os.path.dirname(os.path.realpath(__file__)), '.model_catalog_stamp')
+
+def _get_model_catalog_stamp():
+    try:
+        with open(get_model_catalog_stamp_path()) as f:
+            return f.read()
+    except OSError:
+        return None
+
+def list_model_catalog(project_id: str, zone: str, models_repo: str, max_age: float = None):
+    '''
+    Lists all packages (models) in the repository, reusing the last listing if it is younger than
+    max_age (defaults to MODEL_CATALOG_TTL) and no process invalidated the catalog since.
+    '''
+    if max_age is None:
+        max_age = get_model_catalog_ttl()
+
+    parent = f'projects/{project_id}/locations/{get_region_name(zone)}/repositories/{models_repo}'
+    stamp = _get_model_catalog_stamp()
+    with _MODEL_CATALOG_LOCK:
+        cached = _MODEL_CATALOG.get(parent)
+        if cached is not None and time.monotonic() - cached[0] <= max_age and cached[1] == stamp:
+            return cached[2]
+
+        packages = list_docker_images(project_id, zone, models_repo, specific_tags=False)
+        _MODEL_CATALOG[parent] = (time.monotonic(), stamp, packages)
+        return packages
+
+def invalidate_model_catalog():
+    '''Makes every process list the repository again on its next list_model_catalog'''
+    with _MODEL_CATALOG_LOCK:
+        _MODEL_CATALOG.clear()
+
+    stamp_path = get_model_catalog_stamp_path()
+    try:
+        # a new value rather than a new mtime, which may not change between two touches on coarse file systems
+        with open(stamp_path, 'w') as f:
+            f.write(f'{time.time_ns()} {os.getpid()}')
+    except OSError as e:
+        print(f'Could not write the model catalog stamp {stamp_path}: {e}')
+        print(f'The broker will list the new models within MODEL_CATALOG_TTL ({get_model_catalog_ttl()}s)')
+
 def get_docker_image(project_id: str, zone: str, models_repo: str, image_name: str):
     # request = artifactregistry.GetDockerImageRequest()
     request = artifactregistry.GetPackageRequest(name=f'projects/{project_id}/locations/{get_region_name(zone)}/repositories/{models_repo}/packages/{image_name}')
@@ -38,7 +103,9 @@ def delete_docker_image(project_id: str, zone: str, models_repo: str, image_name
     request = artifactregistry.DeletePackageRequest(name=f'projects/{project_id}/locations/{get_region_name(zone)}/repositories/{models_repo}/packages/{image_name}')
     try:
         response = get_registry_client().delete_package(request)
-        return response.result(timeout=_MAX_TIMEOUT_COMPUTE_REQUEST)
+        result = response.result(timeout=_MAX_TIMEOUT_COMPUTE_REQUEST)
+        invalidate_model_catalog()
+        return result
     except Exception as e:
         print('Could not get docker image of name', image_name)
         print(e)
@@ -100,6 +167,7 @@ def upload_docker_image_to_artifact_registry_helper(project_id: str, zone: str,
     if LOG:
         print('running push')
     subprocess.run(['docker', 'push', docker_tag])
+    invalidate_model_catalog()
 
     if LOG:
         print('Logging out')
@@ -10,6 +10,7 @@ from typing import List, Union
 import json
 from google.api_core.datetime_helpers import DatetimeWithNanoseconds
 from orthanc_functions import get_dicom_series_by_id
+from instance_registry import invalidate_instance_index
 
 # _USERNAME = os.environ.get('USER')
 _USERNAME = 'cmsc435'
@@ -49,25 +50,31 @@ def list_instances(project_id, zone):
         print(e)
         return None
 
+# Any operation that changes an instance invalidates the cached instance index once it is done
+def wait_for_instance_operation(project_id, zone, response, block=True):
+    invalidate_instance_index(project_id, zone)
+    response.add_done_callback(lambda _: invalidate_instance_index(project_id, zone))
+    return response.result(timeout=_MAX_TIMEOUT_COMPUTE_REQUEST) if block else response
+
 def start_instance(project_id, zone, instance_name, block=True):
     request = compute_v1.StartInstanceRequest(project=project_id, zone=zone, instance=instance_name)
     response = get_compute_client().start(request)
-    return response.result(timeout=_MAX_TIMEOUT_COMPUTE_REQUEST) if block else response
+    return wait_for_instance_operation(project_id, zone, response, block=block)
 
 def stop_instance(project_id, zone, instance_name, block=True):
     request = compute_v1.StopInstanceRequest(discard_local_ssd=False, project=project_id, zone=zone, instance=instance_name)
     response = get_compute_client().stop(request)
-    return response.result(timeout=_MAX_TIMEOUT_COMPUTE_REQUEST) if block else response
+    return wait_for_instance_operation(project_id, zone, response, block=block)
 
 def resume_instance(project_id, zone, instance_name, block=True):
     request = compute_v1.ResumeInstanceRequest(project=project_id, zone=zone, instance=instance_name)
     response = get_compute_client().resume(request)
-    return response.result(timeout=_MAX_TIMEOUT_COMPUTE_REQUEST) if block else response
+    return wait_for_instance_operation(project_id, zone, response, block=block)
 
 def suspend_instance(project_id, zone, instance_name, block=True):
     request = compute_v1.SuspendInstanceRequest(discard_local_ssd=False, project=project_id, zone=zone, instance=instance_name)
     response = get_compute_client().suspend(request)
-    return response.result(timeout=_MAX_TIMEOUT_COMPUTE_REQUEST) if block else response
+    return wait_for_instance_operation(project_id, zone, response, block=block)
 
 def get_instance(project_id, zone, instance_name):
     request = compute_v1.GetInstanceRequest(instance=instance_name, project=project_id, zone=zone)
@@ -85,7 +92,7 @@ def delete_instance(project_id, zone, instance_name):
     print('Deleting instance:', instance_name)
     request = compute_v1.DeleteInstanceRequest(project=project_id, zone=zone, instance=instance_name)
     response = get_compute_client().delete(request)
-    return response.result(timeout=_MAX_TIMEOUT_COMPUTE_REQUEST)
+    return wait_for_instance_operation(project_id, zone, response)
 
 class IPType(Enum):
     INTERNAL = "internal"
@@ -154,7 +161,7 @@ def create_instance_helper(
     request = compute_v1.InsertInstanceRequest(instance_resource=instance, project=project_id, zone=zone)
     response = get_compute_client().insert(request)
     print('Sent create instance request')
-    return response.result(timeout=_MAX_TIMEOUT_COMPUTE_REQUEST)
+    return wait_for_instance_operation(project_id, zone, response)
 
 ## NOTE: should probably change this name. This is only a helper function. Use setup_compute_instance() instead
 def create_new_instance(instance_name, project_id, zone, machine_type, instance_limit, service_account_email):
@@ -218,6 +225,7 @@ def setup_instance_metadata(project_id: str, zone: str, models_repo: str, image_
     # print(metadata)
     first_metadata_request = get_compute_client().set_metadata(request)
     first_metadata_request.add_done_callback(lambda _: print('Done setting up startup script'))
+    first_metadata_request.add_done_callback(lambda _: invalidate_instance_index(project_id, zone))
     # startup_script_metadata = compute_v1.Items(key='startup-script', value=setup_script)
     # startup_metadata = compute_v1.Metadata(items=[startup_script_metadata], fingerprint=instance.metadata.fingerprint)
     # startup_request = compute_v1.SetMetadataInstanceRequest(instance=instance.name, metadata_resource=startup_metadata, project=_PROJECT_ID, zone=_ZONE)
@@ -235,6 +243,7 @@ def remove_instance_metadata(project_id: str, zone: str, instance: compute_v1.In
     request = compute_v1.SetMetadataInstanceRequest(instance=instance.name, metadata_resource=metadata, project=project_id, zone=zone)
 
     get_compute_client().set_metadata(request).result(timeout=_MAX_TIMEOUT_NORMAL_REQUEST)
+    invalidate_instance_index(project_id, zone)
 
 def upload_dicom_to_instance(project_id: str, zone: str, service_account: str, key_filepath: str, dicom_image_directory: str, dicom_series_id: str, instance_name: str, run_auth=True) -> bool:
     if run_auth:
@@ -319,7 +328,7 @@ def upload_dicom_to_instance(project_id: str, zone: str, service_account: str, k
 
     return True
 
-def get_dicom_series_from_orthanc_to_cache(dicom_series_id: str, cache_subdir='dcm-images/', series_obj_out=[], extract_zip=True):
+def get_dicom_series_from_orthanc_to_cache(dicom_series_id: str, cache_subdir='dcm-images/', series_obj_out=[], extract_zip=True, keep_zip=False, progress_callback=None):
     if (cache_dir := os.environ.get('CACHE_DIRECTORY')) is not None:
         cache_subdir = os.path.abspath(os.path.join(cache_dir, cache_subdir))
     temp_images_path = os.path.join(cache_subdir, dicom_series_id)
@@ -327,7 +336,7 @@ def get_dicom_series_from_orthanc_to_cache(dicom_series_id: str, cache_subdir='d
 
     # TODO: sometimes there is an out of memory issues and it SIGKILLS the flask process.
     # only happened one time and cannot reproduce
-    dicom_series_path = get_dicom_series_by_id(dicom_series_id, temp_images_path, series_obj_out=series_obj_out, extract_zip=extract_zip)
+    dicom_series_path = get_dicom_series_by_id(dicom_series_id, temp_images_path, series_obj_out=series_obj_out, extract_zip=extract_zip, keep_zip=keep_zip, progress_callback=progress_callback)
     # dicom_series_path = get_first_dicom_image_series_from_study(patient_id, study_id, temp_images_path)
     print(dicom_series_path)
     return dicom_series_path, temp_images_path
@@ -385,6 +394,7 @@ def run_predictions(project_id: str, zone: str, service_account: str, key_filepa
                             f'--project={project_id}',
                             f'--zone={zone}',
                             f'--metadata=dicom-image={dicom_series_id},username={username}'], check=True)
+            invalidate_instance_index(project_id, zone)
 
             # Copy over DICOM images from server to instance
             if progress_bar_update_callback is not None:
@@ -478,6 +488,7 @@ def run_predictions(project_id: str, zone: str, service_account: str, key_filepa
                         f'--project={project_id}',
                         f'--zone={zone}',
                         f'--metadata=idling=True'], check=True)
+        invalidate_instance_index(project_id, zone)
 
         if stop_instance_at_end:
             print('Stopping Instance')
@@ -501,6 +512,7 @@ def run_predictions(project_id: str, zone: str, service_account: str, key_filepa
                         f'--project={project_id}',
                         f'--zone={zone}',
                         f'--metadata=idling=True'], check=True)
+        invalidate_instance_index(project_id, zone)
         return None
 
     dcm_prediction_dir = os.path.join(dcm_prediction_dir, dicom_series_id)
@@ -2,10 +2,10 @@ import pyorthanc
 import zipfile
 import os
 import shutil
+from orthanc_client import get_orthanc_client
 
 def getRTStructWithoutDICEDict(patient_id, study_id):
-    orthanc_url = "/store"
-    orthanc = pyorthanc.Orthanc(orthanc_url, username='orthanc', password='orthanc')
+    orthanc = get_orthanc_client()
     patient = pyorthanc.Patient(patient_id,orthanc)
 
     study = pyorthanc.Study(study_id,orthanc).get_main_information()
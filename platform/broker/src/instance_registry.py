@@ -0,0 +1,96 @@
+## In-process inventory of Compute Instances
+# Listing instances is a Compute API round trip, so the broker keeps one indexed snapshot per zone.
+# Snapshots are refreshed once they are older than the TTL, or right after an operation changes an instance
+# (see invalidate_instance_index, which flask_helpers calls after start/stop/suspend/resume/delete/set_metadata).
+
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+from google.cloud import compute_v1
+from gcloud_auth import get_compute_client
+
+_DEFAULT_TTL = 15 # seconds
+
+_INDEXES: Dict[Tuple[str, str], 'InstanceIndex'] = {}
+_INDEXES_LOCK = threading.Lock()
+
+def get_registry_ttl() -> float:
+    try:
+        return float(os.environ.get('INSTANCE_REGISTRY_TTL', _DEFAULT_TTL))
+    except ValueError:
+        return _DEFAULT_TTL
+
+def get_instance_metadata(instance: compute_v1.Instance) -> Dict[str, str]:
+    '''Returns the metadata items of an instance as a key -> value dict'''
+    return {item.key: item.value for item in instance.metadata.items}
+
+class InstanceIndex:
+    '''A snapshot of the instances in one zone, indexed by the metadata keys the broker looks up'''
+
+    def __init__(self, instances: List[compute_v1.Instance]):
+        self.instances = instances
+        self.created = time.monotonic()
+        self.metadata: Dict[str, Dict[str, str]] = {}
+        self.by_name: Dict[str, compute_v1.Instance] = {}
+        self.by_model: Dict[str, List[compute_v1.Instance]] = {}
+        self.by_dicom_image: Dict[str, List[compute_v1.Instance]] = {}
+        self.by_status: Dict[str, List[compute_v1.Instance]] = {}
+        self.idling = set()
+
+        for instance in instances:
+            metadata = get_instance_metadata(instance)
+            self.metadata[instance.name] = metadata
+            self.by_name[instance.name] = instance
+            self.by_status.setdefault(instance.status, []).append(instance)
+            if (model_name := metadata.get('model-displayname')) is not None:
+                self.by_model.setdefault(model_name, []).append(instance)
+            if (dicom_image := metadata.get('dicom-image')) is not None:
+                self.by_dicom_image.setdefault(dicom_image, []).append(instance)
+            if metadata.get('idling') == 'True':
+                self.idling.add(instance.name)
+
+    def get_metadata_value(self, instance: compute_v1.Instance, key: str):
+        return self.metadata.get(instance.name, {}).get(key)
+
+    def is_idling(self, instance: compute_v1.Instance) -> bool:
+        return instance.name in self.idling
+
+    def age(self) -> float:
+        return time.monotonic() - self.created
+
+def _fetch_instances(project_id: str, zone: str) -> List[compute_v1.Instance]:
+    request = compute_v1.ListInstancesRequest(project=project_id, zone=zone)
+    return list(get_compute_client().list(request=request))
+
+def get_instance_index(project_id: str, zone: str, max_age: float = None) -> InstanceIndex:
+    '''
+    Returns the indexed instances of a zone, listing them again only if the cached snapshot
+    is older than max_age (defaults to INSTANCE_REGISTRY_TTL) or was invalidated.
+    '''
+    if max_age is None:
+        max_age = get_registry_ttl()
+
+    key = (project_id, zone)
+    with _INDEXES_LOCK:
+        index = _INDEXES.get(key)
+        if index is not None and index.age() <= max_age:
+            return index
+
+        try:
+            index = InstanceIndex(_fetch_instances(project_id, zone))
+            _INDEXES[key] = index
+        except Exception as e:
+            print('Could not list instances in', zone)
+            print(e)
+            if index is None:
+                index = InstanceIndex([])
+
+        return index
+
+def invalidate_instance_index(project_id: str = None, zone: str = None):
+    '''Drops cached snapshots so the next lookup lists instances again. None matches every project/zone'''
+    with _INDEXES_LOCK:
+        for key in list(_INDEXES.keys()):
+            if (project_id is None or key[0] == project_id) and (zone is None or key[1] == zone):
+                del _INDEXES[key]
@@ -0,0 +1,216 @@
+## Persistent job queue for long running broker work (predictions, DICE, discrepancy masks, conversions)
+# Jobs are stored in a local SQLite file so that queued work survives a broker restart.
+# Each job kind has its own bounded queue and its own pool of worker threads.
+
+import os
+import json
+import queue
+import sqlite3
+import threading
+import traceback
+import uuid
+from datetime import datetime
+from enum import Enum
+from typing import Callable, Dict, List, Tuple
+
+_DEFAULT_WORKERS = 1
+_DEFAULT_QUEUE_SIZE = 32
+_JOBS_DB_FILENAME = 'jobs.sqlite3'
+
+class JobStatus(Enum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+class QueueFullError(Exception):
+    pass
+
+_CURRENT_JOB = threading.local()
+
+def current_job_id():
+    '''Returns the ID of the job being run by the calling worker thread, or None outside of a job'''
+    return getattr(_CURRENT_JOB, 'job_id', None)
+
+def get_jobs_db_path():
+    cache_dir = os.environ.get('CACHE_DIRECTORY') or '.'
+    return os.path.abspath(os.path.join(cache_dir, _JOBS_DB_FILENAME))
+
+def get_configured_int(name: str, default: int):
+    '''Reads a positive integer setting from the environment, e.g. JOB_WORKERS_DICE=2'''
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+        if value < 1:
+            raise ValueError()
+        return value
+    except ValueError:
+        print(f'{value} is not a valid value for {name}. Using {default}.')
+        return default
+
+class JobQueue:
+    def __init__(self, db_path: str, on_update: Callable[[dict], None] = None):
+        self._db_path = db_path
+        self._db_lock = threading.Lock()
+        self._on_update = on_update
+        self._handlers: Dict[str, Callable] = {}
+        self._queues: Dict[str, queue.Queue] = {}
+        self._done_events: Dict[str, threading.Event] = {}
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._db_lock, self._conn:
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    created TEXT NOT NULL,
+                    updated TEXT NOT NULL
+                )''')
+
+    def register(self, kind: str, handler: Callable, workers: int = None, max_queued: int = None):
+        '''
+        Registers the handler for a job kind and starts its workers.
+        handler is called with the job params as keyword arguments and must return something JSON serializable.
+        Worker count and queue size default to JOB_WORKERS_<KIND> and JOB_QUEUE_SIZE_<KIND> from the environment.
+        '''
+        if workers is None:
+            workers = get_configured_int(f'JOB_WORKERS_{kind.upper()}', _DEFAULT_WORKERS)
+        if max_queued is None:
+            max_queued = get_configured_int(f'JOB_QUEUE_SIZE_{kind.upper()}', _DEFAULT_QUEUE_SIZE)
+
+        self._handlers[kind] = handler
+        self._queues[kind] = queue.Queue(maxsize=max_queued)
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, args=(kind,), name=f'{kind}-worker-{i}', daemon=True)
+            thread.start()
+        print(f'Registered job kind {kind} with {workers} worker(s) and a queue of {max_queued}')
+
+    def recover(self) -> List[Tuple[str, dict]]:
+        '''
+        Re-queues jobs that were queued or interrupted while running when the broker last stopped.
+        Returns the kind and params of every re-queued job.
+        '''
+        with self._db_lock:
+            rows = self._conn.execute(
+                'SELECT id, kind, params FROM jobs WHERE status IN (?, ?) ORDER BY created',
+                (JobStatus.QUEUED.value, JobStatus.RUNNING.value)).fetchall()
+
+        recovered = []
+        for row in rows:
+            if row['kind'] not in self._queues:
+                continue
+            self._set_status(row['id'], JobStatus.QUEUED)
+            self._done_events[row['id']] = threading.Event()
+            try:
+                self._queues[row['kind']].put_nowait(row['id'])
+                recovered.append((row['kind'], json.loads(row['params'])))
+            except queue.Full:
+                self._finish(row['id'], JobStatus.FAILED, error='The job queue was full when the broker restarted.')
+
+        if recovered:
+            print('Recovered', len(recovered), 'jobs from', self._db_path)
+        return recovered
+
+    def submit(self, kind: str, params: dict) -> str:
+        '''Stores and enqueues a new job. Raises QueueFullError if too many jobs of this kind are waiting'''
+        if kind not in self._queues:
+            raise ValueError(f'Unknown job kind: {kind}')
+
+        job_id = uuid.uuid4().hex
+        now = datetime.now().isoformat()
+        with self._db_lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO jobs (id, kind, status, params, created, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, kind, JobStatus.QUEUED.value, json.dumps(params), now, now))
+
+        self._done_events[job_id] = threading.Event()
+        try:
+            self._queues[kind].put_nowait(job_id)
+        except queue.Full:
+            with self._db_lock, self._conn:
+                self._conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            del self._done_events[job_id]
+            raise QueueFullError(f'Too many {kind} jobs are waiting. Please try again later.')
+
+        self._emit_update(job_id)
+        return job_id
+
+    def get(self, job_id: str) -> dict | None:
+        with self._db_lock:
+            row = self._conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+
+        return {
+            'id': row['id'],
+            'kind': row['kind'],
+            'status': row['status'],
+            'result': None if row['result'] is None else json.loads(row['result']),
+            'error': row['error'],
+            'created': row['created'],
+            'updated': row['updated'],
+        }
+
+    def wait(self, job_id: str, timeout: float = None) -> dict | None:
+        '''Blocks until the job has finished (or timeout has passed) and returns its latest state'''
+        event = self._done_events.get(job_id)
+        if event is not None:
+            event.wait(timeout)
+        return self.get(job_id)
+
+    def _worker(self, kind: str):
+        while True:
+            job_id = self._queues[kind].get()
+            try:
+                self._run(kind, job_id)
+            finally:
+                self._queues[kind].task_done()
+
+    def _run(self, kind: str, job_id: str):
+        with self._db_lock:
+            row = self._conn.execute('SELECT params FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return
+
+        self._set_status(job_id, JobStatus.RUNNING)
+        _CURRENT_JOB.job_id = job_id
+        try:
+            result = self._handlers[kind](**json.loads(row['params']))
+            self._finish(job_id, JobStatus.SUCCEEDED, result=result)
+        except Exception as e:
+            print(traceback.format_exc())
+            print('Note, the above exception was raised by job', job_id, 'and was handled by the job queue.')
+            self._finish(job_id, JobStatus.FAILED, error=str(e))
+        finally:
+            _CURRENT_JOB.job_id = None
+
+    def _set_status(self, job_id: str, status: JobStatus):
+        with self._db_lock, self._conn:
+            self._conn.execute('UPDATE jobs SET status = ?, updated = ? WHERE id = ?',
+                               (status.value, datetime.now().isoformat(), job_id))
+        self._emit_update(job_id)
+
+    def _finish(self, job_id: str, status: JobStatus, result=None, error: str = None):
+        with self._db_lock, self._conn:
+            self._conn.execute('UPDATE jobs SET status = ?, result = ?, error = ?, updated = ? WHERE id = ?',
+                               (status.value, json.dumps(result), error, datetime.now().isoformat(), job_id))
+        if (event := self._done_events.pop(job_id, None)) is not None:
+            event.set()
+        self._emit_update(job_id)
+
+    def _emit_update(self, job_id: str):
+        if self._on_update is None:
+            return
+        try:
+            job = self.get(job_id)
+            self._on_update({'id': job['id'], 'kind': job['kind'], 'status': job['status']})
+        except Exception as e:
+            print('Could not emit job update:', e)
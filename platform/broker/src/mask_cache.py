@@ -0,0 +1,174 @@
+## On-disk cache of decoded SEG label volumes, keyed by SOPInstanceUID
+# Decoding a SEG with pydicom_seg is the slow part of DICE scores and discrepancy masks, and the same masks are
+# compared over and over. SEG instances are immutable once stored in Orthanc, so the decoded label volume is kept
+# under CACHE_DIRECTORY/masks/ and reused by every later job, including the cohort scoring processes.
+# The label volume is stored whole, as a .npy (uint8 unless a label does not fit) that is memory mapped read-only
+# when loaded, so a hit costs neither a dense allocation nor a copy: pages are read as the scoring touches them, and
+# are shared through the page cache by every process that loads the same SEG. Next to it, a JSON sidecar holds the
+# header dataset with the segment to label map (SegmentSequence) and the PixelMeasuresSequence.
+# Callers must not write to the masks they get. Entries are evicted oldest first once the cache is larger than
+# MASK_CACHE_SIZE_MB.
+
+import os
+import json
+import threading
+import uuid
+from typing import Callable, Tuple
+import numpy as np
+import pydicom
+from pydicom import Dataset
+
+_DEFAULT_MAX_SIZE_MB = 2048
+_MASK_SUFFIX = '.npy'
+_HEADER_SUFFIX = '.json'
+_TEMP_PREFIX = '.tmp-'
+
+def _get_header(seg_series: Dataset) -> Dataset:
+    '''The parts of a SEG dataset that scoring and discrepancy masks use besides the pixels'''
+    header = Dataset()
+    header.SOPInstanceUID = seg_series.SOPInstanceUID
+    header.SliceThickness = seg_series.get('SliceThickness')
+    if 'SegmentSequence' in seg_series:
+        header.SegmentSequence = seg_series.SegmentSequence
+    try:
+        pixel_measures = Dataset()
+        pixel_measures.PixelMeasuresSequence = seg_series.SharedFunctionalGroupsSequence[0].PixelMeasuresSequence
+        header.SharedFunctionalGroupsSequence = [pixel_measures]
+    except (AttributeError, IndexError, KeyError):
+        pass
+    return header
+
+class MaskCache:
+    def __init__(self, root: str, max_bytes: int):
+        self._root = root
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+
+    def _get_paths(self, sop_instance_uid: str):
+        base = os.path.join(self._root, sop_instance_uid)
+        return base + _MASK_SUFFIX, base + _HEADER_SUFFIX
+
+    def get(self, seg_path: str, decoder: Callable[[str], Tuple[np.ndarray, Dataset]]) -> Tuple[np.ndarray, Dataset]:
+        '''
+        Returns the (read-only) label volume of the SEG in seg_path and a dataset with the header from _get_header.
+        decoder (seg_mask_dice.decode_seg) is only called the first time a SEG instance is seen.
+        '''
+        sop_instance_uid = str(pydicom.dcmread(seg_path, stop_before_pixels=True, specific_tags=['SOPInstanceUID']).SOPInstanceUID)
+        mask_path, header_path = self._get_paths(sop_instance_uid)
+
+        try:
+            result = self._load(mask_path, header_path)
+            with self._lock:
+                self.hits += 1
+            return result
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print('Removing unreadable mask cache entry', sop_instance_uid, e)
+            self._remove(mask_path, header_path)
+
+        with self._lock:
+            self.misses += 1
+        print('Decoding SEG', sop_instance_uid)
+        seg_mask, seg_series = decoder(seg_path)
+        header = _get_header(seg_series)
+        try:
+            self._store(mask_path, header_path, seg_mask, header)
+            # the same memory mapped volume as later hits, instead of keeping the decoded one
+            return self._load(mask_path, header_path)
+        except Exception as e:
+            print('Could not cache decoded SEG', sop_instance_uid, e)
+        return seg_mask, header
+
+    def _load(self, mask_path: str, header_path: str):
+        with open(header_path, 'r') as f:
+            metadata = json.load(f)
+        mask = np.load(mask_path, mmap_mode='r')
+        if list(mask.shape) != metadata['shape']:
+            raise Exception(f'Mask has shape {mask.shape}, expected {metadata["shape"]}')
+        os.utime(header_path) # last use, for eviction
+        return mask, Dataset.from_json(metadata['header'])
+
+    def _store(self, mask_path: str, header_path: str, seg_mask: np.ndarray, header: Dataset):
+        if seg_mask.size == 0 or (seg_mask.min() >= 0 and seg_mask.max() <= np.iinfo(np.uint8).max):
+            seg_mask = seg_mask.astype(np.uint8, copy=False)
+        metadata = {
+            'shape': list(seg_mask.shape),
+            'header': header.to_json_dict(),
+        }
+
+        # written under temporary names and renamed, so that other jobs and processes never see partial entries.
+        # The header is renamed last since its presence marks the entry as complete
+        temp_base = os.path.join(self._root, f'{_TEMP_PREFIX}{uuid.uuid4().hex}')
+        try:
+            np.save(temp_base + _MASK_SUFFIX, np.ascontiguousarray(seg_mask))
+            with open(temp_base + _HEADER_SUFFIX, 'w') as f:
+                json.dump(metadata, f)
+            os.replace(temp_base + _MASK_SUFFIX, mask_path)
+            os.replace(temp_base + _HEADER_SUFFIX, header_path)
+        finally:
+            self._remove(temp_base + _MASK_SUFFIX, temp_base + _HEADER_SUFFIX)
+        self._evict()
+
+    def _remove(self, *paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _get_entries(self):
+        '''Returns [(last use, size, mask path, header path)] of every complete entry'''
+        entries = []
+        for name in os.listdir(self._root):
+            if name.startswith(_TEMP_PREFIX) or not name.endswith(_HEADER_SUFFIX):
+                continue
+            header_path = os.path.join(self._root, name)
+            mask_path = header_path[:-len(_HEADER_SUFFIX)] + _MASK_SUFFIX
+            try:
+                entries.append((os.path.getmtime(header_path), os.path.getsize(header_path) + os.path.getsize(mask_path), mask_path, header_path))
+            except OSError:
+                continue
+        return entries
+
+    def _evict(self):
+        entries = self._get_entries()
+        total = sum(entry[1] for entry in entries)
+        for last_use, size, mask_path, header_path in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            print('Evicting', os.path.basename(mask_path), 'from the mask cache')
+            self._remove(header_path, mask_path)
+            total -= size
+
+    def stats(self):
+        entries = self._get_entries()
+        with self._lock:
+            return {
+                'entries': len(entries),
+                'size': sum(entry[1] for entry in entries),
+                'max_size': self._max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+_MASK_CACHE = None
+_MASK_CACHE_LOCK = threading.Lock()
+
+def get_mask_cache() -> MaskCache:
+    global _MASK_CACHE
+
+    if _MASK_CACHE is None:
+        with _MASK_CACHE_LOCK:
+            if _MASK_CACHE is None:
+                cache_dir = os.environ.get('CACHE_DIRECTORY') or '.'
+                try:
+                    max_size_mb = int(os.environ.get('MASK_CACHE_SIZE_MB', _DEFAULT_MAX_SIZE_MB))
+                except ValueError:
+                    max_size_mb = _DEFAULT_MAX_SIZE_MB
+                _MASK_CACHE = MaskCache(os.path.abspath(os.path.join(cache_dir, 'masks')), max_size_mb * 1024 * 1024)
+
+    return _MASK_CACHE
@@ -0,0 +1,108 @@
+## Persistent cache of DICE and surface metric results
+# SEG and RTSTRUCT instances are immutable once stored in Orthanc, so the scores of a mask pair only depend on
+# the two SOPInstanceUIDs and the metric configuration. Results are kept in CACHE_DIRECTORY/metrics.sqlite3.
+# Mask series hold a single instance, so the SOPInstanceUID seen for each mask series is remembered as well;
+# a repeated /getDICEScores can then be answered from the cache without asking Orthanc anything.
+
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime
+import pydicom
+from seg_mask_dice import DEFAULT_SURFACE_TOLERANCE, validate_metrics
+
+_METRIC_CACHE_DB_FILENAME = 'metrics.sqlite3'
+
+def get_metric_config(dicom_series_UID: str, metrics=None, surface_tolerance=DEFAULT_SURFACE_TOLERANCE) -> str:
+    '''
+    Canonical key for a metric configuration.
+    The image series is part of it since masks are padded to (SEG) or rasterized on (RTSTRUCT) its slices.
+    '''
+    config = {
+        'dicom_series': dicom_series_UID,
+        'metrics': sorted(set(validate_metrics(metrics))),
+        'surface_tolerance': float(surface_tolerance),
+    }
+    return json.dumps(config, sort_keys=True)
+
+def get_sop_instance_uid(file_path: str) -> str:
+    return str(pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=['SOPInstanceUID']).SOPInstanceUID)
+
+class MetricCache:
+    def __init__(self, db_path: str):
+        self._db_path = db_path
+        self._db_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._db_lock, self._conn:
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS series_instances (
+                    series_uid TEXT PRIMARY KEY,
+                    sop_instance_uid TEXT NOT NULL
+                )''')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS results (
+                    pred_sop_instance_uid TEXT NOT NULL,
+                    truth_sop_instance_uid TEXT NOT NULL,
+                    config TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    created TEXT NOT NULL,
+                    PRIMARY KEY (pred_sop_instance_uid, truth_sop_instance_uid, config)
+                )''')
+
+    def get(self, pred_sop_instance_uid: str, truth_sop_instance_uid: str, config: str):
+        '''Returns the cached result for a pair of mask instances, or None'''
+        with self._db_lock:
+            row = self._conn.execute(
+                'SELECT result FROM results WHERE pred_sop_instance_uid = ? AND truth_sop_instance_uid = ? AND config = ?',
+                (pred_sop_instance_uid, truth_sop_instance_uid, config)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def get_by_series(self, pred_series_UID: str, truth_series_UID: str, config: str):
+        '''Same as get(), looking up the instances of two mask series that were scored before'''
+        with self._db_lock:
+            rows = dict(self._conn.execute(
+                'SELECT series_uid, sop_instance_uid FROM series_instances WHERE series_uid IN (?, ?)',
+                (pred_series_UID, truth_series_UID)).fetchall())
+        if pred_series_UID not in rows or truth_series_UID not in rows:
+            return None
+        return self.get(rows[pred_series_UID], rows[truth_series_UID], config)
+
+    def put(self, pred_series_UID: str, pred_sop_instance_uid: str, truth_series_UID: str, truth_sop_instance_uid: str, config: str, result):
+        with self._db_lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO series_instances (series_uid, sop_instance_uid) VALUES (?, ?)',
+                                   [(pred_series_UID, pred_sop_instance_uid), (truth_series_UID, truth_sop_instance_uid)])
+            self._conn.execute(
+                'INSERT OR REPLACE INTO results (pred_sop_instance_uid, truth_sop_instance_uid, config, result, created) VALUES (?, ?, ?, ?, ?)',
+                (pred_sop_instance_uid, truth_sop_instance_uid, config, json.dumps(result), datetime.now().isoformat()))
+
+    def stats(self):
+        with self._db_lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            return {
+                'entries': entries,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+_METRIC_CACHE = None
+_METRIC_CACHE_LOCK = threading.Lock()
+
+def get_metric_cache() -> MetricCache:
+    global _METRIC_CACHE
+
+    if _METRIC_CACHE is None:
+        with _METRIC_CACHE_LOCK:
+            if _METRIC_CACHE is None:
+                cache_dir = os.environ.get('CACHE_DIRECTORY') or '.'
+                _METRIC_CACHE = MetricCache(os.path.abspath(os.path.join(cache_dir, _METRIC_CACHE_DB_FILENAME)))
+
+    return _METRIC_CACHE
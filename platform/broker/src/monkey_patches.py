@@ -1,7 +1,9 @@
 # Monkey patches to library methods
 
 import numpy as np
-from typing import Tuple
+import threading
+from contextlib import contextmanager
+from typing import List, Tuple
 from highdicom.seg import SegmentationTypeValues, SegmentsOverlapValues, Segmentation
 
 from highdicom.content import PixelMeasuresSequence
@@ -12,6 +14,63 @@ from rt_utils import image_helper
 PATCH_HIGHDICOM = True
 PATCH_RTUTILS = True
 
+# Label maps that the SEG writers already validated (see checked_label_map), so they are not scanned again
+_CHECKED_LABEL_MAP = threading.local()
+
+@contextmanager
+def checked_label_map(pixel_array: np.ndarray):
+    '''Within the block, highdicom takes pixel_array as a valid uint8 label map without scanning it for its maximum'''
+    _CHECKED_LABEL_MAP.pixel_array = pixel_array
+    try:
+        yield
+    finally:
+        _CHECKED_LABEL_MAP.pixel_array = None
+
+## Segment stacks
+# A 4D pixel_array holds a full (slices, rows, columns) volume for every segment. A SegmentStack stands in for one and
+# only gets the plane of a segment on a slice from get_segment_plane(plane index, segment number) when highdicom
+# encodes that frame, so SEGs of many (possibly overlapping) ROIs are built one frame at a time.
+# Whether the segments overlap is computed by the caller and taken as given.
+
+class SegmentStack:
+    '''
+    Stands in for a (slices, rows, columns, segments) binary pixel_array.
+    get_segment_plane returns the (rows, columns) plane of a segment as a bool or uint8 array, or None where it is empty.
+    '''
+    ndim = 4
+    dtype = np.dtype(np.uint8)
+
+    def __init__(self, shape, get_segment_plane, segments_overlap: SegmentsOverlapValues):
+        self.shape = tuple(shape)
+        self.get_segment_plane = get_segment_plane
+        self.segments_overlap = segments_overlap
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, plane_index):
+        return SegmentStackPlane(self, plane_index)
+
+    def get_nonempty_plane_indices(self):
+        return [plane_index for plane_index in range(self.shape[0])
+                if any(self[plane_index].get_segment(segment_number).any() for segment_number in range(1, self.shape[-1] + 1))]
+
+class SegmentStackPlane:
+    '''One slice of a SegmentStack, as highdicom passes it to _get_segment_pixel_array'''
+    ndim = 3
+    dtype = SegmentStack.dtype
+
+    def __init__(self, stack: SegmentStack, plane_index: int):
+        self.shape = stack.shape[1:]
+        self._stack = stack
+        self._plane_index = plane_index
+
+    def get_segment(self, segment_number: int) -> np.ndarray:
+        plane = self._stack.get_segment_plane(self._plane_index, segment_number)
+        if plane is None:
+            return np.zeros(self.shape[:2], dtype=np.uint8)
+        return plane.view(np.uint8) if plane.dtype == np.bool_ else plane.astype(np.uint8, copy=False)
+
 # np.float_ is deprecated in numpy>=2.0.0
 # highdicom<=0.22.0 still checks np.float_
 @staticmethod
@@ -20,6 +79,18 @@ def _check_and_cast_pixel_array(
         number_of_segments: int,
         segmentation_type: SegmentationTypeValues
     ) -> Tuple[np.ndarray, SegmentsOverlapValues]:
+        if isinstance(pixel_array, SegmentStack):
+            if pixel_array.shape[-1] != number_of_segments:
+                raise ValueError(
+                    f'The segment stack has {pixel_array.shape[-1]} segments, '
+                    f'but {number_of_segments} are described.'
+                )
+            return pixel_array, pixel_array.segments_overlap
+
+        if pixel_array.ndim == 3 and pixel_array is getattr(_CHECKED_LABEL_MAP, 'pixel_array', None):
+            # labels of a label map cannot overlap
+            return pixel_array, SegmentsOverlapValues.NO
+
         if pixel_array.ndim == 4:
             # Check that the number of segments in the array matches
             if pixel_array.shape[-1] != number_of_segments:
@@ -155,7 +226,9 @@ def _get_segment_pixel_array(
             (0 or 1).
 
         """
-        if pixel_array.dtype in (np.float32, np.float64):
+        if isinstance(pixel_array, SegmentStackPlane):
+            segment_array = pixel_array.get_segment(segment_number)
+        elif pixel_array.dtype in (np.float32, np.float64):
             # Based on the previous checks and casting, if we get here the
             # output is a FRACTIONAL segmentation Floating-point numbers must
             # be mapped to 8-bit integers in the range [0,
@@ -199,20 +272,102 @@ def _get_segment_pixel_array(
                 if int(max_fractional_value) != 1:
                     segment_array *= int(max_fractional_value)
 
+        if segmentation_type == SegmentationTypeValues.BINARY and segment_array.size % 8 == 0:
+            # packed right away, see _encode_pixels_native
+            segment_array = np.packbits(segment_array, axis=None, bitorder='little')
+
         return segment_array
 
+_original_get_nonempty_plane_indices = Segmentation._get_nonempty_plane_indices
+_original_encode_pixels_native = Segmentation._encode_pixels_native
+
+@staticmethod
+def _get_nonempty_plane_indices(pixel_array) -> Tuple[List[int], bool]:
+    if isinstance(pixel_array, SegmentStack):
+        plane_indices = pixel_array.get_nonempty_plane_indices()
+        if len(plane_indices) == 0:
+            return list(range(pixel_array.shape[0])), True
+        return plane_indices, False
+    return _original_get_nonempty_plane_indices(pixel_array)
+
+## Bit packed SEG frames
+# highdicom keeps every frame of a BINARY SEG as an unpacked uint8 array until all of them are cut out, then
+# concatenates them and packs the bits in several more full size copies, so its peak memory is a byte per voxel per
+# segment. When the pixels of a frame fill whole bytes (rows * columns is a multiple of 8, as for every CT and MR
+# matrix), _get_segment_pixel_array packs each frame as soon as it is cut out and the packed frames are simply joined
+# here. The PixelData is the same, since frames then start on byte boundaries anyway.
+
+def _encode_pixels_native(self, planes: np.ndarray) -> bytes:
+    if self.SegmentationType == SegmentationTypeValues.BINARY.value and (self.Rows * self.Columns) % 8 == 0:
+        packed = planes.tobytes()
+        return packed + b'\x00' if len(packed) % 2 else packed
+    return _original_encode_pixels_native(self, planes)
+
+## Contour to slice index
+# rt_utils matches contours to slices by scanning every contour of an ROI for every slice of the series.
+# ContourSliceIndex maps the SOPInstanceUIDs and positions of the series' slices to slice indices once, so the
+# contours of an ROI are grouped by slice in one pass and only the slices that have contours are filled.
+# Contours without a ContourImageSequence are placed on the nearest slice along the slice normal, if it is within
+# half a slice spacing of the contour.
+
+class ContourSliceIndex:
+    def __init__(self, series_data):
+        self.series_data = series_data
+        self._slice_indices = { series_slice.SOPInstanceUID: i for i, series_slice in enumerate(series_data) }
+        _, _, self._slice_direction = image_helper.get_slice_directions(series_data[0])
+        positions = np.array([np.dot(self._slice_direction, series_slice.ImagePositionPatient) for series_slice in series_data])
+        self._position_order = np.argsort(positions)
+        self._sorted_positions = positions[self._position_order]
+        self._tolerance = np.median(np.diff(self._sorted_positions)) / 2 if len(series_data) > 1 else np.inf
+
+    def get_slice_index_by_position(self, contour_data):
+        '''Returns the index of the slice nearest to the first point of contour_data, or None if none is close enough'''
+        if len(contour_data) < 3:
+            return None
+        position = np.dot(self._slice_direction, np.asarray(contour_data[:3], dtype=np.float64))
+        i = np.searchsorted(self._sorted_positions, position)
+        nearest = min((j for j in (i - 1, i) if 0 <= j < len(self._sorted_positions)),
+                      key=lambda j: abs(self._sorted_positions[j] - position))
+        if abs(self._sorted_positions[nearest] - position) > self._tolerance:
+            return None
+        return int(self._position_order[nearest])
+
+    def get_contours_by_slice(self, contour_sequence):
+        '''Returns [(slice index, [contour data])] for every slice that has contours, in slice order'''
+        contours_by_slice = {}
+        for contour in contour_sequence:
+            if 'ContourImageSequence' in contour:
+                slice_indices = [self._slice_indices.get(contour_image.ReferencedSOPInstanceUID) for contour_image in contour.ContourImageSequence]
+            else:
+                slice_indices = [self.get_slice_index_by_position(contour.ContourData)]
+            for slice_index in slice_indices:
+                if slice_index is not None:
+                    contours_by_slice.setdefault(slice_index, []).append(contour.ContourData)
+        return sorted(contours_by_slice.items(), key=lambda item: item[0])
+
+# rt_utils calls create_series_mask_from_contour_sequence once per ROI with the same series,
+# so the index of the last series is kept
+_LAST_CONTOUR_SLICE_INDEX = None
+
+def get_contour_slice_index(series_data) -> ContourSliceIndex:
+    global _LAST_CONTOUR_SLICE_INDEX
+
+    index = _LAST_CONTOUR_SLICE_INDEX
+    if index is None or index.series_data is not series_data:
+        index = ContourSliceIndex(series_data)
+        _LAST_CONTOUR_SLICE_INDEX = index
+    return index
+
 # RT utils monkey patch for contours
 def monkey_patched_create_series_mask_from_contour_sequence(series_data, contour_sequence):
     mask = image_helper.create_empty_series_mask(series_data)
     transformation_matrix = image_helper.get_patient_to_pixel_transformation_matrix(series_data)
 
-    for i, series_slice in enumerate(series_data):
-        slice_contour_data = image_helper.get_slice_contour_data(series_slice, contour_sequence)
+    for i, slice_contour_data in get_contour_slice_index(series_data).get_contours_by_slice(contour_sequence):
         try:
-            if len(slice_contour_data):
-                mask[:, :, i] = image_helper.get_slice_mask_from_slice_contour_data(
-                    series_slice, slice_contour_data, transformation_matrix
-                )
+            mask[:, :, i] = image_helper.get_slice_mask_from_slice_contour_data(
+                series_data[i], slice_contour_data, transformation_matrix
+            )
         except:
             pass
 
@@ -246,6 +401,8 @@ if PATCH_HIGHDICOM:
     Segmentation._check_and_cast_pixel_array = _check_and_cast_pixel_array
     PixelMeasuresSequence.__eq__ = monkey_patched_PixelMeasuresSequence__eq__
     Segmentation._get_segment_pixel_array = _get_segment_pixel_array
+    Segmentation._get_nonempty_plane_indices = _get_nonempty_plane_indices
+    Segmentation._encode_pixels_native = _encode_pixels_native
 
 if PATCH_RTUTILS:
     print('patching rt-utils')
@@ -0,0 +1,103 @@
+## Shared Orthanc client
+# pyorthanc.Orthanc is an httpx.Client, which is thread safe and keeps a pool of keep-alive connections.
+# The broker uses one client for every Orthanc call instead of opening a new connection per call.
+# Pool size and timeout are set with ORTHANC_POOL_SIZE and ORTHANC_TIMEOUT.
+
+import os
+import threading
+import time
+import httpx
+import pyorthanc
+
+orthanc_url = 'http://orthanc'
+_ORTHANC_USERNAME = 'orthanc'
+_ORTHANC_PASSWORD = 'orthanc'
+_DEFAULT_POOL_SIZE = 10
+_DEFAULT_TIMEOUT = 60 # seconds
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+class OrthancMetrics:
+    '''Counters for the requests made through the shared client'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.reused_connections = 0
+        self.new_connections = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, latency: float, new_connection: bool, error: bool):
+        with self._lock:
+            self.requests += 1
+            if new_connection:
+                self.new_connections += 1
+            else:
+                self.reused_connections += 1
+            if error:
+                self.errors += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'reused_connections': self.reused_connections,
+                'new_connections': self.new_connections,
+                'errors': self.errors,
+                # latency is measured until the response headers arrive, not until a streamed body is read
+                'average_latency': self.total_latency / self.requests if self.requests else 0.0,
+                'max_latency': self.max_latency,
+            }
+
+_METRICS = OrthancMetrics()
+
+class _MeteredTransport(httpx.HTTPTransport):
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        opened_connection = []
+        def trace(event_name, info):
+            if event_name == 'connection.connect_tcp.started':
+                opened_connection.append(True)
+
+        request.extensions['trace'] = trace
+        start = time.perf_counter()
+        try:
+            response = super().handle_request(request)
+        except Exception:
+            _METRICS.record(time.perf_counter() - start, len(opened_connection) > 0, error=True)
+            raise
+
+        _METRICS.record(time.perf_counter() - start, len(opened_connection) > 0, error=response.status_code >= 400)
+        return response
+
+def _get_int_env(name: str, default: int):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        print(f'{os.environ.get(name)} is not a valid value for {name}. Using {default}.')
+        return default
+
+def get_orthanc_client() -> pyorthanc.Orthanc:
+    '''Returns the broker wide Orthanc client, creating it on first use'''
+    global _CLIENT
+
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                pool_size = _get_int_env('ORTHANC_POOL_SIZE', _DEFAULT_POOL_SIZE)
+                transport = _MeteredTransport(limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+                _CLIENT = pyorthanc.Orthanc(
+                    orthanc_url,
+                    username=_ORTHANC_USERNAME,
+                    password=_ORTHANC_PASSWORD,
+                    timeout=_get_int_env('ORTHANC_TIMEOUT', _DEFAULT_TIMEOUT),
+                    transport=transport)
+
+    return _CLIENT
+
+def get_orthanc_metrics():
+    return _METRICS.as_dict()
@@ -1,15 +1,21 @@
 import pyorthanc
+import pydicom
 import zipfile
+import struct
+import zlib
+import io
 import os
+import threading
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urljoin
+from orthanc_client import get_orthanc_client, orthanc_url
 
 # TODO: might want to look into this: https://orthanc.uclouvain.be/book/faq/orthanc-ids.html
 
-orthanc_url = 'http://orthanc'
-
 def get_tags(study_UID):
     UID_list = []
-    orthanc = pyorthanc.Orthanc(orthanc_url, username='orthanc', password='orthanc')
+    orthanc = get_orthanc_client()
     study = pyorthanc.find_studies(orthanc, query={"StudyInstanceUID" : study_UID})[0]#there should only be one study
     study_info = study.get_main_information()
     for series_id in study_info["Series"]:
@@ -21,7 +27,7 @@ def get_tags(study_UID):
 
 
 def change_tags(series_UID):#make sure this is an RTstruct series
-    orthanc = pyorthanc.Orthanc(orthanc_url, username='orthanc', password='orthanc')
+    orthanc = get_orthanc_client()
     series = None
     try:
         series = pyorthanc.find_series(orthanc, query={"SeriesInstanceUID":series_UID})[0]#Should only be one
@@ -37,7 +43,7 @@ def change_tags(series_UID):#make sure this is an RTstruct series
 
 
 def get_first_dicom_image_series_from_study(patient_id, study_UID, save_directory):
-    orthanc = pyorthanc.Orthanc(orthanc_url, username='orthanc', password='orthanc', timeout=60)
+    orthanc = get_orthanc_client()
 
     patient_file_id = pyorthanc.find_patients(orthanc,query={'PatientID': patient_id})[0]#there should only be one
     patient = pyorthanc.Patient(patient_file_id.get_main_information()["ID"],orthanc)
@@ -70,11 +76,231 @@ def get_first_dicom_image_series_from_study(patient_id, study_UID, save_director
     image_folder = os.listdir(study_dir)[image_order_num]
     return first_folder, study_dir + "/"+image_folder
 
-def get_dicom_series_by_id(series_instance_uid, save_directory, series_obj_out=[], extract_zip=True, download=True):
+_DEFAULT_DOWNLOAD_WORKERS = 8
+_DOWNLOAD_RETRIES = 3
+
+_ZIP_LOCAL_FILE_HEADER = 0x04034b50
+_ZIP_DATA_DESCRIPTOR = 0x08074b50
+_ZIP_LOCAL_FILE_HEADER_FORMAT = '<IHHHHHIIIHH'
+_ZIP_STORED, _ZIP_DEFLATED = 0, 8
+_ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+_ZIP64_EXTRA_FIELD_ID = 0x0001
+
+class _ChunkReader:
+    '''Reads exact byte counts out of an iterator of byte chunks (e.g. an HTTP response body)'''
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    def read(self, size):
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read_some(self):
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            return data
+        return next(self._chunks, b'')
+
+    def unread(self, data):
+        self._buffer[0:0] = data
+
+class UnsupportedZipMemberError(Exception):
+    '''A zip member that cannot be read before the central directory, see iter_zip_stream'''
+
+def iter_zip_stream(chunks):
+    '''
+    Yields (member_name, member_bytes) from a zip archive as it is being received, without needing the
+    central directory at the end of the file. Supports deflated members (with or without data descriptors),
+    stored members without data descriptors and zip64 sizes.
+    Stored members with data descriptors have no size before their data, and other compression methods cannot
+    be decoded here; both raise UnsupportedZipMemberError.
+    '''
+    reader = _ChunkReader(chunks)
+    header_size = struct.calcsize(_ZIP_LOCAL_FILE_HEADER_FORMAT)
+    while True:
+        header = reader.read(header_size)
+        if len(header) < 4 or struct.unpack('<I', header[:4])[0] != _ZIP_LOCAL_FILE_HEADER:
+            return # reached the central directory (or the end of the stream)
+
+        (_, _, flags, method, _, _, crc, compressed_size, size, name_len, extra_len) = struct.unpack(_ZIP_LOCAL_FILE_HEADER_FORMAT, header)
+        name = reader.read(name_len).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = reader.read(extra_len)
+
+        is_zip64 = False
+        offset = 0
+        while offset + 4 <= len(extra):
+            field_id, field_len = struct.unpack('<HH', extra[offset:offset + 4])
+            if field_id == _ZIP64_EXTRA_FIELD_ID:
+                is_zip64 = True
+                if field_len >= 16:
+                    size, compressed_size = struct.unpack('<QQ', extra[offset + 4:offset + 20])
+            offset += 4 + field_len
+
+        has_data_descriptor = flags & _ZIP_FLAG_DATA_DESCRIPTOR
+        if method == _ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            parts = []
+            while not decompressor.eof:
+                chunk = reader.read_some()
+                if not chunk:
+                    raise Exception(f'Zip stream ended in the middle of {name}')
+                parts.append(decompressor.decompress(chunk))
+            reader.unread(decompressor.unused_data)
+            data = b''.join(parts)
+        elif method == _ZIP_STORED and not has_data_descriptor:
+            data = reader.read(compressed_size)
+        elif method == _ZIP_STORED:
+            raise UnsupportedZipMemberError(f'Cannot stream zip member {name} (stored with a data descriptor)')
+        else:
+            raise UnsupportedZipMemberError(f'Cannot stream zip member {name} (compression method {method})')
+
+        if has_data_descriptor:
+            signature = reader.read(4)
+            if struct.unpack('<I', signature)[0] != _ZIP_DATA_DESCRIPTOR:
+                reader.unread(signature) # the descriptor signature is optional
+            crc = struct.unpack('<I', reader.read(4))[0]
+            reader.read(16 if is_zip64 else 8) # compressed and uncompressed sizes
+
+        if zlib.crc32(data) != crc:
+            raise Exception(f'CRC mismatch for zip member {name}')
+
+        if not name.endswith('/'):
+            yield name, data
+
+def _get_safe_member_path(save_directory, member_name):
+    member_path = os.path.normpath(os.path.join(save_directory, member_name.lstrip('/\\')))
+    if os.path.commonpath([os.path.abspath(save_directory), os.path.abspath(member_path)]) != os.path.abspath(save_directory):
+        raise Exception(f'Zip member {member_name} would be written outside of {save_directory}')
+    return member_path
+
+def stream_series_archive(a_series, save_directory=None, as_datasets=False, zip_path=None, flatten=False):
+    '''
+    Streams the archive of a pyorthanc Series and decodes its members as they arrive.
+    Members are written straight to their final path under save_directory (or directly in save_directory, under
+    their file name, if flatten) and their paths are returned, or returned as pydicom Datasets (only .dcm members)
+    if as_datasets. If zip_path is given, the raw archive is also kept there.
+    If the archive cannot be read, the files written so far are removed before the error is raised.
+    '''
+    datasets = []
+    member_paths = []
+    zip_file = open(zip_path, 'wb') if zip_path is not None else None
+    try:
+        with get_orthanc_client().stream('GET', f'{orthanc_url}/series/{a_series.id_}/archive') as response:
+            response.raise_for_status()
+
+            def chunks():
+                for chunk in response.iter_bytes():
+                    if zip_file is not None:
+                        zip_file.write(chunk)
+                    yield chunk
+
+            for name, data in iter_zip_stream(chunks()):
+                if as_datasets:
+                    if name.endswith('.dcm'):
+                        datasets.append(pydicom.dcmread(io.BytesIO(data)))
+                    continue
+
+                member_path = _get_safe_member_path(save_directory, os.path.basename(name) if flatten else name)
+                if flatten and member_path in member_paths:
+                    raise Exception(f'Zip member {name} has the same file name as an earlier member')
+                os.makedirs(os.path.dirname(member_path), exist_ok=True)
+                member_paths.append(member_path)
+                with open(member_path, 'wb') as f:
+                    f.write(data)
+    except Exception:
+        if zip_file is not None:
+            zip_file.close()
+            member_paths.append(zip_path)
+        for path in member_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    finally:
+        if zip_file is not None:
+            zip_file.close()
+
+    return datasets if as_datasets else member_paths
+
+def get_download_workers():
+    '''Number of parallel instance downloads, from ORTHANC_DOWNLOAD_WORKERS. 0 streams the series archive instead'''
+    try:
+        return max(0, int(os.environ.get('ORTHANC_DOWNLOAD_WORKERS', _DEFAULT_DOWNLOAD_WORKERS)))
+    except ValueError:
+        return _DEFAULT_DOWNLOAD_WORKERS
+
+def download_series_instances(a_series, save_directory=None, max_workers=_DEFAULT_DOWNLOAD_WORKERS, progress_callback=None, as_datasets=False):
+    '''
+    Fetches every instance file of a pyorthanc Series concurrently with a bounded thread pool.
+    Files are written to save_directory/<orthanc instance id>.dcm through a .part file, so a download that was
+    interrupted can be resumed by calling this again with the same directory. With as_datasets, nothing is written
+    and pydicom Datasets are returned in the series' instance order.
+    progress_callback(done, total) is called after each instance.
+    '''
+    instances = a_series.instances
+    total = len(instances)
+    if not as_datasets:
+        os.makedirs(save_directory, exist_ok=True)
+
+    def fetch(instance):
+        last_error = None
+        for _ in range(_DOWNLOAD_RETRIES):
+            try:
+                if as_datasets:
+                    buffer = io.BytesIO()
+                    instance.download(buffer)
+                    buffer.seek(0)
+                    return pydicom.dcmread(buffer)
+
+                file_path = os.path.join(save_directory, f'{instance.id_}.dcm')
+                if os.path.exists(file_path):
+                    return file_path # already fetched by an earlier attempt
+                instance.download(file_path + '.part')
+                os.replace(file_path + '.part', file_path)
+                return file_path
+            except Exception as e:
+                last_error = e
+        raise Exception(f'Could not download instance {instance.id_}: {last_error}')
+
+    results = [None] * total
+    done = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, total))) as pool:
+        futures = {pool.submit(fetch, instance): i for i, instance in enumerate(instances)}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            done += 1
+            if progress_callback is not None:
+                progress_callback(done, total)
+
+    return results
+
+def write_series_zip(file_paths, zip_path):
+    '''Packs already downloaded instance files into an uncompressed zip (DICOM pixel data barely compresses)'''
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as zip_ref:
+        for file_path in file_paths:
+            zip_ref.write(file_path, arcname=os.path.basename(file_path))
+
+    return zip_path
+
+def get_dicom_series_by_id(series_instance_uid, save_directory, series_obj_out=[], extract_zip=True, download=True, keep_zip=False, as_datasets=False, download_workers=None, progress_callback=None):
+    '''
+    Downloads a series from Orthanc and returns the directory containing its files.
+    With download_workers > 0 (defaults to ORTHANC_DOWNLOAD_WORKERS), instances are fetched in parallel into
+    save_directory/instances/. With 0, the series archive is streamed and extracted on the fly into the
+    patient directory. keep_zip also leaves a series.zip in save_directory.
+    With as_datasets, nothing is written to disk and a list of pydicom Datasets is returned instead.
+    Without extract_zip, only series.zip is downloaded and its path is returned.
+    '''
     print('saving', save_directory)
-    url = orthanc_url
-
-    orthanc = pyorthanc.Orthanc(url, username='orthanc', password='orthanc', timeout=60)
+    orthanc = get_orthanc_client()
     valid_series = pyorthanc.find_series(orthanc, query={'SeriesInstanceUID': series_instance_uid})
     if len(valid_series) == 0:
         raise Exception('No series found with UID:', series_instance_uid)
@@ -87,22 +313,43 @@ def get_dicom_series_by_id(series_instance_uid, save_directory, series_obj_out=[
     if not download:
         return a_series
 
-    os.makedirs(save_directory, exist_ok=True)
-    zip_path = os.path.join(save_directory, 'series.zip')
-    a_series.download(zip_path, with_progres=False)
-    if extract_zip:
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            # zip_ref.extractall(zip_path, [r'PANCREAS_0005 PANCREAS_0005/'])
-            zip_ref.extractall(save_directory)
-            os.remove(zip_path)
-
-    patient = a_series.parent_patient
     if isinstance(series_obj_out, list):
         series_obj_out.append(a_series)
         # a_series.parent_study.uid
         # a_series.description
 
-    return os.path.join(save_directory, f'{patient.patient_id} {patient.name}') if extract_zip else zip_path
+    if download_workers is None:
+        download_workers = get_download_workers()
+
+    if as_datasets:
+        if download_workers > 0:
+            return download_series_instances(a_series, max_workers=download_workers, progress_callback=progress_callback, as_datasets=True)
+        try:
+            return stream_series_archive(a_series, as_datasets=True)
+        except UnsupportedZipMemberError as e:
+            print(f'{e}, downloading the instances one by one instead')
+            return download_series_instances(a_series, max_workers=_DEFAULT_DOWNLOAD_WORKERS, progress_callback=progress_callback, as_datasets=True)
+
+    os.makedirs(save_directory, exist_ok=True)
+    zip_path = os.path.join(save_directory, 'series.zip')
+    if not extract_zip:
+        a_series.download(zip_path, with_progres=False)
+        return zip_path
+
+    if download_workers == 0:
+        try:
+            stream_series_archive(a_series, save_directory, zip_path=zip_path if keep_zip else None)
+            patient = a_series.parent_patient
+            return os.path.join(save_directory, f'{patient.patient_id} {patient.name}')
+        except UnsupportedZipMemberError as e:
+            print(f'{e}, downloading the instances one by one instead')
+            download_workers = _DEFAULT_DOWNLOAD_WORKERS
+
+    instances_directory = os.path.join(save_directory, 'instances')
+    file_paths = download_series_instances(a_series, instances_directory, max_workers=download_workers, progress_callback=progress_callback)
+    if keep_zip:
+        write_series_zip(file_paths, zip_path)
+    return instances_directory
 
 def extract_dicom_series_zip(zip_path, save_directory, remove_original=False):
     with zipfile.ZipFile(zip_path, 'r') as zip_ref:
@@ -112,19 +359,44 @@ def extract_dicom_series_zip(zip_path, save_directory, remove_original=False):
 
     return save_directory
 
-def uploadSegFile(file_path, remove_original=False):
-    print('Uploading', file_path, 'to orthanc...')
-    orthanc = pyorthanc.Orthanc(orthanc_url, username='orthanc', password='orthanc', timeout=60)
-    with open(file_path, 'rb') as file:
-        orthanc.post_instances(file.read())
+_UPLOAD_CHUNK_SIZE = 1024 * 1024
 
-    if remove_original:
-        print(os.path.exists(file_path))
-        if os.path.exists(file_path):
-            os.remove(file_path)
+def uploadSegFile(seg, remove_original=False, progress_callback=None):
+    '''
+    Streams a SEG to Orthanc's /instances in chunks. seg is a file path or a file-like object (e.g. the io.BytesIO
+    returned by the SEG writers). progress_callback(sent bytes, total bytes) is called after every chunk.
+    '''
+    print('Uploading', seg, 'to orthanc...')
+    is_path = isinstance(seg, (str, os.PathLike))
+    file = open(seg, 'rb') if is_path else seg
+    try:
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        file.seek(0)
+
+        def chunks():
+            sent = 0
+            while chunk := file.read(_UPLOAD_CHUNK_SIZE):
+                yield chunk
+                sent += len(chunk)
+                if progress_callback is not None:
+                    progress_callback(sent, size)
+
+        # the size is known, so the body is streamed with a Content-Length instead of chunked transfer encoding
+        response = get_orthanc_client().post(f'{orthanc_url}/instances', content=chunks(),
+                                             headers={ 'Content-Type': 'application/dicom', 'Content-Length': str(size) })
+        response.raise_for_status()
+    finally:
+        if is_path:
+            file.close()
+
+    if remove_original and is_path:
+        print(os.path.exists(seg))
+        if os.path.exists(seg):
+            os.remove(seg)
 
 def get_modality_of_series(series_UID):
-    orthanc = pyorthanc.Orthanc(orthanc_url, username='orthanc', password='orthanc', timeout=60)
+    orthanc = get_orthanc_client()
     series = None
     try:
         series = pyorthanc.find_series(orthanc, query={"SeriesInstanceUID":series_UID})[0]#Should only be one
@@ -134,45 +406,107 @@ def get_modality_of_series(series_UID):
     series = series.get_main_information()
     return series["MainDicomTags"]["Modality"]
 
-def get_next_available_iterative_name_for_series(base_series_name, parent_study_uid, split_char='_', modality='SEG', max_len=64):
-    orthanc = pyorthanc.Orthanc(orthanc_url, username='orthanc', password='orthanc', timeout=60)
-    valid_studies = pyorthanc.find_studies(orthanc, query={'StudyInstanceUID': parent_study_uid})
-    if len(valid_studies) == 0:
-        raise Exception('Could not find any studies with UID', parent_study_uid)
-    # print(valid_studies[0])
-    # print([s.modality for s in valid_studies[0].series])
-    # print([s.description for s in valid_studies[0].series])
-    # print([split_char.join(s.description.split(split_char)[:-1]) for s in valid_studies[0].series])
-    intersecting_series = []
-    for s in valid_studies[0].series:
-        try:
-            if s.modality == modality and \
-               s.description.count(split_char) >= 1 and \
-               split_char.join(s.description.split(split_char)[:-1]) == base_series_name:
-                   intersecting_series.append(s.description)
-        except Exception as e:
-            continue
+## Iterative series names
+# Outputs are named <base>_<n> with the lowest n that is not used by a series of the study in Orthanc.
+# Names handed out by reserve_iterative_names_for_series are also skipped until they are released, so outputs that
+# are converted and uploaded in parallel (or by concurrent jobs) never get the same name.
+
+_RESERVED_NAMES = {} # {parent study UID: set of reserved series descriptions}
+_RESERVED_NAMES_LOCK = threading.Lock()
 
-    # intersecting_series = [s.description for s in valid_studies[0].series if (
-    #     s.modality==modality and
-    #     s.description.count(split_char) >= 1 and
-    #     split_char.join(s.description.split(split_char)[:-1])==base_series_name
-    #     # s.description.startswith(base_series_name)
-    #     )]
-    # print(intersecting_series)
-    # intersecting_series.sort(key=lambda s: s.description)
-    next_valid_iteration = 1
-    for i in range(1, len(intersecting_series) + 2):
-        if f'{base_series_name}{split_char}{i}' not in intersecting_series:
-            next_valid_iteration = i
-            print('next valid iter:', next_valid_iteration)
-            break
-
-    return_name = f'{base_series_name}{split_char}{next_valid_iteration}'
-    if max_len is not None and len(return_name) > max_len: # DICOM descriptions must be 64 chars or less
+def _shorten_series_name(name, max_len):
+    if max_len is not None and len(name) > max_len: # DICOM descriptions must be 64 chars or less
         prefix_len = (max_len - 5) // 2  # Length of the prefix
         suffix_len = max_len - 5 - prefix_len  # Length of the suffix
-        return_name = return_name[:prefix_len] + '-xxx-' + return_name[-suffix_len:]
-        print('shortened description to', return_name)
+        name = name[:prefix_len] + '-xxx-' + name[-suffix_len:]
+    return name
+
+def _get_iterative_names_for_series(base_series_name, parent_study_uid, count, split_char, modality, max_len, reserve):
+    # Orthanc is asked under the lock as well, so that a name released after its upload is always seen in Orthanc
+    with _RESERVED_NAMES_LOCK:
+        orthanc = get_orthanc_client()
+        valid_studies = pyorthanc.find_studies(orthanc, query={'StudyInstanceUID': parent_study_uid})
+        if len(valid_studies) == 0:
+            raise Exception('Could not find any studies with UID', parent_study_uid)
+        # print(valid_studies[0])
+        # print([s.modality for s in valid_studies[0].series])
+        # print([s.description for s in valid_studies[0].series])
+        # print([split_char.join(s.description.split(split_char)[:-1]) for s in valid_studies[0].series])
+        intersecting_series = set()
+        for s in valid_studies[0].series:
+            try:
+                if s.modality == modality and \
+                   s.description.count(split_char) >= 1 and \
+                   split_char.join(s.description.split(split_char)[:-1]) == base_series_name:
+                       intersecting_series.add(s.description)
+            except Exception as e:
+                continue
+
+        reserved = _RESERVED_NAMES.get(parent_study_uid, set())
+        names = []
+        i = 1
+        while len(names) < count:
+            name = _shorten_series_name(f'{base_series_name}{split_char}{i}', max_len)
+            if name not in intersecting_series and name not in reserved:
+                print('next valid iter:', i, name)
+                names.append(name)
+            i += 1
+        if reserve:
+            _RESERVED_NAMES.setdefault(parent_study_uid, set()).update(names)
+
+    return names
+
+def get_next_available_iterative_name_for_series(base_series_name, parent_study_uid, split_char='_', modality='SEG', max_len=64):
+    return _get_iterative_names_for_series(base_series_name, parent_study_uid, 1, split_char, modality, max_len, reserve=False)[0]
+
+def reserve_iterative_names_for_series(base_series_name, parent_study_uid, count, split_char='_', modality='SEG', max_len=64):
+    '''
+    Returns count distinct iterative names, like get_next_available_iterative_name_for_series, and reserves them
+    until release_iterative_names is called. Release them once the series are uploaded (or failed).
+    '''
+    return _get_iterative_names_for_series(base_series_name, parent_study_uid, count, split_char, modality, max_len, reserve=True)
+
+def release_iterative_names(parent_study_uid, names):
+    with _RESERVED_NAMES_LOCK:
+        reserved = _RESERVED_NAMES.get(parent_study_uid)
+        if reserved is None:
+            return
+        reserved.difference_update(names)
+        if len(reserved) == 0:
+            del _RESERVED_NAMES[parent_study_uid]
+
+def find_cohort_series(study_query, pred_description, truth_description, image_modality='CT'):
+    '''
+    Finds (image, prediction, truth) series in every study matching study_query, an Orthanc find query such as
+    {'PatientID': 'LIVER*'}. pred_description and truth_description are fnmatch patterns on SeriesDescription.
+    When several series match a pattern, the most recently updated one is used. Studies missing one of the three are skipped.
+    '''
+    orthanc = get_orthanc_client()
+    triples = []
+    for study in pyorthanc.find_studies(orthanc, query=study_query or {}):
+        image_series, pred_series, truth_series = [], [], []
+        for s in study.series:
+            try:
+                modality, description = s.modality, s.description or ''
+            except Exception:
+                continue
+            if modality == image_modality:
+                image_series.append(s)
+            elif fnmatch(description, pred_description):
+                pred_series.append(s)
+            elif fnmatch(description, truth_description):
+                truth_series.append(s)
+
+        if len(image_series) == 0 or len(pred_series) == 0 or len(truth_series) == 0:
+            print('Skipping study', study.uid, 'without image, prediction and truth series')
+            continue
+
+        latest = lambda series: max(series, key=lambda s: s.last_update)
+        triples.append({
+            'study_id': study.uid,
+            'parent_id': latest(image_series).uid,
+            'pred_series_id': latest(pred_series).uid,
+            'truth_series_id': latest(truth_series).uid,
+        })
 
-    return return_name
\ No newline at end of file
+    return triples
@@ -3,39 +3,49 @@ import zipfile
 import os
 import shutil
 from dice_score_get import get_DICE_score
-from seg_mask_dice import seg_mask_dice
+from seg_mask_dice import seg_mask_dice, DEFAULT_SURFACE_TOLERANCE
 from orthanc_functions import get_dicom_series_by_id, get_modality_of_series
+from series_cache import get_series_cache
+from metric_cache import get_metric_cache, get_metric_config, get_sop_instance_uid
 import traceback
 
-def get_files_and_dice_score(dicom_series_UID, pred_series_UID,truth_series_UID):#find ground truth and use this series id to get files from folder
-    #orthanc_url = 'http://localhost:8042' #TEST ONLY!!
-    orthanc_url = 'http://orthanc'
-    orthanc = pyorthanc.Orthanc(orthanc_url, username='orthanc', password='orthanc')
+# metrics beyond DICE (see seg_mask_dice.AVAILABLE_METRICS) are only available for SEG masks
+# executor (e.g. a process pool) runs the scoring itself; downloads always happen in the calling thread
+# results are memoized in the metric cache, so scoring the same pair again does not touch Orthanc
+def get_files_and_dice_score(dicom_series_UID, pred_series_UID,truth_series_UID, metrics=None, surface_tolerance=DEFAULT_SURFACE_TOLERANCE, executor=None):#find ground truth and use this series id to get files from folder
+    metric_cache = get_metric_cache()
+    config = get_metric_config(dicom_series_UID, metrics, surface_tolerance)
+    if (dice_list := metric_cache.get_by_series(pred_series_UID, truth_series_UID, config)) is not None:
+        print('Metric cache hit for', pred_series_UID, truth_series_UID)
+        return dice_list
+
     has_SEG_tag = get_modality_of_series(pred_series_UID) == 'SEG' or get_modality_of_series(truth_series_UID) == 'SEG'
 
-    dice_dir = 'dice/'
-    # print('cache', os.environ.get('CACHE_DIRECTORY'))
-    # return []
-    if (cache_dir := os.environ.get('CACHE_DIRECTORY')) is not None:
-        dice_dir = os.path.abspath(os.path.join(cache_dir, dice_dir))
-    #     print(dice_dir)
-    # return []
-    pred_dir = get_dicom_series_by_id(pred_series_UID, os.path.join(dice_dir, '_pred'))
-    truth_dir = get_dicom_series_by_id(truth_series_UID, os.path.join(dice_dir, '_truth'))
-    DICOM_series = get_dicom_series_by_id(dicom_series_UID, os.path.join(dice_dir, '_dicom'), download=False)
+    # pred and truth are read straight from the series cache, which keeps them on disk until they are released
+    series_cache = get_series_cache()
+    with series_cache.acquire(pred_series_UID) as cached_pred, series_cache.acquire(truth_series_UID) as cached_truth:
+        pred_sop_instance_uid = get_sop_instance_uid(cached_pred.files()[0])
+        truth_sop_instance_uid = get_sop_instance_uid(cached_truth.files()[0])
+        dice_list = metric_cache.get(pred_sop_instance_uid, truth_sop_instance_uid, config)
+        if dice_list is None:
+            dice_list = _get_dice_score_from_cache(dicom_series_UID, cached_pred, cached_truth, has_SEG_tag, metrics, surface_tolerance, executor)
+            if not dice_list: # failed, do not remember it
+                return dice_list
+        metric_cache.put(pred_series_UID, pred_sop_instance_uid, truth_series_UID, truth_sop_instance_uid, config, dice_list)
+        return dice_list
+
+def _run(executor, fn, *args, **kwargs):
+    if executor is None:
+        return fn(*args, **kwargs)
+    return executor.submit(fn, *args, **kwargs).result()
+
+def _get_dice_score_from_cache(dicom_series_UID, cached_pred, cached_truth, has_SEG_tag, metrics, surface_tolerance, executor):
+    # pred and truth series hold a single SEG/RTSTRUCT instance
+    pred_dir = cached_pred.files()[0]
+    truth_dir = cached_truth.files()[0]
+    DICOM_series = get_dicom_series_by_id(dicom_series_UID, None, series_obj_out=None, download=False)
     print(len(DICOM_series.instances))
 
-    for dirpath, _, fnames in os.walk(pred_dir):
-        print(fnames)
-        print(dirpath)
-        if len(fnames) == 1:
-            pred_dir = os.path.abspath(os.path.join(dirpath, fnames[0]))
-    for dirpath, _, fnames in os.walk(truth_dir):
-        print(fnames)
-        print(dirpath)
-        if len(fnames) == 1:
-            truth_dir = os.path.abspath(os.path.join(dirpath, fnames[0]))
-
     # pred_series = pyorthanc.find_series(orthanc, query={"SeriesInstanceUID": pred_series_UID})[0]
 
     # patient_file_id = pyorthanc.find_patients(orthanc,query={'PatientID': patient_id})[0]#there should only be one
@@ -109,10 +119,10 @@ def get_files_and_dice_score(dicom_series_UID, pred_series_UID,truth_series_UID)
     try:
         if has_SEG_tag:
             print('has seg')
-            dice_list = seg_mask_dice(len(DICOM_series.instances), pred_dir, truth_dir)#for seg files
+            dice_list = _run(executor, seg_mask_dice, len(DICOM_series.instances), pred_dir, truth_dir, metrics=metrics, surface_tolerance=surface_tolerance)#for seg files
         else:
-            DICOM_dir = get_dicom_series_by_id(dicom_series_UID, os.path.join(dice_dir, '_dicom'))
-            dice_list = get_DICE_score(DICOM_dir,pred_dir,truth_dir)#for rtstruct files
+            with get_series_cache().acquire(dicom_series_UID) as cached_dicom:
+                dice_list = _run(executor, get_DICE_score, cached_dicom.path,pred_dir,truth_dir)#for rtstruct files
     except Exception as e:
         print(e)
         print(traceback.format_exc())
@@ -120,7 +130,5 @@ def get_files_and_dice_score(dicom_series_UID, pred_series_UID,truth_series_UID)
     print(dice_list)
     # if os.path.exists(start+"/"+patient_folder_name):
     #     shutil.rmtree(start+"/" +patient_folder_name)
-    print('Removing temp dirs')
-    shutil.rmtree(dice_dir)
 
     return dice_list
\ No newline at end of file
@@ -0,0 +1,175 @@
+## Chunked prediction artifacts (.qdpred)
+# The legacy model output is a gzipped .npz, which has to be decompressed as a whole, in one thread, before any of
+# it can be read. A .qdpred file holds the same uint8 label volume and ROI names in slabs of consecutive slices that
+# are compressed one by one, so the broker can read it slab by slab, decompressing slabs in parallel threads straight
+# into a preallocated (slices, rows, columns) array, or memory map the slabs when they are stored uncompressed.
+#
+# Layout (all integers little endian):
+#   b'QDPRED01'                     magic
+#   slab 0, slab 1, ...             each the (slab slices, rows, columns) uint8 labels in C order, compressed on its own
+#   index                           UTF-8 JSON, see below
+#   uint64 index offset, b'QDPRED01'
+# The index is { "version": 1, "shape": [slices, rows, columns], "rois": [ROI name of label 1, ...],
+#                "compression": "zlib" | "none", "slabs": [[first slice, slice count, offset, size], ...] }.
+# Slabs are always slice-major; write_prediction_artifact transposes each slab of the model's array on its own.
+# Slabs are compressed with zlib unless compression='none' is asked for.
+
+import io
+import os
+import json
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+import numpy as np
+
+PREDICTION_ARTIFACT_SUFFIX = '.qdpred'
+
+_MAGIC = b'QDPRED01'
+_FOOTER = struct.Struct('<Q8s')
+_VERSION = 1
+_DEFAULT_SLAB_SLICES = 16
+_DEFAULT_READ_WORKERS = 4
+_DEFAULT_COMPRESSION = 'zlib'
+
+def _compress(data: bytes, compression: str) -> bytes:
+    if compression == 'none':
+        return data
+    if compression == 'zlib':
+        return zlib.compress(data, 6)
+    raise Exception(f'Unknown compression {compression}')
+
+def _decompress(data, compression: str, size: int) -> bytes:
+    if compression == 'none':
+        return data
+    if compression == 'zlib':
+        return zlib.decompress(data, bufsize=size)
+    raise Exception(f'Unknown compression {compression}')
+
+def write_prediction_artifact(path: str, label_map: np.ndarray, roi_names: List[str], slice_axis: int = 2,
+                              slab_slices: int = _DEFAULT_SLAB_SLICES, compression: str = None):
+    '''
+    Writes a label map (values 0..len(roi_names)) whose slices are along slice_axis as a .qdpred file.
+    This is what a model would call in place of saving a gzipped .npz.
+    Raises, without leaving a file behind, if a label is outside 0..len(roi_names).
+    '''
+    if len(roi_names) > np.iinfo(np.uint8).max:
+        raise Exception(f'At most {np.iinfo(np.uint8).max} ROIs can be stored, got {len(roi_names)}')
+    compression = compression or _DEFAULT_COMPRESSION
+    volume = np.moveaxis(label_map, slice_axis, 0) # a view, nothing is copied yet
+    num_slices = volume.shape[0]
+
+    slabs = []
+    try:
+        with open(path, 'wb') as f:
+            f.write(_MAGIC)
+            for start in range(0, num_slices, slab_slices):
+                slab = volume[start:start + slab_slices]
+                # checked before the cast, since out of range labels would wrap around in uint8
+                if slab.size > 0 and (slab.min() < 0 or slab.max() > len(roi_names)):
+                    raise Exception(f'Slices {start} to {start + slab.shape[0] - 1} have labels from {slab.min()} to {slab.max()}, '
+                                    f'but only 0 to {len(roi_names)} are described.')
+                slab = np.ascontiguousarray(slab, dtype=np.uint8)
+                data = _compress(slab.tobytes(), compression)
+                slabs.append([start, slab.shape[0], f.tell(), len(data)])
+                f.write(data)
+
+            index_offset = f.tell()
+            f.write(json.dumps({
+                'version': _VERSION,
+                'shape': [int(s) for s in volume.shape],
+                'rois': [str(roi_name) for roi_name in roi_names],
+                'compression': compression,
+                'slabs': slabs,
+            }).encode('utf-8'))
+            f.write(_FOOTER.pack(index_offset, _MAGIC))
+    except Exception:
+        # a model must not leave a partial artifact behind for the broker to pick up
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+class PredictionArtifact:
+    '''Reads a .qdpred file. shape is (slices, rows, columns)'''
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise Exception(f'{path} is not a prediction artifact')
+            f.seek(-_FOOTER.size, io.SEEK_END)
+            footer_offset = f.tell()
+            index_offset, magic = _FOOTER.unpack(f.read(_FOOTER.size))
+            if magic != _MAGIC:
+                raise Exception(f'{path} is truncated')
+            f.seek(index_offset)
+            index = json.loads(f.read(footer_offset - index_offset).decode('utf-8'))
+
+        if index.get('version') != _VERSION:
+            raise Exception(f'Unsupported prediction artifact version {index.get("version")}')
+        self.shape = tuple(index['shape'])
+        self.roi_names = index['rois']
+        self.compression = index['compression']
+        self._slabs = index['slabs']
+
+    def iter_slabs(self, start: int = 0, stop: int = None):
+        '''Yields (first slice, (slices, rows, columns) uint8 labels) for the slabs that overlap slices [start, stop)'''
+        stop = self.shape[0] if stop is None else stop
+        slice_size = self.shape[1] * self.shape[2]
+
+        if self.compression == 'none':
+            volume = np.memmap(self.path, dtype=np.uint8, mode='r')
+            for first, count, offset, size in self._slabs:
+                if first < stop and first + count > start:
+                    yield first, volume[offset:offset + size].reshape(count, self.shape[1], self.shape[2])
+            return
+
+        with open(self.path, 'rb') as f:
+            for first, count, offset, size in self._slabs:
+                if first >= stop or first + count <= start:
+                    continue
+                f.seek(offset)
+                data = _decompress(f.read(size), self.compression, count * slice_size)
+                yield first, np.frombuffer(data, dtype=np.uint8).reshape(count, self.shape[1], self.shape[2])
+
+    def read_slices(self, start: int, stop: int, out: np.ndarray = None, workers: int = _DEFAULT_READ_WORKERS) -> np.ndarray:
+        '''
+        Returns slices [start, stop) as a (slices, rows, columns) uint8 array, written into out if given.
+        Compressed slabs are decompressed by a pool of workers threads (zlib releases the GIL).
+        '''
+        start, stop = max(0, start), min(self.shape[0], stop)
+        if out is None:
+            out = np.empty((stop - start, self.shape[1], self.shape[2]), dtype=np.uint8)
+
+        def copy_slab(first, slab):
+            begin, end = max(first, start), min(first + slab.shape[0], stop)
+            out[begin - start:end - start] = slab[begin - first:end - first]
+
+        if self.compression == 'none' or workers <= 1:
+            for first, slab in self.iter_slabs(start, stop):
+                copy_slab(first, slab)
+            return out
+
+        # the compressed slabs are read in one pass over the file, then decompressed and copied in parallel
+        slice_size = self.shape[1] * self.shape[2]
+        slabs = []
+        with open(self.path, 'rb') as f:
+            for first, count, offset, size in self._slabs:
+                if first < stop and first + count > start:
+                    f.seek(offset)
+                    slabs.append((first, count, f.read(size)))
+
+        def read_slab(slab):
+            first, count, data = slab
+            data = _decompress(data, self.compression, count * slice_size)
+            copy_slab(first, np.frombuffer(data, dtype=np.uint8).reshape(count, self.shape[1], self.shape[2]))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(read_slab, slabs))
+        return out
+
+    def read_label_volume(self) -> np.ndarray:
+        return self.read_slices(0, self.shape[0])
+
+def is_prediction_artifact(path: str) -> bool:
+    return path.endswith(PREDICTION_ARTIFACT_SUFFIX)
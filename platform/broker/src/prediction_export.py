@@ -0,0 +1,163 @@
+## Prediction to SEG export
+# Models write one file per output, either a gzipped .npz ({'data': label map, 'rois': ROI names}) or a chunked
+# .qdpred (prediction_artifact.py); ensemble and multi-task models write several per run. Each output is read and encoded as a SEG in a pool of SEG_EXPORT_WORKERS processes
+# (0 encodes them in the calling thread), and every SEG is uploaded to Orthanc by one of SEG_UPLOAD_WORKERS threads
+# as soon as it is written, while the other outputs are still being encoded.
+# A .qdpred is read slab by slab into bit packed masks of the filled slices of each ROI (get_packed_label_masks), so
+# its label volume is never held whole; uncompressed artifacts are memory mapped.
+# SEGs are serialized in memory and only written to their paths with SEG_KEEP_FILES=1 (see get_seg_output_path).
+
+import os
+import gzip
+import threading
+import multiprocessing
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from typing import List
+import numpy as np
+from pydicom import Dataset
+from rtstruct_to_seg_conversion import convert_3d_numpy_array_to_dicom_seg, convert_packed_masks_to_dicom_seg, get_seg_output_path, PackedRoiMask
+from prediction_artifact import PredictionArtifact, is_prediction_artifact, PREDICTION_ARTIFACT_SUFFIX
+
+PREDICTION_SUFFIXES = ('.npz', PREDICTION_ARTIFACT_SUFFIX)
+
+_DEFAULT_EXPORT_WORKERS = 2
+_DEFAULT_UPLOAD_WORKERS = 2
+
+def _get_int_env(name: str, default: int):
+    try:
+        return max(0, int(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+def get_seg_export_workers():
+    return _get_int_env('SEG_EXPORT_WORKERS', _DEFAULT_EXPORT_WORKERS)
+
+def get_seg_upload_workers():
+    return max(1, _get_int_env('SEG_UPLOAD_WORKERS', _DEFAULT_UPLOAD_WORKERS))
+
+_EXPORT_POOL = None
+_EXPORT_POOL_LOCK = threading.Lock()
+
+def _get_export_pool() -> ProcessPoolExecutor:
+    global _EXPORT_POOL
+
+    if _EXPORT_POOL is None:
+        with _EXPORT_POOL_LOCK:
+            if _EXPORT_POOL is None:
+                # spawn, so the workers do not inherit the broker's threads and sockets
+                _EXPORT_POOL = ProcessPoolExecutor(max_workers=max(1, get_seg_export_workers()),
+                                                   mp_context=multiprocessing.get_context('spawn'))
+
+    return _EXPORT_POOL
+
+def get_packed_label_masks(artifact: PredictionArtifact) -> List[PackedRoiMask]:
+    '''
+    Reads a .qdpred artifact slab by slab into one (rows, columns, slices) PackedRoiMask per ROI, so only a slab of
+    the label volume is ever unpacked (or paged in, for uncompressed artifacts, which are memory mapped).
+    Raises if a label is outside 0..number of ROIs.
+    '''
+    num_slices, rows, columns = artifact.shape
+    num_labels = len(artifact.roi_names)
+    slice_indices = [[] for _ in range(num_labels)]
+    packed_slices = [[] for _ in range(num_labels)]
+    for first, slab in artifact.iter_slabs():
+        label_counts = np.bincount(slab.ravel(), minlength=num_labels + 1)
+        if len(label_counts) > num_labels + 1:
+            raise Exception(f'Slices {first} to {first + slab.shape[0] - 1} have labels up to {len(label_counts) - 1}, '
+                            f'but only 0 to {num_labels} are described.')
+        for label in np.flatnonzero(label_counts[1:]) + 1:
+            label_slab = slab == label
+            for i in np.flatnonzero(label_slab.reshape(slab.shape[0], -1).any(axis=1)):
+                slice_indices[label - 1].append(first + int(i))
+                packed_slices[label - 1].append(np.packbits(label_slab[i]))
+
+    return [PackedRoiMask((rows, columns, num_slices), slice_indices[label], packed_slices[label]) for label in range(num_labels)]
+
+def convert_prediction_to_seg(dicom_series: List[Dataset], prediction_path: str, seg_path: str, seg_series_description: str):
+    '''
+    Converts the prediction output in prediction_path to a SEG.
+    Returns seg_path, or an io.BytesIO with the SEG if seg_path is None.
+    '''
+    if is_prediction_artifact(prediction_path):
+        # the label volume is never held whole, only the filled slices of each ROI, bit packed
+        artifact = PredictionArtifact(prediction_path)
+        seg_save_dir = convert_packed_masks_to_dicom_seg(
+            dicom_series,
+            get_packed_label_masks(artifact),
+            artifact.roi_names,
+            seg_path,
+            seg_series_description=seg_series_description
+        )
+    else:
+        with gzip.open(prediction_path, 'rb') as gzf:
+            with np.load(gzf) as data:
+                seg_save_dir = convert_3d_numpy_array_to_dicom_seg(
+                    dicom_series,
+                    data['data'],
+                    data['rois'],
+                    seg_path,
+                    slice_axis=2,
+                    seg_series_description=seg_series_description
+                )
+    if seg_save_dir is None:
+        raise Exception('Something went wrong with saving SEG')
+    return seg_save_dir
+
+def export_predictions_to_seg(dicom_series: List[Dataset], prediction_paths: List[str], seg_paths: List[str], seg_series_descriptions: List[str],
+                              upload, progress_callback=None):
+    '''
+    Converts every prediction output to a SEG and passes the SEG (a path or an io.BytesIO) to upload (e.g. uploadSegFile).
+    The outputs of predictions that were uploaded are removed and progress_callback(uploaded, total) is called.
+    Every output is attempted; the first error, if any, is raised once all of them are done.
+    '''
+    exports = [(prediction_path, get_seg_output_path(seg_path), description)
+               for prediction_path, seg_path, description in zip(prediction_paths, seg_paths, seg_series_descriptions)]
+    workers = min(get_seg_export_workers(), len(exports))
+    uploaded = []
+    uploaded_lock = threading.Lock()
+
+    def _upload(prediction_path, seg):
+        upload(seg)
+        print('Removing', prediction_path, '...')
+        os.remove(prediction_path)
+        if progress_callback is not None:
+            with uploaded_lock:
+                uploaded.append(prediction_path)
+                progress_callback(len(uploaded), len(exports))
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=get_seg_upload_workers()) as upload_pool:
+        uploads = []
+        if workers <= 1:
+            for prediction_path, seg_path, description in exports:
+                try:
+                    seg = convert_prediction_to_seg(dicom_series, prediction_path, seg_path, description)
+                except Exception as e:
+                    print(traceback.format_exc())
+                    errors.append(e)
+                    continue
+                uploads.append(upload_pool.submit(_upload, prediction_path, seg))
+        else:
+            # the (header-only) source datasets are pickled once per output, the label maps are read by the workers
+            export_pool = _get_export_pool()
+            futures = { export_pool.submit(convert_prediction_to_seg, dicom_series, prediction_path, seg_path, description): prediction_path
+                        for prediction_path, seg_path, description in exports }
+            for future in as_completed(futures):
+                try:
+                    seg = future.result()
+                except Exception as e:
+                    print(f'Could not convert {futures[future]}: {e}')
+                    errors.append(e)
+                    continue
+                uploads.append(upload_pool.submit(_upload, futures[future], seg))
+
+        for future in uploads:
+            try:
+                future.result()
+            except Exception as e:
+                print(traceback.format_exc())
+                errors.append(e)
+
+    if len(errors) > 0:
+        raise errors[0]
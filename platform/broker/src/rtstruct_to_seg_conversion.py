@@ -2,51 +2,49 @@ import numpy as np
 import pydicom
 from pydicom import Dataset
 import os
+import io
+import threading
+import multiprocessing
 
 import pydicom.sequence
 import cv2 as cv
-from rt_utils import RTStructBuilder
-from highdicom.seg import Segmentation, SegmentDescription
+from rt_utils import RTStructBuilder, image_helper, ds_helper
+from highdicom.seg import Segmentation, SegmentDescription, SegmentsOverlapValues
 from pydicom.sr.coding import Code
 from pydicom.uid import generate_uid
-from typing import List
+from typing import Dict, List, Tuple
 import monkey_patches
-from seg_mask_dice import pad_ground_truth
+from seg_mask_dice import get_label_bounding_boxes, get_union_bounding_box, get_bounding_box_size, get_comparison_shapes, get_padded_label_mask
 from functools import reduce
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # Function to convert RT struct to binary 3D mask
 def get_roi_masks(dicom_series_path, rt_struct_path):
     try:
-        rtstruct = RTStructBuilder.create_from(
-            dicom_series_path=dicom_series_path,
-            rt_struct_path=rt_struct_path
-        )
-        roi_names = rtstruct.get_roi_names()
+        roi_masks = RTStructRasterizer(dicom_series_path).get_packed_roi_masks(rt_struct_path)
+        roi_names = list(roi_masks.keys())
         print(f"Available ROIs: {roi_names}")
 
         masks = {}
         valid_roi_names = []
         for roi_name in roi_names:
             try:
-                mask = rtstruct.get_roi_mask_by_name(roi_name)
+                mask = roi_masks[roi_name]
                 print(f"Retrieved mask for {roi_name}")
 
                 if mask is None:
                     print(f"No mask available for {roi_name}")
                     continue
 
-                voxel_count = np.sum(mask > 0)
+                voxel_count = mask.count_voxels()
                 if voxel_count == 0:
                     print(f"Skipping {roi_name} - no non-zero voxels found")
                     continue
 
-                if mask.dtype != np.int32:
-                    mask = mask.astype(np.int32)
-
                 masks[roi_name] = {
                     'mask': mask,
                     'shape': mask.shape,
-                    'voxels': np.sum(mask)
+                    'voxels': voxel_count
                 }
 
                 valid_roi_names.append(roi_name)
@@ -61,13 +59,91 @@ def get_roi_masks(dicom_series_path, rt_struct_path):
         print(f"Failed to process RT struct: {e}")
         return {}, []
 
+## SEG output
+# The writers return the path they saved the SEG to, or, when seg_filename is None, an io.BytesIO holding the
+# serialized SEG that uploadSegFile streams to Orthanc without a round trip through the disk.
+# Callers that only upload the SEG pass get_seg_output_path(path), which is the path itself only when SEG_KEEP_FILES=1
+# (to keep the files around for debugging).
+
+def keep_seg_files():
+    return os.environ.get('SEG_KEEP_FILES', '0').strip().lower() in ('1', 'true', 'yes')
+
+def get_seg_output_path(seg_filename):
+    return seg_filename if keep_seg_files() else None
+
+def save_seg(seg: Dataset, seg_filename=None):
+    '''Saves seg to seg_filename and returns the path, or returns an io.BytesIO with seg if seg_filename is None'''
+    if seg_filename is None:
+        buffer = io.BytesIO()
+        seg.save_as(buffer)
+        print(f"DICOM SEG serialized in memory ({buffer.tell()} bytes)")
+        buffer.seek(0)
+        return buffer
+
+    seg.save_as(seg_filename)
+    print(f"DICOM SEG file saved at: {seg_filename}")
+    return seg_filename
+
+## SEG writer options
+# By default SEGs are written like they always were, with a frame for every segment on every slice.
+# SEG_OMIT_EMPTY_FRAMES=1 leaves out the frames of a segment that are empty on that slice, which makes SEGs of small
+# structures on long series several times smaller and faster to build. It is opt-in since
+# pydicom_seg, which decode_seg reads SEGs back with for DICE scores and discrepancy masks, crops such SEGs to the
+# slices that have frames (or fails on them), so they would no longer line up with full masks.
+
+def get_seg_writer_options() -> dict:
+    '''Keyword arguments for highdicom's Segmentation from SEG_OMIT_EMPTY_FRAMES'''
+    omit_empty_frames = os.environ.get('SEG_OMIT_EMPTY_FRAMES', '0').strip().lower() in ('1', 'true', 'yes')
+    return { 'omit_empty_frames': omit_empty_frames }
+
+## Label map validation
+# highdicom takes a slice-major label map with labels 0..number of segments. get_slice_major_label_map casts the
+# label map to a C-contiguous uint8 array and checks its labels slab by slab, in one pass over the volume, instead
+# of a full astype copy and separate scans for the min and max (and another one by highdicom).
+# Slabs are taken along the axis the input is laid out by in memory (e.g. rows for a transposed (rows, columns,
+# slices) model output), so each slab is a contiguous block of the input.
+# A label map that already is a C-contiguous uint8 array is used as is.
+
+_LABEL_MAP_SLAB_BYTES = 4 * 1024 * 1024
+
+def get_slice_major_label_map(numpy_array: np.ndarray, num_labels: int) -> Tuple[np.ndarray, int, int]:
+    '''
+    numpy_array is a (slices, rows, columns) label map, e.g. a transposed view.
+    Returns (C-contiguous uint8 label map, min label, max label). Raises if a label is outside 0..num_labels.
+    '''
+    if numpy_array.dtype == np.uint8 and numpy_array.flags.c_contiguous:
+        label_map = numpy_array
+    else:
+        label_map = np.empty(numpy_array.shape, dtype=np.uint8)
+
+    min_label, max_label = 0, 0
+    if numpy_array.size == 0:
+        return label_map, min_label, max_label
+
+    axis = int(np.argmax([abs(stride) for stride in numpy_array.strides]))
+    slab_size = max(1, _LABEL_MAP_SLAB_BYTES // (numpy_array.nbytes // numpy_array.shape[axis]))
+    box = [slice(None)] * numpy_array.ndim
+    for start in range(0, numpy_array.shape[axis], slab_size):
+        box[axis] = slice(start, start + slab_size)
+        slab = numpy_array[tuple(box)]
+        # checked on the input, since out of range labels would wrap around in uint8
+        min_label, max_label = min(min_label, slab.min()), max(max_label, slab.max())
+        if label_map is not numpy_array:
+            np.copyto(label_map[tuple(box)], slab, casting='unsafe')
+
+    min_label, max_label = int(min_label), int(max_label)
+    if min_label < 0 or max_label > num_labels:
+        raise Exception(f'Label map has labels from {min_label} to {max_label}, but only 0 to {num_labels} are described.')
+    return label_map, min_label, max_label
+
 # NOTE: there shouldn't really ever be a reason to use this over convert_3d
 # It takes up more memory for no benefit
-def convert_4d_numpy_array_to_dicom_seg(dicom_series: List[Dataset], numpy_array, roi_names, seg_filename, seg_series_description=None):
+def convert_4d_numpy_array_to_dicom_seg(dicom_series: List[Dataset] | str, numpy_array, roi_names, seg_filename, seg_series_description=None):
     '''
     Converts a (num_slices, height, width, num_rois) numpy array into DICOM SEG object
+    dicom_series may be a list of datasets or the path of the series
     '''
-    dicom_series.sort(key=lambda d: d.InstanceNumber)
+    dicom_series = get_source_images(dicom_series)
 
     segment_descriptions = []
     for i, roi_name in enumerate(roi_names):
@@ -112,22 +188,21 @@ def convert_4d_numpy_array_to_dicom_seg(dicom_series: List[Dataset], numpy_array
         series_number=1,
         software_versions="1.0",
         series_description=seg_series_description,
-        omit_empty_frames=False
+        **get_seg_writer_options()
     )
 
     try:
         print('Saving...')
-        seg.save_as(seg_filename)
-        print(f"DICOM SEG file saved at: {seg_filename}")
-        return seg_filename
+        return save_seg(seg, seg_filename)
     except Exception as e:
         print(f"Error saving DICOM SEG file: {e}")
         return None
 
-def convert_3d_numpy_array_to_dicom_seg(dicom_series: List[Dataset], numpy_array, roi_names, seg_filename, slice_axis=2, seg_series_description=None):
+def convert_3d_numpy_array_to_dicom_seg(dicom_series: List[Dataset] | str, numpy_array, roi_names, seg_filename, slice_axis=2, seg_series_description=None):
     '''
     Converts 3d numpy array into a DICOM SEG object.
     slice_axis determines which axis corresponds to num_slices
+    dicom_series may be a list of datasets or the path of the series
     '''
     if slice_axis >= 3:
         raise Exception(f'Invalid axis: {slice_axis}')
@@ -152,7 +227,7 @@ def convert_3d_numpy_array_to_dicom_seg(dicom_series: List[Dataset], numpy_array
 
     # return convert_4d_numpy_array_to_dicom_seg(dicom_series, pixel_array, roi_names, seg_filename, seg_series_description=seg_series_description)
 
-    dicom_series.sort(key=lambda d: d.InstanceNumber)
+    dicom_series = get_source_images(dicom_series)
     numpy_array = np.transpose(numpy_array, transpose)
     print(numpy_array.shape, numpy_array.dtype)
     print(roi_names)
@@ -187,33 +262,32 @@ def convert_3d_numpy_array_to_dicom_seg(dicom_series: List[Dataset], numpy_array
 
     print('Creating SEG object')
     # print(segment_descriptions)
-    numpy_array = numpy_array.astype(np.uint8)
+    numpy_array, min_label, max_label = get_slice_major_label_map(numpy_array, len(roi_names))
     print(numpy_array.shape, numpy_array.dtype)
-    print(numpy_array.max(), numpy_array.min())
-
-
-    seg = Segmentation(
-        source_images=dicom_series,
-        pixel_array=numpy_array,
-        segmentation_type="BINARY",
-        segment_descriptions=segment_descriptions,
-        series_instance_uid=generate_uid(),
-        sop_instance_uid=generate_uid(),
-        device_serial_number="123456",
-        instance_number=1,
-        manufacturer="YourCompany",
-        manufacturer_model_name="YourModel",
-        series_number=1,
-        software_versions="1.0",
-        series_description=seg_series_description,
-        omit_empty_frames=False
-    )
+    print(max_label, min_label)
+
+    # already checked, so highdicom does not scan the label map again
+    with monkey_patches.checked_label_map(numpy_array):
+        seg = Segmentation(
+            source_images=dicom_series,
+            pixel_array=numpy_array,
+            segmentation_type="BINARY",
+            segment_descriptions=segment_descriptions,
+            series_instance_uid=generate_uid(),
+            sop_instance_uid=generate_uid(),
+            device_serial_number="123456",
+            instance_number=1,
+            manufacturer="YourCompany",
+            manufacturer_model_name="YourModel",
+            series_number=1,
+            software_versions="1.0",
+            series_description=seg_series_description,
+            **get_seg_writer_options()
+        )
 
     try:
         print('Saving...')
-        seg.save_as(seg_filename)
-        print(f"DICOM SEG file saved at: {seg_filename}")
-        return seg_filename
+        return save_seg(seg, seg_filename)
     except Exception as e:
         # print(f"Error saving DICOM SEG file: {e}")
         # return None
@@ -223,13 +297,20 @@ def convert_3d_numpy_array_to_dicom_seg(dicom_series: List[Dataset], numpy_array
 def convert_mask_to_dicom_seg(dicom_series, binary_masks, roi_names, seg_filename, seg_series_description=None):
     '''
     Converts dict of binary 3D masks into a DICOM SEG object.
-    binary_masks must be a dict of the same structure that get_roi_masks() returns.
+    binary_masks must be a dict of the same structure that get_roi_masks() returns; masks may also be numpy arrays.
+    dicom_series may be a list of datasets or the path of the series
     '''
+    masks = [binary_masks[roi_name]['mask'] for roi_name in roi_names]
+    masks = [mask if isinstance(mask, PackedRoiMask) else PackedRoiMask.from_array(mask) for mask in masks]
+    return convert_packed_masks_to_dicom_seg(dicom_series, masks, roi_names, seg_filename, seg_series_description)
 
-    first_mask = binary_masks[roi_names[0]]['mask']
-    height, width, num_slices = first_mask.shape
-
-    pixel_array = np.zeros((num_slices, height, width, len(roi_names)), dtype=np.uint8)
+def convert_packed_masks_to_dicom_seg(dicom_series, masks, roi_names, seg_filename, seg_series_description=None):
+    '''
+    Converts a list of (height, width, num_slices) PackedRoiMasks, one per ROI in roi_names, into a DICOM SEG object.
+    dicom_series may be a list of datasets or the path of the series
+    '''
+    dicom_series = get_source_images(dicom_series)
+    height, width, num_slices = masks[0].shape
 
     dicom_height = dicom_series[0].Rows
     dicom_width = dicom_series[0].Columns
@@ -237,25 +318,321 @@ def convert_mask_to_dicom_seg(dicom_series, binary_masks, roi_names, seg_filenam
         print(f"Dimension mismatch: DICOM image is {dicom_height}x{dicom_width}, pixel_array is {height}x{width}.")
         return
 
-    for i, roi_name in enumerate(roi_names):
-        binary_mask = (binary_masks[roi_name]['mask'] > 0).astype(np.uint8)
-        binary_mask = np.transpose(binary_mask, (2, 0, 1))
-        pixel_array[:, :, :, i] = binary_mask
+    # the frames are unpacked one at a time while highdicom encodes them, instead of a 4D array of every ROI
+    pixel_array = monkey_patches.SegmentStack(
+        (num_slices, height, width, len(masks)),
+        lambda slice_index, segment_number: masks[segment_number - 1].get_slice(slice_index),
+        get_packed_masks_overlap(masks)
+    )
 
     return convert_4d_numpy_array_to_dicom_seg(dicom_series, pixel_array, roi_names, seg_filename, seg_series_description)
 
+# Pixel data larger than this is left on disk by deferred reads until it is accessed
+_DEFERRED_PIXEL_SIZE = '1 KB'
+
+_DEFAULT_LOAD_WORKERS = 4
+
+def get_load_workers():
+    try:
+        return max(1, int(os.environ.get('DICOM_LOAD_WORKERS', _DEFAULT_LOAD_WORKERS)))
+    except ValueError:
+        return _DEFAULT_LOAD_WORKERS
+
+def _read_dicom_file(dicom_file_path, header_only=False, defer_pixels=False):
+    if header_only:
+        return pydicom.dcmread(dicom_file_path, stop_before_pixels=True)
+    if defer_pixels:
+        return pydicom.dcmread(dicom_file_path, defer_size=_DEFERRED_PIXEL_SIZE)
+    return pydicom.dcmread(dicom_file_path)
+
+def map_dicom_files(read_file, dicom_file_paths, *args, workers=None, use_processes=False):
+    '''
+    Returns read_file(path, *args) for every path, in order.
+    Files are read by a pool of workers (defaults to DICOM_LOAD_WORKERS) threads, or processes with use_processes.
+    '''
+    if workers is None:
+        workers = get_load_workers()
+    workers = min(workers, len(dicom_file_paths))
+
+    if workers <= 1:
+        return [read_file(p, *args) for p in dicom_file_paths]
+    executor_type = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_type(max_workers=workers) as executor:
+        # chunksize only applies to processes, where it saves a round trip per file
+        return list(executor.map(read_file, dicom_file_paths, *[[arg] * len(dicom_file_paths) for arg in args],
+                                 chunksize=max(1, len(dicom_file_paths) // (workers * 4))))
+
+def _get_slice_sort_key(dataset: Dataset):
+    # InstanceNumber first (as the SEG writers always sorted), then the position along the slice normal,
+    # then the SOPInstanceUID so that the order never depends on the order the files were read in
+    instance_number = dataset.get('InstanceNumber')
+    position = 0.0
+    if 'ImagePositionPatient' in dataset and 'ImageOrientationPatient' in dataset:
+        orientation = np.array(dataset.ImageOrientationPatient, dtype=float)
+        position = float(np.dot(np.cross(orientation[:3], orientation[3:]), np.array(dataset.ImagePositionPatient, dtype=float)))
+    return (instance_number is None, int(instance_number or 0), position, str(dataset.get('SOPInstanceUID', '')))
+
+def sort_dicom_series(dicom_series: List[Dataset]) -> List[Dataset]:
+    '''Sorts in place by InstanceNumber / ImagePositionPatient and returns the list'''
+    dicom_series.sort(key=_get_slice_sort_key)
+    return dicom_series
+
 # Function to load DICOM series from a given path
-def load_dicom_series(dicom_series_path):
-    dicom_series = []
+def load_dicom_series(dicom_series_path, header_only=False, defer_pixels=False, workers=None, use_processes=False):
+    '''
+    Loads every .dcm file under dicom_series_path, sorted with sort_dicom_series.
+    header_only skips the pixel data, which is all highdicom needs from source images to build a SEG.
+    defer_pixels keeps large elements (i.e. the pixel data) on disk until they are accessed.
+    Files are read by a pool of workers (defaults to DICOM_LOAD_WORKERS) threads, or processes with use_processes.
+    '''
+    dicom_file_paths = []
     for root, dirs, files in os.walk(dicom_series_path):
         for file in files:
             if file.endswith(".dcm"):
-                dicom_file_path = os.path.join(root, file)
-                dicom_series.append(pydicom.dcmread(dicom_file_path))
+                dicom_file_paths.append(os.path.join(root, file))
+
+    dicom_series = map_dicom_files(_read_dicom_file, dicom_file_paths, header_only, defer_pixels,
+                                   workers=workers, use_processes=use_processes)
+    return sort_dicom_series(dicom_series)
+
+def get_source_images(dicom_series):
+    '''
+    SEG writers accept either loaded datasets (sorted with sort_dicom_series) or the path of the series.
+    A path is loaded header-only since building a SEG never reads the source pixels.
+    '''
+    if isinstance(dicom_series, str):
+        return load_dicom_series(dicom_series, header_only=True)
     return dicom_series
 
+## RTSTRUCT rasterization
+# rt_utils rebuilds the patient to pixel transform for every ROI, scans every contour for every slice and reads the
+# pixel data of the whole image series only to get its geometry. RTStructRasterizer reads the series headers and
+# computes the transform once, groups contours by slice with the ContourSliceIndex of the patched rt_utils and fills
+# the polygons of each ROI in a pool of RTSTRUCT_WORKERS processes (0 fills them in the calling thread).
+# Masks are the same (columns, rows, slices) booleans, in the same slice order, as RTStruct.get_roi_mask_by_name.
+# get_packed_roi_masks keeps them as the PackedRoiMasks the workers send back, with only the filled slices, bit
+# packed, which is what the RTSTRUCT to SEG conversion uses so that its memory does not grow a volume per ROI.
+
+_DEFAULT_RTSTRUCT_WORKERS = 4
+
+def get_rtstruct_workers():
+    try:
+        return max(0, int(os.environ.get('RTSTRUCT_WORKERS', _DEFAULT_RTSTRUCT_WORKERS)))
+    except ValueError:
+        return _DEFAULT_RTSTRUCT_WORKERS
+
+_RTSTRUCT_POOL = None
+_RTSTRUCT_POOL_LOCK = threading.Lock()
+
+def _get_rtstruct_pool() -> ProcessPoolExecutor:
+    global _RTSTRUCT_POOL
+
+    if _RTSTRUCT_POOL is None:
+        with _RTSTRUCT_POOL_LOCK:
+            if _RTSTRUCT_POOL is None:
+                # spawn, so the workers do not inherit the broker's threads and sockets
+                _RTSTRUCT_POOL = ProcessPoolExecutor(max_workers=max(1, get_rtstruct_workers()),
+                                                     mp_context=multiprocessing.get_context('spawn'))
+
+    return _RTSTRUCT_POOL
+
+def _rasterize_roi(slice_contours, transformation_matrix: np.ndarray, columns: int, rows: int):
+    '''
+    Fills the contours of one ROI slice by slice, the same way as rt_utils' get_slice_mask_from_slice_contour_data.
+    slice_contours is [(slice index, [contour data])]. Returns (slice indices, bit packed (columns, rows) slice masks)
+    so that only the filled slices are sent back from the worker processes.
+    '''
+    slice_indices, packed_slices = [], []
+    for slice_index, contours in slice_contours:
+        try:
+            polygons = []
+            for contour_coords in contours:
+                points = np.reshape(contour_coords, [len(contour_coords) // 3, 3])
+                pixel_points = image_helper.apply_transformation_to_3d_points(points, transformation_matrix)
+                polygon = [np.around([pixel_points[:, :2]]).astype(np.int32)]
+                polygons.append(np.array(polygon).squeeze())
+            slice_mask = np.zeros((columns, rows), dtype=np.uint8)
+            cv.fillPoly(img=slice_mask, pts=polygons, color=1)
+        except Exception:
+            continue # the patched rt_utils leaves slices it cannot fill empty as well
+        slice_indices.append(slice_index)
+        packed_slices.append(np.packbits(slice_mask))
+    return slice_indices, packed_slices
+
+class PackedRoiMask:
+    '''A (columns, rows, slices) bool mask stored as its filled slices, each bit packed with np.packbits'''
+
+    def __init__(self, shape, slice_indices, packed_slices):
+        self.shape = tuple(shape)
+        self.slices = dict(zip(slice_indices, packed_slices))
+
+    @classmethod
+    def from_array(cls, mask: np.ndarray):
+        slice_indices = [slice_index for slice_index in range(mask.shape[2]) if mask[:, :, slice_index].any()]
+        return cls(mask.shape, slice_indices, [np.packbits(mask[:, :, slice_index] > 0) for slice_index in slice_indices])
+
+    def get_slice(self, slice_index: int):
+        '''Returns the (columns, rows) bool mask of a slice, or None if nothing was filled on it'''
+        packed_slice = self.slices.get(slice_index)
+        if packed_slice is None:
+            return None
+        return np.unpackbits(packed_slice, count=self.shape[0] * self.shape[1]).reshape(self.shape[:2]).view(bool)
+
+    def count_voxels(self) -> int:
+        return sum(int(np.count_nonzero(np.unpackbits(packed_slice))) for packed_slice in self.slices.values())
+
+    def to_array(self) -> np.ndarray:
+        mask = np.zeros(self.shape, dtype=bool)
+        for slice_index in self.slices:
+            mask[:, :, slice_index] = self.get_slice(slice_index)
+        return mask
+
+def get_packed_masks_overlap(masks: List[PackedRoiMask]) -> SegmentsOverlapValues:
+    '''Whether a voxel is in more than one of masks, compared slice by slice on the packed bits'''
+    filled = {}
+    for mask in masks:
+        for slice_index, packed_slice in mask.slices.items():
+            if slice_index not in filled:
+                filled[slice_index] = packed_slice.copy()
+            elif np.any(filled[slice_index] & packed_slice):
+                return SegmentsOverlapValues.YES
+            else:
+                filled[slice_index] |= packed_slice
+    return SegmentsOverlapValues.NO
+
+class RTStructRasterizer:
+    '''Rasterizes the ROIs of RTSTRUCTs that were drawn on one image series'''
+
+    def __init__(self, dicom_series_path: str):
+        series_data = load_dicom_series(dicom_series_path, header_only=True)
+        if len(series_data) == 0:
+            raise Exception('No DICOM Images found in input path')
+        series_data.sort(key=image_helper.get_slice_position) # rt_utils' slice order
+
+        self.series_data = series_data
+        self.transformation_matrix = image_helper.get_patient_to_pixel_transformation_matrix(series_data)
+        self.shape = (int(series_data[0].Columns), int(series_data[0].Rows), len(series_data))
+        self._contour_slice_index = monkey_patches.ContourSliceIndex(series_data)
+
+    def get_slice_contours(self, contour_sequence):
+        '''Returns [(slice index, [contour data])] for every slice that has contours, in slice order'''
+        return [(slice_index, [np.asarray(contour_data, dtype=np.float64) for contour_data in contours])
+                for slice_index, contours in self._contour_slice_index.get_contours_by_slice(contour_sequence)]
+
+    def get_roi_masks(self, rt_struct_path: str, roi_names=None) -> Dict[str, np.ndarray]:
+        '''
+        Returns {ROI name: mask} for roi_names (default every ROI) in the order of the StructureSetROISequence.
+        ROIs whose contours cannot be read are left out and logged.
+        '''
+        return { roi_name: mask.to_array() for roi_name, mask in self.get_packed_roi_masks(rt_struct_path, roi_names).items() }
+
+    def get_packed_roi_masks(self, rt_struct_path: str, roi_names=None) -> Dict[str, PackedRoiMask]:
+        '''Same as get_roi_masks, with the masks left packed'''
+        ds = pydicom.dcmread(rt_struct_path)
+        RTStructBuilder.validate_rtstruct(ds)
+        RTStructBuilder.validate_rtstruct_series_references(ds, self.series_data)
+
+        roi_contours, seen = {}, set()
+        for structure_roi in ds.StructureSetROISequence:
+            roi_name = structure_roi.ROIName
+            if roi_name in seen or (roi_names is not None and roi_name not in roi_names):
+                continue
+            seen.add(roi_name) # like rt_utils, only the first ROI with a name is used
+            try:
+                contour_sequence = ds_helper.get_contour_sequence_by_roi_number(ds, structure_roi.ROINumber)
+                roi_contours[roi_name] = self.get_slice_contours(contour_sequence)
+            except Exception as e:
+                print(f'Could not read the contours of {roi_name}: {e}')
+
+        columns, rows, num_slices = self.shape
+        if min(get_rtstruct_workers(), len(roi_contours)) <= 1:
+            results = { name: _rasterize_roi(contours, self.transformation_matrix, columns, rows) for name, contours in roi_contours.items() }
+        else:
+            pool = _get_rtstruct_pool()
+            futures = { name: pool.submit(_rasterize_roi, contours, self.transformation_matrix, columns, rows) for name, contours in roi_contours.items() }
+            results = { name: future.result() for name, future in futures.items() }
+
+        return { roi_name: PackedRoiMask(self.shape, slice_indices, packed_slices)
+                 for roi_name, (slice_indices, packed_slices) in results.items() }
+
+def get_discrepancy_label_map(
+        pred_data: np.ndarray,
+        truth_data: np.ndarray,
+        label_to_roi_numbers: dict,
+        shape: Tuple[int, ...] = None,
+        separate_fp_fn: bool = False,
+        merge_all_rois: bool = False):
+    '''
+    Builds the discrepancy label map of get_non_intersection_mask_to_seg in one pass over the labels.
+    label_to_roi_numbers is {label name: [truth segment number, pred segment number]}, either of which may be None.
+    Each label is only compared inside the union of its boxes in pred and truth, with the comparisons written into
+    buffers that are allocated once for the largest box.
+    The label map has the given shape (truth_data.shape by default); past their ends, pred and truth are background.
+    Returns (label map, label names, voxels per label). There are no discrepancies if the label names are empty.
+    '''
+    non_intersections = np.zeros(truth_data.shape if shape is None else shape, dtype=truth_data.dtype)
+    pred_boxes = get_label_bounding_boxes(pred_data)
+    truth_boxes = get_label_bounding_boxes(truth_data)
+    boxes = [get_union_bounding_box(pred_boxes.get(pred_index), truth_boxes.get(truth_index))
+             for truth_index, pred_index in label_to_roi_numbers.values()]
+
+    buffer_size = max([get_bounding_box_size(box) for box in boxes] + [0])
+    pred_buffer = np.empty(buffer_size, dtype=bool)
+    truth_buffer = np.empty(buffer_size, dtype=bool)
+    diff_buffer = np.empty(buffer_size, dtype=bool)
+
+    label_names, label_counts = [], []
+    written_box = None
+    mask_value = 1
+    for (label_name, (truth_index, pred_index)), box in zip(label_to_roi_numbers.items(), boxes):
+        print('Processing', label_name, pred_index, truth_index)
+        if box is None:
+            continue # the label is empty in both, so there is nothing to compare
+
+        shape = tuple(s.stop - s.start for s in box)
+        size = get_bounding_box_size(box)
+        pred_mask = pred_buffer[:size].reshape(shape)
+        truth_mask = truth_buffer[:size].reshape(shape)
+        diff_mask = diff_buffer[:size].reshape(shape)
+        get_padded_label_mask(pred_data, box, pred_index, out=pred_mask)
+        get_padded_label_mask(truth_data, box, truth_index, out=truth_mask)
+        label_non_intersections = non_intersections[box] # a view, so writes go to non_intersections
+
+        if separate_fp_fn: # false positive vs false negative
+            # for booleans, pred & ~truth is pred > truth and ~pred & truth is pred < truth
+            differences = ((np.greater, ' FP', 1), (np.less, ' FN', 2))
+        else:
+            differences = ((np.not_equal, '', 1),)
+        for compare, suffix, merged_value in differences:
+            compare(pred_mask, truth_mask, out=diff_mask)
+            count = np.count_nonzero(diff_mask)
+            if count == 0:
+                continue
+            np.copyto(label_non_intersections, merged_value if merge_all_rois else mask_value, where=diff_mask, casting='unsafe')
+            written_box = get_union_bounding_box(written_box, box)
+            if not merge_all_rois:
+                mask_value += 1
+                label_names.append(label_name + suffix)
+                label_counts.append(count)
+
+    if merge_all_rois and written_box is not None:
+        # counted on the final map since a later label may overwrite an earlier one where their boxes overlap
+        written = non_intersections[written_box]
+        fp_count = np.count_nonzero(written == 1)
+        fn_count = np.count_nonzero(written == 2)
+        if separate_fp_fn:
+            for name, count in (('False Positives', fp_count), ('False Negatives', fn_count)):
+                if count > 0:
+                    label_names.append(name)
+                    label_counts.append(count)
+        else:
+            label_names.append('Discrepancies')
+            label_counts.append(fp_count + fn_count)
+
+    return non_intersections, label_names, label_counts
+
 def get_non_intersection_mask_to_seg(
-        dicom_series: List[Dataset],
+        dicom_series: List[Dataset] | str,
         pred_data: np.ndarray,
         truth_data: np.ndarray,
         segfile_pred: pydicom.Dataset,
@@ -264,25 +641,21 @@ def get_non_intersection_mask_to_seg(
         output_desc: str = 'Prediction Discrepancy',
         separate_fp_fn: bool = False,
         merge_all_rois: bool = False):
+    '''dicom_series may be a list of datasets or the path of the series'''
+    dicom_series = get_source_images(dicom_series)
 
     print('!!!',pred_data.shape, truth_data.shape)
-    if truth_data.shape != pred_data.shape:
-        print('Padding...')
-        if truth_data.shape[0] < pred_data.shape[0]:
-            # print("not the same size, padding the ground truth to match the image shape")
-            truth_data = pad_ground_truth(truth_data, pred_data.shape)
-        elif truth_data.shape[0] > pred_data.shape[0]:
-            pred_data = pad_ground_truth(pred_data, truth_data.shape)
-
-    if pred_data.shape != truth_data.shape:
-        print(f"Shapes don't match: pred {pred_data.shape}, truth {truth_data.shape}")
+    # the one with fewer slices is compared as if it was padded with empty slices, without copying it
+    pred_shape, truth_shape = get_comparison_shapes(pred_data.shape, truth_data.shape)
+    if pred_shape != truth_shape:
+        print(f"Shapes don't match: pred {pred_shape}, truth {truth_shape}")
         raise ValueError(
             "Prediction and ground truth arrays must have the same shape")
 
     # Create label to ROI mappings for both prediction and truth
     label_to_roi_numbers = {}
 
-    print(pred_data.shape, truth_data.shape)
+    print(pred_shape, truth_shape)
 
     # Get truth labels
     if hasattr(segfile_truth, 'SegmentSequence'):
@@ -301,56 +674,15 @@ def get_non_intersection_mask_to_seg(
 
     # merged_segment_labels = label_to_roi_numbers.keys()
 
-    # non_intersections = np.zeros(shape=(truth_data.shape + (len(label_to_roi_numbers),)))
-    non_intersections = np.zeros_like(truth_data)
-    label_names = []
-    mask_value = 1
-    for index, (label_name, (truth_index, pred_index)) in enumerate(label_to_roi_numbers.items()):
-        print('Processing', label_name, pred_index, truth_index)
-        pred_mask = pred_data == pred_index
-        truth_mask = truth_data == truth_index
-        if separate_fp_fn: # false positive vs false negative
-            fp = pred_mask & (~truth_mask)
-            fn = (~pred_mask) & truth_mask
-            if merge_all_rois:
-                non_intersections[fp] = 1
-                non_intersections[fn] = 2
-            else:
-                if np.count_nonzero(fp) > 0:
-                    non_intersections[fp] = mask_value
-                    mask_value += 1
-                    label_names.append(label_name + ' FP')
-                if np.count_nonzero(fn) > 0:
-                    non_intersections[fn] = mask_value
-                    mask_value += 1
-                    label_names.append(label_name + ' FN')
-        else:
-            diff_mask = pred_mask ^ truth_mask
-            if np.count_nonzero(diff_mask) > 0:
-                non_intersections[diff_mask] = 1 if merge_all_rois else mask_value
-                mask_value += 1
-                label_names.append(label_name)
-
-        # print(' - ', np.count_nonzero(pred_mask), np.count_nonzero(truth_mask), np.count_nonzero(non_intersections == index+1))
+    non_intersections, label_names, label_counts = get_discrepancy_label_map(
+        pred_data, truth_data, label_to_roi_numbers, shape=pred_shape, separate_fp_fn=separate_fp_fn, merge_all_rois=merge_all_rois)
 
-    if np.count_nonzero(non_intersections) == 0:
+    if len(label_names) == 0:
         print('There were no discrepancies between prediction and truth.')
         # TODO: handle this None somehow, probably with a toast
         return None
 
-    if merge_all_rois:
-        label_names = []
-        fp_count = np.count_nonzero(non_intersections == 1)
-        fn_count = np.count_nonzero(non_intersections == 2)
-        if separate_fp_fn:
-            if fp_count > 0:
-                label_names.append('False Positives')
-            if fn_count > 0:
-                label_names.append('False Negatives')
-        else:
-            if fp_count + fn_count > 0:
-                label_names.append('Discrepancies')
-        # label_names = ['False Positive', 'False Negative'] if separate_fp_fn else ['Discrepancies']
+    # label_names = ['False Positive', 'False Negative'] if separate_fp_fn else ['Discrepancies']
     # elif separate_fp_fn:
     #     label_names = reduce(lambda a, c: a + [f'{c} FP', f'{c} FN'], label_names, [])
 
@@ -5,7 +5,7 @@ def process_conversion(dicom_series_path, rt_struct_path, seg_filename):
     masks, valid_roi_names = get_roi_masks(dicom_series_path, rt_struct_path)
     if masks:
         # Step 2: Load DICOM series
-        dicom_series = load_dicom_series(dicom_series_path)
+        dicom_series = load_dicom_series(dicom_series_path, header_only=True)
         #roi_names = list(masks.keys())
 
         # Step 3: Convert mask to DICOM SEG
@@ -1,8 +1,10 @@
 import pydicom
-from typing import Tuple
+from typing import Dict, Optional, Tuple
 import pydicom_seg.reader_utils
 import numpy as np
+from scipy import ndimage
 import traceback
+from mask_cache import get_mask_cache
 
 
 ## deps
@@ -35,65 +37,216 @@ def mp_get_declared_image_spacing(dataset: pydicom.Dataset) -> Tuple[float, floa
 
 pydicom_seg.reader_utils.get_declared_image_spacing = mp_get_declared_image_spacing
 
-def pad_ground_truth(gt_data: np.ndarray, target_shape: Tuple[int, int, int]) -> np.ndarray:
-    current_shape = gt_data.shape
-
-    # Calculate the padding required for each dimension
-    pad_z = (target_shape[0] - current_shape[0]
-             ) if target_shape[0] > current_shape[0] else 0
-    pad_y = (target_shape[1] - current_shape[1]
-             ) if target_shape[1] > current_shape[1] else 0
-    pad_x = (target_shape[2] - current_shape[2]
-             ) if target_shape[2] > current_shape[2] else 0
-
-    # Define the padding for each dimension as (before, after)
-    padding = ((0, pad_z), (0, pad_y), (0, pad_x))
-
-    # Pad the ground truth data with zeros
-    padded_gt_data = np.pad(
-        gt_data, padding, mode='constant', constant_values=0)
-    return padded_gt_data
+## Bounding boxes
+# Organ masks cover a small part of the volume, so per-label work is restricted to the box around the label.
+# A box is a tuple of slices that indexes a (sub-)volume directly, e.g. mask[box].
+
+BoundingBox = Tuple[slice, ...]
+
+def get_mask_bounding_box(mask: np.ndarray) -> Optional[BoundingBox]:
+    '''Returns the box around the non-zero voxels of mask, or None if there are none'''
+    box = []
+    for axis in range(mask.ndim):
+        # only scan the range already found for the previous axes
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        present = np.flatnonzero(np.any(mask[tuple(box) + (slice(None),) * (mask.ndim - len(box))], axis=other_axes))
+        if present.size == 0:
+            return None
+        box.append(slice(int(present[0]), int(present[-1]) + 1))
+    return tuple(box)
+
+def get_union_bounding_box(a: Optional[BoundingBox], b: Optional[BoundingBox]) -> Optional[BoundingBox]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return tuple(slice(min(sa.start, sb.start), max(sa.stop, sb.stop)) for sa, sb in zip(a, b))
+
+def get_bounding_box_size(box: Optional[BoundingBox]) -> int:
+    return 0 if box is None else int(np.prod([s.stop - s.start for s in box]))
+
+# Slices per slab when scanning a label map, which bounds the size of the temporary label codes
+_BOUNDING_BOX_SLAB_SIZE = 16
+
+def get_label_bounding_boxes(label_map: np.ndarray) -> Dict[int, BoundingBox]:
+    '''
+    Returns {label: box} for every non-zero label of a 3D label map, computed in one scan of the labelled region.
+    The presence of each label at each position along each axis is counted with bincount on (position, label) codes.
+    '''
+    outer_box = get_mask_bounding_box(label_map)
+    if outer_box is None:
+        return {}
+
+    cropped = label_map[outer_box]
+    num_labels = int(cropped.max()) + 1
+    presence = [np.zeros((cropped.shape[axis], num_labels), dtype=bool) for axis in range(3)]
+    for start in range(0, cropped.shape[0], _BOUNDING_BOX_SLAB_SIZE):
+        slab = cropped[start:start + _BOUNDING_BOX_SLAB_SIZE].astype(np.intp)
+        for axis in range(3):
+            position_shape = [1, 1, 1]
+            position_shape[axis] = slab.shape[axis]
+            positions = np.arange(slab.shape[axis], dtype=np.intp).reshape(position_shape)
+            codes = positions * num_labels + slab
+            present = np.bincount(codes.reshape(-1), minlength=slab.shape[axis] * num_labels).reshape(-1, num_labels) > 0
+            if axis == 0:
+                presence[0][start:start + slab.shape[0]] |= present
+            else:
+                presence[axis] |= present
+
+    boxes = {}
+    for label in range(1, num_labels):
+        box = []
+        for axis in range(3):
+            present = np.flatnonzero(presence[axis][:, label])
+            if present.size == 0:
+                break
+            offset = outer_box[axis].start
+            box.append(slice(offset + int(present[0]), offset + int(present[-1]) + 1))
+        else:
+            boxes[label] = tuple(box)
+    return boxes
+
+## Implicit padding
+# SEGs saved with omit_empty_frames decode to fewer slices than the image series, so prediction and truth often
+# differ in slice count. Instead of padding copies with np.pad, volumes are compared in a common shape in which
+# every voxel past the end of an array is background. Only the region covered by an array is ever read.
+
+def get_padded_shape(shape: Tuple[int, ...], target_shape: Tuple[int, ...]) -> Tuple[int, ...]:
+    '''Shape of shape padded at the end of each axis up to target_shape'''
+    return tuple(max(size, target_size) for size, target_size in zip(shape, target_shape))
+
+def get_comparison_shapes(pred_shape: Tuple[int, ...], truth_shape: Tuple[int, ...], num_slices: int = 0):
+    '''
+    Returns the (pred, truth) shapes after padding the one with fewer slices to the other,
+    and both to at least num_slices slices. The shapes still differ if rows or columns do not match.
+    '''
+    if truth_shape[0] < pred_shape[0]:
+        pred_shape = get_padded_shape(pred_shape, (num_slices,) + tuple(pred_shape[1:]))
+        truth_shape = get_padded_shape(truth_shape, pred_shape)
+    elif truth_shape[0] > pred_shape[0]:
+        truth_shape = get_padded_shape(truth_shape, (num_slices,) + tuple(truth_shape[1:]))
+        pred_shape = get_padded_shape(pred_shape, truth_shape)
+    return tuple(pred_shape), tuple(truth_shape)
+
+def _clip_box(box: BoundingBox, shape: Tuple[int, ...]) -> BoundingBox:
+    return tuple(slice(min(s.start, size), min(s.stop, size)) for s, size in zip(box, shape))
+
+def _get_outside_boxes(box: BoundingBox, shape: Tuple[int, ...]):
+    '''Splits the part of box that is outside of shape into disjoint boxes'''
+    outside_boxes = []
+    inside = list(box)
+    for axis, size in enumerate(shape):
+        if inside[axis].stop > size:
+            outside = list(inside)
+            outside[axis] = slice(max(inside[axis].start, size), inside[axis].stop)
+            outside_boxes.append(tuple(outside))
+            inside[axis] = slice(min(inside[axis].start, size), size)
+    return outside_boxes
+
+def get_padded_label_mask(label_map: np.ndarray, box: BoundingBox, label: Optional[int], out: np.ndarray = None) -> np.ndarray:
+    '''label_map[box] == label, where the part of box past the end of label_map is background. label may be None'''
+    shape = tuple(s.stop - s.start for s in box)
+    if out is None:
+        out = np.empty(shape, dtype=bool)
+    inside = _clip_box(box, label_map.shape)
+    inside_shape = tuple(s.stop - s.start for s in inside)
+    if label is None or 0 in inside_shape:
+        out.fill(False)
+    elif inside_shape == shape:
+        np.equal(label_map[box], label, out=out)
+    else:
+        out.fill(False)
+        np.equal(label_map[inside], label, out=out[tuple(slice(0, size) for size in inside_shape)])
+    return out
 
+# Voxels per bincount call. Small enough that the label codes of a chunk stay in cache
+_HISTOGRAM_CHUNK_SIZE = 1 << 20
 
-def calculate_dice_scores(pred_data: np.ndarray,
-                          truth_data: np.ndarray,
-                          segfile_pred: pydicom.Dataset,
-                          segfile_truth: pydicom.Dataset):
+def get_joint_label_histogram(pred_data: np.ndarray, truth_data: np.ndarray) -> np.ndarray:
     """
-    Args:
-        pred_data: Predicted segmentation array
-        truth_data: Ground truth segmentation array
-        segfile_pred: DICOM dataset containing prediction segment information
-        segfile_truth: DICOM dataset containing ground truth segment information
-
-    Returns:
-        DICE scores for each ROI
+    Counts the voxels of every (pred label, truth label) pair in a single pass over both label maps.
+    joint[p, t] is the number of voxels labelled p in pred_data and t in truth_data,
+    so joint.sum(axis=1) and joint.sum(axis=0) are the per-label voxel counts of pred and truth.
     """
     if pred_data.shape != truth_data.shape:
-        print(f"Shapes don't match: pred {pred_data.shape}, truth {truth_data.shape}")
-        raise ValueError(
-            "Prediction and ground truth arrays must have the same shape")
-
-        # Create ROI to label mappings for both prediction and truth
-    roi_to_label_pred = {}
-    roi_to_label_truth = {}
-
-    # Get truth labels
-    if hasattr(segfile_truth, 'SegmentSequence'):
-        for segment in segfile_truth.SegmentSequence:
-            roi_to_label_truth[segment.SegmentNumber] = segment.SegmentLabel
-
-    # Get prediction labels (assuming they're in the same structure)
-    if hasattr(segfile_pred, 'SegmentSequence'):
-        for segment in segfile_pred.SegmentSequence:
-            roi_to_label_pred[segment.SegmentNumber] = segment.SegmentLabel
-
-    # print("roi_to_label_truth ->")
-    # print(roi_to_label_truth)
-    # print("roi_to_label_pred ->")
-    # print(roi_to_label_pred)
+        raise ValueError("Prediction and ground truth arrays must have the same shape")
+
+    pred_flat = pred_data.reshape(-1)
+    truth_flat = truth_data.reshape(-1)
+    joint = np.zeros((1, 1), dtype=np.int64)
+    for start in range(0, pred_flat.size, _HISTOGRAM_CHUNK_SIZE):
+        pred_chunk = pred_flat[start:start + _HISTOGRAM_CHUNK_SIZE].astype(np.intp)
+        truth_chunk = truth_flat[start:start + _HISTOGRAM_CHUNK_SIZE].astype(np.intp)
+        num_pred_labels = int(pred_chunk.max()) + 1
+        num_truth_labels = int(truth_chunk.max()) + 1
+
+        # combine both labels into one code so that one bincount gives the joint histogram
+        pred_chunk *= num_truth_labels
+        pred_chunk += truth_chunk
+        counts = np.bincount(pred_chunk, minlength=num_pred_labels * num_truth_labels)
+        counts = counts.reshape(num_pred_labels, num_truth_labels)
+
+        if counts.shape[0] > joint.shape[0] or counts.shape[1] > joint.shape[1]:
+            grown = np.zeros((max(joint.shape[0], counts.shape[0]), max(joint.shape[1], counts.shape[1])), dtype=np.int64)
+            grown[:joint.shape[0], :joint.shape[1]] = joint
+            joint = grown
+        joint[:counts.shape[0], :counts.shape[1]] += counts
+
+    return joint
+
+def _add_background_counts(joint: np.ndarray, counts: np.ndarray, is_pred: bool) -> np.ndarray:
+    '''Adds label counts of pred (truth) where the other volume is background, i.e. to joint[:, 0] (joint[0, :])'''
+    rows, columns = joint.shape
+    if is_pred:
+        rows = max(rows, counts.size)
+    else:
+        columns = max(columns, counts.size)
+    if (rows, columns) != joint.shape:
+        grown = np.zeros((rows, columns), dtype=np.int64)
+        grown[:joint.shape[0], :joint.shape[1]] = joint
+        joint = grown
+    if is_pred:
+        joint[:counts.size, 0] += counts
+    else:
+        joint[0, :counts.size] += counts
+    return joint
+
+def get_padded_joint_label_histogram(pred_data: np.ndarray, truth_data: np.ndarray, box: BoundingBox) -> np.ndarray:
+    '''
+    get_joint_label_histogram of pred_data[box] and truth_data[box] for volumes of different shapes,
+    where everything past the end of a volume is background. Voxels of box outside both volumes are not counted.
+    '''
+    common = _clip_box(box, np.minimum(pred_data.shape, truth_data.shape))
+    if get_bounding_box_size(common) > 0:
+        joint = get_joint_label_histogram(pred_data[common], truth_data[common])
+    else:
+        joint = np.zeros((1, 1), dtype=np.int64)
+
+    # past the end of the shorter volume along some axis at most one of the volumes has voxels
+    for outside in _get_outside_boxes(box, np.minimum(pred_data.shape, truth_data.shape)):
+        for label_map, is_pred in ((pred_data, True), (truth_data, False)):
+            inside = _clip_box(outside, label_map.shape)
+            if get_bounding_box_size(inside) > 0:
+                joint = _add_background_counts(joint, np.bincount(label_map[inside].reshape(-1)), is_pred)
+    return joint
+
+def _get_roi_to_label(segfile: pydicom.Dataset):
+    roi_to_label = {}
+    if hasattr(segfile, 'SegmentSequence'):
+        for segment in segfile.SegmentSequence:
+            roi_to_label[segment.SegmentNumber] = segment.SegmentLabel
+    return roi_to_label
+
+def get_matched_rois(segfile_pred: pydicom.Dataset, segfile_truth: pydicom.Dataset):
+    """
+    Pairs every prediction ROI with the truth ROI of the same label.
+    Returns [(pred_label, pred_roi, truth_roi or None)] in the order of the prediction SegmentSequence.
+    """
+    roi_to_label_pred = _get_roi_to_label(segfile_pred)
+    roi_to_label_truth = _get_roi_to_label(segfile_truth)
 
     # Create mapping of truth ROI numbers to pred ROI numbers based on matching labels
+    # (the first pred ROI with the label wins, as it always has)
     truth_to_pred_roi = {}
     for truth_roi, truth_label in roi_to_label_truth.items():
         for pred_roi, pred_label in roi_to_label_pred.items():
@@ -101,53 +254,235 @@ def calculate_dice_scores(pred_data: np.ndarray,
                 truth_to_pred_roi[truth_roi] = pred_roi
                 break
 
-    # print("Mapped ROIs (truth_roi: pred_roi) ->")
-    # print(truth_to_pred_roi)
+    pred_to_truth_roi = {}
+    for truth_roi, pred_roi in truth_to_pred_roi.items():
+        pred_to_truth_roi.setdefault(pred_roi, truth_roi)
 
-    dice_scores = {}
+    return [(pred_label, pred_roi, pred_to_truth_roi.get(pred_roi)) for pred_roi, pred_label in roi_to_label_pred.items()]
 
-    # Calculate dice scores for all prediction ROIs
-    for pred_roi, pred_label in roi_to_label_pred.items():
-        pred_flat = (pred_data == pred_roi).flatten()
+def _get_count(counts: np.ndarray, index):
+    return int(counts[index]) if index is not None and 0 <= index < counts.shape[0] else 0
 
-        # Find if there's a corresponding truth ROI
-        matching_truth_roi = None
-        for truth_roi, mapped_pred_roi in truth_to_pred_roi.items():
-            if mapped_pred_roi == pred_roi:
-                matching_truth_roi = truth_roi
-                break
+def calculate_overlap_counts(pred_data: np.ndarray,
+                             truth_data: np.ndarray,
+                             segfile_pred: pydicom.Dataset,
+                             segfile_truth: pydicom.Dataset,
+                             shape: Tuple[int, ...] = None):
+    """
+    Computes DICE with true positive, false positive and false negative voxel counts for every prediction ROI,
+    from one joint label histogram instead of one pass over the volumes per ROI.
+    The volumes are compared in shape (pred_data.shape by default), past their ends they are background.
+    Returns {label: {'dice', 'tp', 'fp', 'fn'}} in the order of the prediction SegmentSequence.
+    """
+    if shape is None:
+        shape = pred_data.shape
+    # only the box around the labels of either volume is scanned; everything outside it is background in both
+    box = get_union_bounding_box(get_mask_bounding_box(pred_data), get_mask_bounding_box(truth_data))
+    if box is None:
+        joint = np.zeros((1, 1), dtype=np.int64)
+    elif pred_data.shape == truth_data.shape:
+        joint = get_joint_label_histogram(pred_data[box], truth_data[box])
+    else:
+        joint = get_padded_joint_label_histogram(pred_data, truth_data, box)
+    joint[0, 0] += int(np.prod(shape, dtype=np.int64)) - joint.sum()
+    pred_counts = joint.sum(axis=1)
+    truth_counts = joint.sum(axis=0)
+
+    results = {}
+    for pred_label, pred_roi, truth_roi in get_matched_rois(segfile_pred, segfile_truth):
+        pred_count = _get_count(pred_counts, pred_roi)
+        if truth_roi is None:
+            # No matching ROI in truth data
+            results[pred_label] = { 'dice': 0.0, 'tp': 0, 'fp': pred_count, 'fn': 0 }
+            continue
+
+        truth_count = _get_count(truth_counts, truth_roi)
+        intersection = int(joint[pred_roi, truth_roi]) if pred_roi < joint.shape[0] and truth_roi < joint.shape[1] else 0
+        total = pred_count + truth_count
+        dice_score = 0.0 if total == 0 else (2.0 * intersection) / total
+
+        results[pred_label] = {
+            'dice': float(dice_score),
+            'tp': intersection,
+            'fp': pred_count - intersection,
+            'fn': truth_count - intersection,
+        }
+
+    return results
+
+## Surface and volume metrics
+# DICE comes from the joint histogram and is always returned. The other metrics are only computed when requested:
+#  - hd95: 95th percentile Hausdorff distance in mm (the larger of the two directed 95th percentiles)
+#  - asd: average symmetric surface distance in mm
+#  - surface_dice: fraction of both surfaces within surface_tolerance mm of the other surface
+#  - volume_difference: relative volume error (pred - truth) / truth
+# Distances are None when either mask of a label is empty.
+
+AVAILABLE_METRICS = ('dice', 'hd95', 'asd', 'surface_dice', 'volume_difference')
+_SURFACE_METRICS = ('hd95', 'asd', 'surface_dice')
+DEFAULT_SURFACE_TOLERANCE = 1.0 # mm
+
+def get_voxel_spacing(segfile: pydicom.Dataset) -> Tuple[float, float, float]:
+    '''
+    Returns the (slice, row, column) spacing in mm of a SEG, in the axis order of the decoded mask.
+    Read from the PixelMeasuresSequence; seg_to_mask overwrites the top level SliceThickness, so it is not used.
+    '''
+    try:
+        pixel_measures = segfile.SharedFunctionalGroupsSequence[0].PixelMeasuresSequence[0]
+    except (AttributeError, IndexError, KeyError):
+        return 1.0, 1.0, 1.0
+
+    row_spacing, column_spacing = pixel_measures.PixelSpacing
+    slice_spacing = pixel_measures.get('SpacingBetweenSlices') or pixel_measures.get('SliceThickness') or 1.0
+    return abs(float(slice_spacing)), float(row_spacing), float(column_spacing)
+
+def _get_surface(mask: np.ndarray) -> np.ndarray:
+    # voxels on the edge of the box count as surface, which is right because the box is tight around both masks
+    return mask & ~ndimage.binary_erosion(mask, border_value=0)
+
+def calculate_surface_metrics(pred_mask: np.ndarray, truth_mask: np.ndarray, spacing, metrics, surface_tolerance=DEFAULT_SURFACE_TOLERANCE):
+    '''
+    Computes the requested surface metrics of one label from two boolean masks.
+    The masks should already be cropped to the union of their bounding boxes: every surface voxel
+    is inside the crop, so distance transforms over the crop give the same distances as over the volume.
+    '''
+    results = {metric: None for metric in metrics}
+    pred_surface = _get_surface(pred_mask)
+    truth_surface = _get_surface(truth_mask)
+    if not pred_surface.any() or not truth_surface.any():
+        return results
+
+    pred_to_truth = ndimage.distance_transform_edt(~truth_surface, sampling=spacing)[pred_surface]
+    truth_to_pred = ndimage.distance_transform_edt(~pred_surface, sampling=spacing)[truth_surface]
+
+    if 'hd95' in metrics:
+        results['hd95'] = float(max(np.percentile(pred_to_truth, 95), np.percentile(truth_to_pred, 95)))
+    if 'asd' in metrics:
+        results['asd'] = float((pred_to_truth.sum() + truth_to_pred.sum()) / (pred_to_truth.size + truth_to_pred.size))
+    if 'surface_dice' in metrics:
+        within_tolerance = np.count_nonzero(pred_to_truth <= surface_tolerance) + np.count_nonzero(truth_to_pred <= surface_tolerance)
+        results['surface_dice'] = float(within_tolerance / (pred_to_truth.size + truth_to_pred.size))
+    return results
+
+def calculate_label_metrics(pred_data: np.ndarray,
+                            truth_data: np.ndarray,
+                            segfile_pred: pydicom.Dataset,
+                            segfile_truth: pydicom.Dataset,
+                            overlap_counts: dict,
+                            metrics,
+                            spacing=None,
+                            surface_tolerance=DEFAULT_SURFACE_TOLERANCE):
+    '''
+    Returns {label: {metric: value}} for the requested metrics other than DICE.
+    overlap_counts is the result of calculate_overlap_counts for the same volumes.
+    '''
+    surface_metrics = [metric for metric in metrics if metric in _SURFACE_METRICS]
+    if spacing is None:
+        spacing = get_voxel_spacing(segfile_truth if hasattr(segfile_truth, 'SharedFunctionalGroupsSequence') else segfile_pred)
+
+    pred_boxes, truth_boxes = {}, {}
+    if len(surface_metrics) > 0:
+        pred_boxes = get_label_bounding_boxes(pred_data)
+        truth_boxes = get_label_bounding_boxes(truth_data)
+
+    results = {}
+    for pred_label, pred_roi, truth_roi in get_matched_rois(segfile_pred, segfile_truth):
+        label_results = {}
+        if 'volume_difference' in metrics:
+            counts = overlap_counts[pred_label]
+            truth_volume = counts['tp'] + counts['fn']
+            pred_volume = counts['tp'] + counts['fp']
+            label_results['volume_difference'] = None if truth_roi is None or truth_volume == 0 else (pred_volume - truth_volume) / truth_volume
+
+        if len(surface_metrics) > 0:
+            box = get_union_bounding_box(pred_boxes.get(pred_roi), truth_boxes.get(truth_roi) if truth_roi is not None else None)
+            if truth_roi is None or box is None:
+                label_results.update({metric: None for metric in surface_metrics})
+            else:
+                label_results.update(calculate_surface_metrics(get_padded_label_mask(pred_data, box, pred_roi),
+                                                               get_padded_label_mask(truth_data, box, truth_roi),
+                                                               spacing, surface_metrics, surface_tolerance))
 
-        if matching_truth_roi is not None:
-            # Calculate dice score with matching truth ROI
-            truth_flat = (truth_data == matching_truth_roi).flatten()
+        results[pred_label] = label_results
 
-            intersection = np.sum(pred_flat & truth_flat)
-            total = np.sum(pred_flat) + np.sum(truth_flat)
+    return results
 
-            if total == 0:
-                dice_score = 0.0
-            else:
-                dice_score = (2.0 * intersection) / total
-        else:
-            # No matching ROI in truth data
-            dice_score = 0.0
+def validate_metrics(metrics):
+    '''Returns the list of requested metrics, raising ValueError for unknown ones'''
+    if metrics is None:
+        return ['dice']
+    if isinstance(metrics, str):
+        metrics = [metrics]
+    unknown = [metric for metric in metrics if metric not in AVAILABLE_METRICS]
+    if len(unknown) > 0:
+        raise ValueError(f'Unknown metrics: {", ".join(unknown)}. Available metrics are {", ".join(AVAILABLE_METRICS)}.')
+    return list(metrics)
 
-        dice_scores[pred_label] = float(dice_score)
+def calculate_dice_scores(pred_data: np.ndarray,
+                          truth_data: np.ndarray,
+                          segfile_pred: pydicom.Dataset,
+                          segfile_truth: pydicom.Dataset,
+                          include_counts: bool = False,
+                          metrics=None,
+                          spacing=None,
+                          surface_tolerance=DEFAULT_SURFACE_TOLERANCE,
+                          shape=None):
+    """
+    Args:
+        pred_data: Predicted segmentation array
+        truth_data: Ground truth segmentation array
+        segfile_pred: DICOM dataset containing prediction segment information
+        segfile_truth: DICOM dataset containing ground truth segment information
+        include_counts: Also add the tp, fp and fn voxel counts of each ROI
+        metrics: Metrics from AVAILABLE_METRICS to add to each ROI besides DICE
+        spacing: (slice, row, column) voxel spacing in mm, read from the SEGs by default
+        surface_tolerance: Tolerance in mm for surface_dice
+        shape: Shape to compare the arrays in when they differ, past their ends they are background (see get_comparison_shapes)
 
-    # dice_scores is in the form of {'Liver': 0.8906308112413376, 'Stomach': 0.9276701174292482, 'Duodenum': 0.9404155757022683, 'Inferior Vena Cava': 0.7494568578632709, 'Left Kidney': 0.0, 'Right Kidney': 0.9141375614824105, 'Aorta': 0.0, 'Left Adrenal Gland': 0.0, 'Right Adrenal Gland': 0.0, 'Gallbladder': 0.0, 'Esophagus': 0.8972954467648065, 'Pancreas': 0.8069919883466861}
-    dice_scores_list = [{"label":key, "value":value} for key, value in dice_scores.items()]
-    # print(dice_scores_list)
-    # return dice_scores
+    Returns:
+        DICE scores (and the requested metrics) for each ROI
+    """
+    if shape is None:
+        if pred_data.shape != truth_data.shape:
+            print(f"Shapes don't match: pred {pred_data.shape}, truth {truth_data.shape}")
+            raise ValueError(
+                "Prediction and ground truth arrays must have the same shape")
+        shape = pred_data.shape
+
+    overlap_counts = calculate_overlap_counts(pred_data, truth_data, segfile_pred, segfile_truth, shape=shape)
+    extra_metrics = [metric for metric in validate_metrics(metrics) if metric != 'dice']
+    label_metrics = {}
+    if len(extra_metrics) > 0:
+        label_metrics = calculate_label_metrics(pred_data, truth_data, segfile_pred, segfile_truth, overlap_counts,
+                                                extra_metrics, spacing=spacing, surface_tolerance=surface_tolerance)
+
+    # dice_scores_list is in the form of [{'label': 'Liver', 'value': 0.8906308112413376}, {'label': 'Stomach', 'value': 0.9276701174292482}, ...]
+    dice_scores_list = []
+    for label, counts in overlap_counts.items():
+        dice_score = {"label": label, "value": counts['dice']}
+        if include_counts:
+            dice_score.update(tp=counts['tp'], fp=counts['fp'], fn=counts['fn'])
+        dice_score.update(label_metrics.get(label, {}))
+        dice_scores_list.append(dice_score)
     return dice_scores_list
 
-def seg_to_mask(seg_path, slice_thickness=1):
+def decode_seg(seg_path, slice_thickness=1):
+    '''Decodes a SEG with pydicom_seg, bypassing the mask cache'''
     seg_series = pydicom.dcmread(seg_path)
     seg_series.add(pydicom.DataElement(('0018', '0050'), 'DS', slice_thickness)) # set SliceThickness property
     reader = pydicom_seg.MultiClassReader()
     seg_mask = reader.read(seg_series).data
     return seg_mask, seg_series
 
-def seg_mask_dice(num_dicom_instances, pred_path, truth_path):
+def seg_to_mask(seg_path, slice_thickness=1):
+    '''
+    Returns the label volume of a SEG and a dataset with its SegmentSequence and PixelMeasuresSequence.
+    Decoded masks are reused from the mask cache, keyed by SOPInstanceUID.
+    '''
+    return get_mask_cache().get(seg_path, lambda path: decode_seg(path, slice_thickness=slice_thickness))
+
+def seg_mask_dice(num_dicom_instances, pred_path, truth_path, include_counts=False, metrics=None, surface_tolerance=DEFAULT_SURFACE_TOLERANCE):
+    metric_options = { 'include_counts': include_counts, 'metrics': metrics, 'surface_tolerance': surface_tolerance }
 
     # print("hello I AM IN SEG_MASK_DICE ")
     # print("pred_path -> " + pred_path)
@@ -187,22 +522,21 @@ def seg_mask_dice(num_dicom_instances, pred_path, truth_path):
     if pred_data is None and truth_data is None:
         return []
 
+    # a missing mask is an empty array that is background everywhere in the shape of the other one
     if pred_data is None and truth_data is not None:
-        return calculate_dice_scores(np.zeros_like(truth_data), truth_data, {}, dcm_truth)
+        return calculate_dice_scores(np.zeros((0,) * truth_data.ndim, dtype=truth_data.dtype), truth_data, {}, dcm_truth,
+                                     shape=truth_data.shape, **metric_options)
 
     if truth_data is None and pred_data is not None:
-        return calculate_dice_scores(pred_data, np.zeros_like(pred_data), dcm_pred, {})
-
-    if truth_data.shape != pred_data.shape:
-        if truth_data.shape[0] < pred_data.shape[0]:
-            # print("not the same size, padding the ground truth to match the image shape")
-            if pred_data.shape[0] < num_dicom_instances:
-                pred_data = pad_ground_truth(pred_data, (num_dicom_instances, pred_data.shape[1], pred_data.shape[2]))
-            truth_data = pad_ground_truth(truth_data, pred_data.shape)
-        elif truth_data.shape[0] > pred_data.shape[0]:
-            if truth_data.shape[0] < num_dicom_instances:
-                truth_data = pad_ground_truth(truth_data, (num_dicom_instances, truth_data.shape[1], truth_data.shape[2]))
-            pred_data = pad_ground_truth(pred_data, truth_data.shape)
+        return calculate_dice_scores(pred_data, np.zeros((0,) * pred_data.ndim, dtype=pred_data.dtype), dcm_pred, {},
+                                     shape=pred_data.shape, **metric_options)
+
+    # the one with fewer slices (e.g. saved with omit_empty_frames) is compared as if it was padded with empty slices
+    pred_shape, truth_shape = get_comparison_shapes(pred_data.shape, truth_data.shape, num_dicom_instances)
+    if pred_shape != truth_shape:
+        print(f"Shapes don't match: pred {pred_shape}, truth {truth_shape}")
+        raise ValueError(
+            "Prediction and ground truth arrays must have the same shape")
 
     # print("after pad")
     # print(truth_data.shape)
@@ -210,7 +544,7 @@ def seg_mask_dice(num_dicom_instances, pred_path, truth_path):
 
     # print("DICE SCORES")
     dice_scores = calculate_dice_scores(
-        pred_data, truth_data, dcm_pred, dcm_truth)
+        pred_data, truth_data, dcm_pred, dcm_truth, shape=pred_shape, **metric_options)
 
     # print(dice_scores)
     return dice_scores
@@ -0,0 +1,206 @@
+## Persistent on-disk cache of DICOM series, keyed by SeriesInstanceUID
+# Predictions, DICE scores and discrepancy masks are usually run on the same studies over and over,
+# so series are kept under CACHE_DIRECTORY/series/<SeriesInstanceUID>/ instead of being downloaded for every job.
+# An entry is reused only while Orthanc's LastUpdate and instance count for the series are unchanged.
+# Entries in use by a job are reference counted and never evicted; the rest are evicted least recently used first
+# once the cache is larger than SERIES_CACHE_SIZE_MB.
+# Series are fetched like get_dicom_series_by_id does: ORTHANC_DOWNLOAD_WORKERS instances at a time, or, with 0, by
+# streaming the series archive (falling back to instance downloads for archives that cannot be streamed).
+
+import os
+import json
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import pyorthanc
+from orthanc_client import get_orthanc_client
+from orthanc_functions import download_series_instances, get_download_workers, stream_series_archive, UnsupportedZipMemberError
+
+_DEFAULT_MAX_SIZE_MB = 10240
+_ENTRY_METADATA_FILENAME = 'entry.json'
+_TEMP_PREFIX = '.tmp-'
+
+class CachedSeries:
+    def __init__(self, series_instance_uid: str, path: str, series, size: int, last_update: str, instance_count: int):
+        self.series_instance_uid = series_instance_uid
+        self.path = path            # directory containing the instance files
+        self.series = series        # pyorthanc Series, or None for entries loaded from disk
+        self.size = size
+        self.last_update = last_update
+        self.instance_count = instance_count
+        self.last_access = time.time()
+        self.references = 0
+
+    def files(self):
+        '''Sorted paths of the instance files of this series'''
+        return [os.path.join(self.path, f) for f in sorted(os.listdir(self.path)) if f.endswith('.dcm')]
+
+class SeriesCache:
+    def __init__(self, root: str, max_bytes: int):
+        self._root = root
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._series_locks = {}
+        self._entries = {}
+        os.makedirs(root, exist_ok=True)
+        self._load_entries()
+
+    def _load_entries(self):
+        for name in os.listdir(self._root):
+            entry_dir = os.path.join(self._root, name)
+            if name.startswith(_TEMP_PREFIX):
+                shutil.rmtree(entry_dir, ignore_errors=True) # interrupted download
+                continue
+
+            metadata_path = os.path.join(entry_dir, _ENTRY_METADATA_FILENAME)
+            try:
+                with open(metadata_path, 'r') as f:
+                    metadata = json.load(f)
+                entry = CachedSeries(name, os.path.join(entry_dir, 'instances'), None,
+                                     metadata['size'], metadata['last_update'], metadata['instance_count'])
+                entry.last_access = os.path.getmtime(metadata_path)
+                self._entries[name] = entry
+            except Exception as e:
+                print('Removing unreadable series cache entry', entry_dir, e)
+                shutil.rmtree(entry_dir, ignore_errors=True)
+
+        print('Series cache has', len(self._entries), 'entries in', self._root)
+
+    def _get_series_lock(self, series_instance_uid: str) -> threading.Lock:
+        with self._lock:
+            return self._series_locks.setdefault(series_instance_uid, threading.Lock())
+
+    @contextmanager
+    def acquire(self, series_instance_uid: str, progress_callback=None):
+        '''Context manager around checkout() and release()'''
+        entry = self.checkout(series_instance_uid, progress_callback=progress_callback)
+        try:
+            yield entry
+        finally:
+            self.release(entry)
+
+    def checkout(self, series_instance_uid: str, progress_callback=None) -> CachedSeries:
+        '''
+        Returns a CachedSeries whose files stay on disk until release() is called with it.
+        The series is downloaded from Orthanc first if it is not cached or has changed since it was cached.
+        '''
+        return self._get_or_download(series_instance_uid, progress_callback=progress_callback)
+
+    def release(self, entry: CachedSeries):
+        with self._lock:
+            entry.references -= 1
+            is_stale = self._entries.get(entry.series_instance_uid) is not entry
+        if is_stale and entry.references <= 0:
+            shutil.rmtree(os.path.dirname(entry.path), ignore_errors=True)
+        self._evict()
+
+    def _get_or_download(self, series_instance_uid: str, progress_callback=None) -> CachedSeries:
+        valid_series = pyorthanc.find_series(get_orthanc_client(), query={'SeriesInstanceUID': series_instance_uid})
+        if len(valid_series) == 0:
+            raise Exception('No series found with UID:', series_instance_uid)
+        a_series = valid_series[0]
+        info = a_series.get_main_information()
+        last_update, instance_count = info.get('LastUpdate'), len(info.get('Instances', []))
+
+        with self._get_series_lock(series_instance_uid):
+            with self._lock:
+                entry = self._entries.get(series_instance_uid)
+                if entry is not None and entry.last_update == last_update and entry.instance_count == instance_count:
+                    entry.references += 1
+                    entry.last_access = time.time()
+                    entry.series = a_series
+                    self._touch(entry)
+                    print('Series cache hit for', series_instance_uid)
+                    return entry
+
+            print('Series cache miss for', series_instance_uid)
+            temp_dir = os.path.join(self._root, f'{_TEMP_PREFIX}{uuid.uuid4().hex}')
+            try:
+                file_paths = self._download(a_series, os.path.join(temp_dir, 'instances'), progress_callback)
+                size = sum(os.path.getsize(p) for p in file_paths)
+                with open(os.path.join(temp_dir, _ENTRY_METADATA_FILENAME), 'w') as f:
+                    json.dump({'size': size, 'last_update': last_update, 'instance_count': instance_count}, f)
+            except Exception:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                raise
+
+            entry_dir = os.path.join(self._root, series_instance_uid)
+            with self._lock:
+                stale = self._entries.pop(series_instance_uid, None)
+                if stale is not None and stale.references > 0:
+                    # a job is still reading the outdated files, so move them aside; release() deletes them
+                    stale_dir = os.path.join(self._root, f'{_TEMP_PREFIX}{uuid.uuid4().hex}')
+                    os.replace(entry_dir, stale_dir)
+                    stale.path = os.path.join(stale_dir, 'instances')
+                elif os.path.exists(entry_dir):
+                    shutil.rmtree(entry_dir)
+                os.replace(temp_dir, entry_dir)
+
+                entry = CachedSeries(series_instance_uid, os.path.join(entry_dir, 'instances'), a_series, size, last_update, instance_count)
+                entry.references = 1
+                self._entries[series_instance_uid] = entry
+
+        self._evict()
+        return entry
+
+    def _download(self, a_series, instances_dir: str, progress_callback=None):
+        '''Fetches the instance files of a_series into instances_dir (no subdirectories) and returns their paths'''
+        download_workers = get_download_workers()
+        if download_workers > 0:
+            return download_series_instances(a_series, instances_dir, max_workers=download_workers, progress_callback=progress_callback)
+        try:
+            return stream_series_archive(a_series, instances_dir, flatten=True)
+        except UnsupportedZipMemberError as e:
+            print(f'{e}, downloading the instances one by one instead')
+            return download_series_instances(a_series, instances_dir, progress_callback=progress_callback)
+
+    def _touch(self, entry: CachedSeries):
+        try:
+            os.utime(os.path.join(self._root, entry.series_instance_uid, _ENTRY_METADATA_FILENAME))
+        except OSError:
+            pass
+
+    def _evict(self):
+        with self._lock:
+            total = sum(e.size for e in self._entries.values())
+            if total <= self._max_bytes:
+                return
+
+            for entry in sorted(self._entries.values(), key=lambda e: e.last_access):
+                if total <= self._max_bytes:
+                    break
+                if entry.references > 0:
+                    continue
+                print('Evicting', entry.series_instance_uid, 'from the series cache')
+                del self._entries[entry.series_instance_uid]
+                shutil.rmtree(os.path.join(self._root, entry.series_instance_uid), ignore_errors=True)
+                total -= entry.size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': sum(e.size for e in self._entries.values()),
+                'max_size': self._max_bytes,
+                'in_use': sum(1 for e in self._entries.values() if e.references > 0),
+            }
+
+_SERIES_CACHE = None
+_SERIES_CACHE_LOCK = threading.Lock()
+
+def get_series_cache() -> SeriesCache:
+    global _SERIES_CACHE
+
+    if _SERIES_CACHE is None:
+        with _SERIES_CACHE_LOCK:
+            if _SERIES_CACHE is None:
+                cache_dir = os.environ.get('CACHE_DIRECTORY') or '.'
+                try:
+                    max_size_mb = int(os.environ.get('SERIES_CACHE_SIZE_MB', _DEFAULT_MAX_SIZE_MB))
+                except ValueError:
+                    max_size_mb = _DEFAULT_MAX_SIZE_MB
+                _SERIES_CACHE = SeriesCache(os.path.abspath(os.path.join(cache_dir, 'series')), max_size_mb * 1024 * 1024)
+
+    return _SERIES_CACHE
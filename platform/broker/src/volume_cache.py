@@ -0,0 +1,146 @@
+## In-memory cache of parsed DICOM series
+# Building a SEG only needs the headers of the source images, but parsing every file of a thin-slice CT
+# is slow, and a multi-output prediction used to parse the same series once per output.
+# Entries are keyed by SeriesInstanceUID and validated against a fingerprint of the files on disk.
+# Entries are evicted least recently used first once the cache is larger than VOLUME_CACHE_SIZE_MB.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+import pydicom
+from pydicom import Dataset
+from rtstruct_to_seg_conversion import sort_dicom_series, map_dicom_files
+
+_DEFAULT_MAX_SIZE_MB = 1024
+
+class CachedVolume:
+    def __init__(self, series_instance_uid: str, fingerprint: tuple, datasets: List[Dataset], header_size: int):
+        self.series_instance_uid = series_instance_uid
+        self.fingerprint = fingerprint
+        self.datasets = datasets    # header-only datasets, sorted with sort_dicom_series
+        self.header_size = header_size
+        self.last_access = time.time()
+
+    @property
+    def size(self):
+        return self.header_size
+
+def _get_dicom_files(dicom_series_path: str) -> List[str]:
+    file_paths = []
+    for root, dirs, files in os.walk(dicom_series_path):
+        for file in files:
+            if file.endswith('.dcm'):
+                file_paths.append(os.path.join(root, file))
+    return sorted(file_paths)
+
+def _get_fingerprint(file_paths: List[str]) -> tuple:
+    '''Changes whenever a file is added, removed or rewritten'''
+    fingerprint = []
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        fingerprint.append((file_path, stat.st_size, stat.st_mtime_ns))
+    return tuple(fingerprint)
+
+def _read_header(file_path: str):
+    with open(file_path, 'rb') as f:
+        dataset = pydicom.dcmread(f, stop_before_pixels=True)
+        return dataset, f.tell() # bytes parsed, i.e. everything before the pixel data
+
+def _read_headers(file_paths: List[str]):
+    '''Parses the headers on the DICOM_LOAD_WORKERS pool of load_dicom_series'''
+    headers = map_dicom_files(_read_header, file_paths)
+    datasets = [dataset for dataset, _ in headers]
+    return sort_dicom_series(datasets), sum(size for _, size in headers)
+
+class VolumeCache:
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._series_locks = {}
+        self._entries: OrderedDict[str, CachedVolume] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _get_series_lock(self, series_instance_uid: str) -> threading.Lock:
+        with self._lock:
+            return self._series_locks.setdefault(series_instance_uid, threading.Lock())
+
+    def get(self, series_instance_uid: str, dicom_series_path: str) -> CachedVolume:
+        '''Returns the parsed series in dicom_series_path, parsing it only if it is not cached or its files changed'''
+        file_paths = _get_dicom_files(dicom_series_path)
+        fingerprint = _get_fingerprint(file_paths)
+
+        with self._get_series_lock(series_instance_uid):
+            with self._lock:
+                entry = self._entries.get(series_instance_uid)
+                if entry is not None and entry.fingerprint != fingerprint:
+                    del self._entries[series_instance_uid]
+                    entry = None
+                if entry is not None:
+                    self.hits += 1
+                    self._entries.move_to_end(series_instance_uid)
+                else:
+                    self.misses += 1
+
+            if entry is None:
+                print('Parsing DICOM series', series_instance_uid)
+                datasets, header_size = _read_headers(file_paths)
+                entry = CachedVolume(series_instance_uid, fingerprint, datasets, header_size)
+
+            entry.last_access = time.time()
+            with self._lock:
+                self._entries[series_instance_uid] = entry
+                self._entries.move_to_end(series_instance_uid)
+                self._evict(keep=series_instance_uid)
+
+        return entry
+
+    def get_datasets(self, series_instance_uid: str, dicom_series_path: str) -> List[Dataset]:
+        '''Returns the header-only datasets of a series. The list is a copy so callers may re-sort it'''
+        return list(self.get(series_instance_uid, dicom_series_path).datasets)
+
+    def invalidate(self, series_instance_uid: str = None):
+        with self._lock:
+            if series_instance_uid is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(series_instance_uid, None)
+
+    def _evict(self, keep: str):
+        total = sum(e.size for e in self._entries.values())
+        for series_instance_uid in list(self._entries.keys()):
+            if total <= self._max_bytes:
+                break
+            if series_instance_uid == keep:
+                continue
+            print('Evicting', series_instance_uid, 'from the volume cache')
+            total -= self._entries.pop(series_instance_uid).size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': sum(e.size for e in self._entries.values()),
+                'max_size': self._max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+_VOLUME_CACHE = None
+_VOLUME_CACHE_LOCK = threading.Lock()
+
+def get_volume_cache() -> VolumeCache:
+    global _VOLUME_CACHE
+
+    if _VOLUME_CACHE is None:
+        with _VOLUME_CACHE_LOCK:
+            if _VOLUME_CACHE is None:
+                try:
+                    max_size_mb = int(os.environ.get('VOLUME_CACHE_SIZE_MB', _DEFAULT_MAX_SIZE_MB))
+                except ValueError:
+                    max_size_mb = _DEFAULT_MAX_SIZE_MB
+                _VOLUME_CACHE = VolumeCache(max_size_mb * 1024 * 1024)
+
+    return _VOLUME_CACHE
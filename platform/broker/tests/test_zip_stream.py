@@ -0,0 +1,156 @@
+## Tests for iter_zip_stream, the zip reader that series archives are streamed through
+# Run from platform/broker:
+#   python -m pytest tests
+
+import os
+import sys
+import io
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import pytest
+from orthanc_functions import iter_zip_stream, UnsupportedZipMemberError
+
+_MEMBERS = {
+    'patient/study/series/1.dcm': os.urandom(3000),
+    'patient/study/series/2.dcm': b'DICM' * 5000,
+    'patient/study/series/empty.dcm': b'',
+}
+
+class _UnseekableWriter(io.RawIOBase):
+    '''A stream zipfile cannot seek back in, so it writes data descriptors like a streaming server'''
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+def _write_zip(compression, streamed=False, force_zip64=False, directories=False):
+    output = _UnseekableWriter() if streamed else io.BytesIO()
+    with zipfile.ZipFile(output, 'w', compression=compression) as zf:
+        if directories:
+            zf.writestr('patient/', b'')
+        for name, data in _MEMBERS.items():
+            with zf.open(name, 'w', force_zip64=force_zip64) as member:
+                member.write(data)
+    return bytes(output.buffer) if streamed else output.getvalue()
+
+def _read(archive, chunk_size=7):
+    # small chunks, so that headers, data and descriptors are split across chunk boundaries
+    return dict(iter_zip_stream(archive[i:i + chunk_size] for i in range(0, len(archive), chunk_size)))
+
+def _get_flags(archive):
+    return [info.flag_bits for info in zipfile.ZipFile(io.BytesIO(archive)).infolist()]
+
+def test_stored():
+    archive = _write_zip(zipfile.ZIP_STORED)
+    assert not any(flags & 0x08 for flags in _get_flags(archive))
+    assert _read(archive) == _MEMBERS
+
+def test_deflated():
+    archive = _write_zip(zipfile.ZIP_DEFLATED)
+    assert not any(flags & 0x08 for flags in _get_flags(archive))
+    assert _read(archive) == _MEMBERS
+
+def test_deflated_with_data_descriptors():
+    archive = _write_zip(zipfile.ZIP_DEFLATED, streamed=True)
+    assert all(flags & 0x08 for flags in _get_flags(archive))
+    assert _read(archive) == _MEMBERS
+
+def test_deflated_zip64_with_data_descriptors():
+    archive = _write_zip(zipfile.ZIP_DEFLATED, streamed=True, force_zip64=True)
+    assert _read(archive) == _MEMBERS
+
+def test_stored_zip64():
+    assert _read(_write_zip(zipfile.ZIP_STORED, force_zip64=True)) == _MEMBERS
+
+def test_directories_are_skipped():
+    assert _read(_write_zip(zipfile.ZIP_DEFLATED, directories=True)) == _MEMBERS
+
+def test_whole_archive_in_one_chunk():
+    archive = _write_zip(zipfile.ZIP_DEFLATED, streamed=True)
+    assert _read(archive, chunk_size=len(archive)) == _MEMBERS
+
+def test_stored_with_data_descriptors_is_unsupported():
+    archive = _write_zip(zipfile.ZIP_STORED, streamed=True)
+    assert all(flags & 0x08 for flags in _get_flags(archive))
+    with pytest.raises(UnsupportedZipMemberError):
+        _read(archive)
+
+def test_other_compression_is_unsupported():
+    with pytest.raises(UnsupportedZipMemberError):
+        _read(_write_zip(zipfile.ZIP_BZIP2))
+
+def test_crc_mismatch():
+    archive = bytearray(_write_zip(zipfile.ZIP_STORED))
+    data_offset = archive.index(_MEMBERS['patient/study/series/2.dcm'])
+    archive[data_offset] ^= 0xFF
+    with pytest.raises(Exception, match='CRC mismatch'):
+        _read(bytes(archive))
+
+def test_truncated_deflated_member():
+    archive = _write_zip(zipfile.ZIP_DEFLATED)
+    with pytest.raises(Exception, match='ended in the middle'):
+        _read(archive[:len(archive) // 2])
+
+class _FakeResponse:
+    def __init__(self, archive):
+        self._archive = archive
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_bytes(self):
+        for i in range(0, len(self._archive), 1024):
+            yield self._archive[i:i + 1024]
+
+class _FakeSeries:
+    id_ = 'series'
+
+def test_stream_series_archive_removes_partial_files(tmp_path, monkeypatch):
+    import orthanc_functions
+
+    # the first member can be streamed, the second cannot
+    output = _UnseekableWriter()
+    with zipfile.ZipFile(output, 'w') as zf:
+        zf.writestr(zipfile.ZipInfo('series/1.dcm'), b'a' * 100, compress_type=zipfile.ZIP_DEFLATED)
+        with zf.open(zipfile.ZipInfo('series/2.dcm'), 'w') as member:
+            member.write(b'b' * 100)
+    archive = bytes(output.buffer)
+
+    class FakeClient:
+        def stream(self, method, url):
+            return _FakeResponse(archive)
+
+    monkeypatch.setattr(orthanc_functions, 'get_orthanc_client', lambda: FakeClient())
+    zip_path = tmp_path / 'series.zip'
+    with pytest.raises(UnsupportedZipMemberError):
+        orthanc_functions.stream_series_archive(_FakeSeries(), str(tmp_path / 'out'), zip_path=str(zip_path))
+    assert not zip_path.exists()
+    assert [files for _, _, files in os.walk(tmp_path)] == [[], [], []]
+
+def test_stream_series_archive_flatten(tmp_path, monkeypatch):
+    import orthanc_functions
+
+    archive = _write_zip(zipfile.ZIP_DEFLATED, streamed=True)
+
+    class FakeClient:
+        def stream(self, method, url):
+            return _FakeResponse(archive)
+
+    monkeypatch.setattr(orthanc_functions, 'get_orthanc_client', lambda: FakeClient())
+    paths = orthanc_functions.stream_series_archive(_FakeSeries(), str(tmp_path), flatten=True)
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(name) for name in _MEMBERS)
+    assert {os.path.basename(path): open(path, 'rb').read() for path in paths} == { os.path.basename(name): data for name, data in _MEMBERS.items() }